@@ -0,0 +1,233 @@
+"""批次問答模組
+
+回歸測試集或 FAQ 覆蓋率檢查需要一次回答數千個問題，逐一呼叫 /chat 時每個問題各自嵌入、檢索與等待生成。
+此模組（POST /chat/batch 與 python -m backend.batch）一次處理整批問題：
+1. 正規化後相同的問題只處理一次
+2. 需要嵌入的問題一次批次嵌入，向量檢索以一次批次搜尋完成
+3. 檢索到相同上下文的問題只組裝一次上下文，並排在一起生成，Ollama 可重用相同 prompt 開頭的 KV 快取
+4. 以有限的並發數生成（經生成排程，與互動的聊天請求輪流），每完成一題就以 JSONL 輸出，附上該題的延遲
+
+使用方式：
+    python -m backend.batch questions.jsonl -o answers.jsonl --concurrency 4
+每行為 {"id": "q1", "question": "運費如何計算？"} 或單純的 JSON 字串；批次問答不寫入聊天歷史。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+from contextlib import redirect_stdout
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from backend import rag
+from backend.rag import aretrieve_many, cache_answer, normalize_question, prompt_template
+from backend.context_packing import pack_context
+from backend.database import init_db
+from backend.ollama_client import agenerate, close_async_client, generation_scheduler
+from backend.scheduler import OllamaBusyError
+from backend.metrics import span, ANSWERS_TOTAL
+
+# 每批最多的問題數
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "10000"))
+
+# 同時生成的問題數（0 表示與生成排程的並發上限相同）
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "0"))
+
+# Ollama 忙碌（排隊逾時）時每題最多重試的次數
+BATCH_BUSY_RETRIES = int(os.getenv("BATCH_BUSY_RETRIES", "5"))
+
+def parse_questions(lines: Iterable[str]) -> Tuple[List[dict], List[dict]]:
+    """解析 JSONL 問題，返回 (問題, 無法解析的行的錯誤結果)；空白行略過
+
+    每行可以是含 question（或 message）欄位的物件，id 欄位會原樣輸出；也可以是單純的 JSON 字串。
+    """
+    items, errors = [], []
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        item = {"line": line_number, "id": None}
+        try:
+            data = json.loads(line)
+            if isinstance(data, dict):
+                item["id"] = data.get("id")
+                question = data.get("question", data.get("message"))
+            else:
+                question = data
+            if not isinstance(question, str) or not question.strip():
+                raise ValueError("缺少 question 欄位或問題為空")
+        except ValueError as e:
+            errors.append({
+                **item, "question": None, "answer": None, "source": "invalid", "retrieval": None,
+                "latency_ms": 0.0, "generate_ms": 0.0, "error": str(e),
+            })
+            continue
+        items.append({**item, "question": question.strip()})
+    return items, errors
+
+def default_concurrency() -> int:
+    """預設的生成並發數"""
+    return BATCH_CONCURRENCY or generation_scheduler.max_concurrency
+
+async def _agenerate(prompt: str, session_id: str) -> str:
+    """生成回答，Ollama 忙碌時依建議的秒數等待後重試"""
+    for attempt in range(BATCH_BUSY_RETRIES + 1):
+        try:
+            return await agenerate(prompt, session_id)
+        except OllamaBusyError as e:
+            if attempt == BATCH_BUSY_RETRIES:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+async def aanswer_batch(items: List[dict], concurrency: Optional[int] = None) -> AsyncIterator[dict]:
+    """回答一批問題（items 由 parse_questions 產生），依完成順序逐題返回結果
+
+    每題的結果包含 answer、source（generated、intent、exact_cache、semantic_cache、out_of_scope、no_document、error）、
+    retrieval（lexical、hybrid）、latency_ms（從批次開始到該題完成）與 generate_ms（該題的排隊與生成時間）。
+    """
+    start = time.perf_counter()
+    concurrency = max(1, concurrency or default_concurrency())
+    # 整批使用同一個排程 key，互動的聊天請求仍與批次輪流取得生成名額
+    session_id = f"batch-{uuid.uuid4().hex[:12]}"
+    generation = rag.vectorstore_generation
+
+    def result(item: dict, answer: Optional[str], source: str, retrieval: Optional[str] = None,
+               generate_ms: float = 0.0, error: Optional[str] = None) -> dict:
+        output = {
+            "line": item["line"],
+            "id": item["id"],
+            "question": item["question"],
+            "answer": answer,
+            "source": source,
+            "retrieval": retrieval,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+            "generate_ms": round(generate_ms, 1),
+        }
+        if error is not None:
+            output["error"] = error
+        return output
+
+    # 1. 正規化後相同的問題只處理一次
+    groups: Dict[str, List[dict]] = {}
+    for item in items:
+        groups.setdefault(normalize_question(item["question"]), []).append(item)
+    unique = [members[0]["question"] for members in groups.values()]
+    members_list = list(groups.values())
+
+    # 2. 批次檢索
+    try:
+        retrieved = await aretrieve_many(unique)
+    except Exception as e:
+        ANSWERS_TOTAL.labels("error").inc(len(unique))
+        for members in members_list:
+            for item in members:
+                yield result(item, None, "error", error=f"檢索時發生錯誤：{e}")
+        return
+
+    # 3. 依上下文分組：相同的文本塊只組裝一次上下文，相同上下文的問題排在一起生成
+    jobs: List[Tuple[str, str, Optional[List[float]], str, List[dict]]] = []
+    answered = []
+    contexts: Dict[tuple, str] = {}
+    with span("batch", "prompt"):
+        for question, members, (answer, embedding, docs, path) in zip(unique, members_list, retrieved):
+            if answer is not None:
+                answered.extend(result(item, answer, path) for item in members)
+                continue
+            key = tuple(doc.page_content for doc in docs)
+            if key not in contexts:
+                contexts[key] = pack_context(docs)
+            jobs.append((question, contexts[key], embedding, path, members))
+    for item in answered:
+        yield item
+    order = {key: position for position, key in enumerate(contexts.values())}
+    jobs.sort(key=lambda job: order[job[1]])
+
+    # 4. 以有限的並發數生成，完成一題就輸出
+    results: asyncio.Queue = asyncio.Queue()
+    next_job = iter(jobs)
+
+    async def worker():
+        for question, context, embedding, path, members in next_job:
+            generate_start = time.perf_counter()
+            try:
+                answer = await _agenerate(prompt_template.format(context=context, question=question), session_id)
+                ANSWERS_TOTAL.labels("generated").inc()
+                answer = answer or "抱歉，我無法生成回答。"
+                cache_answer(question, embedding, answer, generation)
+                source, error = "generated", None
+            except Exception as e:
+                ANSWERS_TOTAL.labels("error").inc()
+                answer, source, error = None, "error", f"生成回答時發生錯誤：{e}"
+            generate_ms = (time.perf_counter() - generate_start) * 1000
+            for item in members:
+                await results.put(result(item, answer, source, path, generate_ms, error))
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(jobs)))]
+    remaining = sum(len(job[4]) for job in jobs)
+    try:
+        while remaining:
+            yield await results.get()
+            remaining -= 1
+    finally:
+        # 用戶端中途斷線時停止尚未完成的生成
+        for task in workers:
+            task.cancel()
+
+def summarize(results: List[dict], seconds: float) -> dict:
+    """批次的統計：題數、各來源的題數、吞吐量與延遲"""
+    latencies = sorted(item["latency_ms"] for item in results)
+    generate_times = sorted(item["generate_ms"] for item in results if item["source"] == "generated")
+    return {
+        "questions": len(results),
+        "sources": dict(Counter(item["source"] for item in results)),
+        "seconds": round(seconds, 3),
+        "questions_per_sec": round(len(results) / seconds, 2) if seconds > 0 else 0.0,
+        "latency_ms_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+        "generate_ms_p50": generate_times[len(generate_times) // 2] if generate_times else 0.0,
+    }
+
+async def run_cli(input_path: str, output_path: Optional[str], concurrency: Optional[int]):
+    """讀取 JSONL 問題檔並將結果逐行寫入輸出檔（或標準輸出），最後在標準錯誤印出統計
+
+    載入向量庫等過程的訊息改印到標準錯誤，標準輸出只有結果。
+    """
+    if input_path == "-":
+        items, errors = parse_questions(sys.stdin)
+    else:
+        with open(input_path, encoding="utf-8") as f:
+            items, errors = parse_questions(f)
+    total = len(items) + len(errors)
+    output = open(output_path, "w", encoding="utf-8") if output_path else sys.stdout
+    start = time.perf_counter()
+    results = list(errors)
+    try:
+        with redirect_stdout(sys.stderr):
+            # 與 API 啟動時相同先建立資料表：SHARED_INDEX 模式在新的資料庫上需要 index_versions 表
+            await asyncio.to_thread(init_db)
+            for item in errors:
+                output.write(json.dumps(item, ensure_ascii=False) + "\n")
+            async for item in aanswer_batch(items, concurrency):
+                results.append(item)
+                output.write(json.dumps(item, ensure_ascii=False) + "\n")
+                output.flush()
+                if output_path and len(results) % 100 == 0:
+                    print(f"已完成 {len(results)}/{total} 題")
+            await close_async_client()
+    finally:
+        if output_path:
+            output.close()
+    print(json.dumps(summarize(results, time.perf_counter() - start), ensure_ascii=False), file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="批次回答 JSONL 檔案中的問題（直接載入向量庫並呼叫 Ollama，不需啟動 API）")
+    parser.add_argument("input", help="JSONL 問題檔（- 表示標準輸入）")
+    parser.add_argument("-o", "--output", help="輸出的 JSONL 檔案（預設為標準輸出）")
+    parser.add_argument("--concurrency", type=int, default=None, help="同時生成的問題數（預設依 BATCH_CONCURRENCY）")
+    args = parser.parse_args()
+    asyncio.run(run_cli(args.input, args.output, args.concurrency))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""Prompt 上下文組裝模組
+
+檢索到的文本塊來自 chunk_overlap=50 的分割器，直接串接會重複相鄰文本塊的重疊部分，
+prompt 長度也不受控制；而 prompt 評估正是 CPU 上首個 token 延遲的主要來源。
+此模組在組合 prompt 前：
+1. 合併同一文件中相鄰的文本塊（去除重疊的文字）
+2. 移除與已選段落幾乎相同的段落
+3. 依相關性順序放入段落，直到用完 token 預算
+"""
+from langchain_core.documents import Document
+from typing import List, Set
+import re
+import os
+
+# 上下文最多佔用的 token 數（以 estimate_tokens 估算）
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1024"))
+
+# 兩個段落字元 3-gram 的 Jaccard 相似度達此門檻時視為重複
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.8"))
+
+# 預算剩餘不足此 token 數時不再截斷段落放入（過短的片段幫助不大）
+_MIN_PASSAGE_TOKENS = 32
+
+# 合併相鄰文本塊時檢查的最大重疊字元數（略大於分割器的 chunk_overlap）
+_MAX_OVERLAP_CHARS = 200
+
+# 估算 token 數：中日韓文字每字一個，英數字每個單字一個，其餘每個符號一個
+_TOKEN_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff]|[A-Za-z0-9]+|[^\sA-Za-z0-9]")
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文字的 token 數（不呼叫 tokenizer）"""
+    return len(_TOKEN_PATTERN.findall(text))
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """將文字截斷至約 budget 個 token"""
+    if budget <= 0:
+        return ""
+    for count, match in enumerate(_TOKEN_PATTERN.finditer(text), start=1):
+        if count == budget:
+            end = match.end()
+            return text[:end] + "…" if end < len(text.rstrip()) else text
+    return text
+
+def _overlap_length(left: str, right: str) -> int:
+    """left 的結尾與 right 的開頭重疊的字元數"""
+    for length in range(min(len(left), len(right), _MAX_OVERLAP_CHARS), 0, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+def _join_adjacent(left: str, right: str) -> str:
+    """串接相鄰的兩個文本塊，去除重疊的部分"""
+    overlap = _overlap_length(left, right)
+    if overlap:
+        return left + right[overlap:]
+    return left + "\n" + right
+
+def merge_adjacent(docs: List[Document]) -> List[Document]:
+    """合併同一文件中 chunk_index 相鄰的文本塊，合併後的段落排在其中最相關的文本塊的位置"""
+    groups = []
+    # (source, chunk_index) -> 所屬的段落
+    positions = {}
+    for doc in docs:
+        source = doc.metadata.get("source")
+        index = doc.metadata.get("chunk_index")
+        if source is None or index is None:
+            groups.append([doc])
+            continue
+        # 已有段落包含前一個或後一個文本塊時併入該段落；同時相鄰兩個段落時將兩者合併
+        group = positions.get((source, index - 1))
+        following = positions.get((source, index + 1))
+        if group is None:
+            group = following
+        elif following is not None and following is not group:
+            group.extend(following)
+            groups = [other for other in groups if other is not following]
+            for other in following:
+                positions[(source, other.metadata["chunk_index"])] = group
+        if group is None:
+            group = [doc]
+            groups.append(group)
+        else:
+            group.append(doc)
+        positions[(source, index)] = group
+
+    passages = []
+    for group in groups:
+        if len(group) == 1:
+            passages.append(group[0])
+            continue
+        ordered = sorted(group, key=lambda doc: doc.metadata["chunk_index"])
+        text = ordered[0].page_content
+        for doc in ordered[1:]:
+            text = _join_adjacent(text, doc.page_content)
+        metadata = dict(ordered[0].metadata)
+        metadata["chunk_indexes"] = [doc.metadata["chunk_index"] for doc in ordered]
+        passages.append(Document(page_content=text, metadata=metadata))
+    return passages
+
+def _shingles(text: str) -> Set[str]:
+    """去除空白後的字元 3-gram"""
+    text = "".join(text.split())
+    return {text[i:i + 3] for i in range(max(len(text) - 2, 1))}
+
+def drop_near_duplicates(docs: List[Document], threshold: float = CONTEXT_DUPLICATE_THRESHOLD) -> List[Document]:
+    """移除與較相關段落內容幾乎相同（或被其完整包含）的段落"""
+    kept = []
+    kept_shingles = []
+    for doc in docs:
+        shingles = _shingles(doc.page_content)
+        duplicate = False
+        for other, other_shingles in zip(kept, kept_shingles):
+            if doc.page_content.strip() in other.page_content:
+                duplicate = True
+                break
+            union = len(shingles | other_shingles)
+            if union and len(shingles & other_shingles) / union >= threshold:
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(doc)
+            kept_shingles.append(shingles)
+    return kept
+
+def pack_documents(docs: List[Document], budget: int = CONTEXT_TOKEN_BUDGET) -> List[Document]:
+    """組裝上下文：合併相鄰文本塊、移除重複段落，再依相關性順序放入 token 預算內
+
+    docs 需依相關性由高到低排列。放不下的段落截斷至剩餘的預算後放入；
+    剩餘預算太少時改為略過，讓後面較短的段落仍有機會完整放入。
+    """
+    packed = []
+    remaining = budget
+    for doc in drop_near_duplicates(merge_adjacent(docs)):
+        tokens = estimate_tokens(doc.page_content)
+        if tokens <= remaining:
+            packed.append(doc)
+            remaining -= tokens
+        elif not packed or remaining >= _MIN_PASSAGE_TOKENS:
+            text = truncate_to_tokens(doc.page_content, remaining)
+            if text:
+                packed.append(Document(page_content=text, metadata=doc.metadata))
+            break
+    return packed
+
+def pack_context(docs: List[Document], budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """組裝上下文並以與 stuff 鏈相同的分隔方式串接"""
+    return "\n\n".join(doc.page_content for doc in pack_documents(docs, budget))
@@ -1,24 +1,99 @@
 """資料庫初始化模組"""
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from contextlib import contextmanager
 import os
 
 # SQLite 資料庫路徑
 DB_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "custom_service.db")
 
-# 創建資料庫引擎
+# SQLite 連線設定：WAL 模式下讀取不會被寫入阻塞，synchronous=NORMAL 只在 checkpoint 時 fsync
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+# 每個連線的頁面快取（KB）與記憶體映射大小（MB）
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE_MB = int(os.getenv("SQLITE_MMAP_SIZE_MB", "256"))
+# 資料庫被其他連線鎖定時等待的毫秒數（逾時才拋出 database is locked）
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# 連線池大小：常駐連線數與尖峰時可額外建立的連線數
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """每個新的 SQLite 連線套用 PRAGMA 設定"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE_MB * 1024 * 1024}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+# 創建資料庫引擎（背景上傳工作在執行緒中使用）
 engine = create_engine(
     f"sqlite:///{DB_PATH}",
-    connect_args={"check_same_thread": False}
+    connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW
 )
+event.listen(engine, "connect", set_sqlite_pragmas)
 
 # 創建 SessionLocal 類別
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 創建非同步資料庫引擎（aiosqlite），供 API 端點使用，避免阻塞事件迴圈
+# （aiosqlite 預設不使用連線池，每個請求都要開啟新連線並建立一條執行緒）
+async_engine = create_async_engine(
+    f"sqlite+aiosqlite:///{DB_PATH}",
+    connect_args={"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW
+)
+event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+
+# 創建 AsyncSessionLocal 類別
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    autoflush=False,
+    expire_on_commit=False
+)
+
 # 創建 Base 類別
 Base = declarative_base()
 
+@contextmanager
+def file_lock(path: str):
+    """跨行程的檔案鎖（多個 worker 共用同一個資料庫與索引目錄時使用）"""
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            # LK_LOCK 約 10 秒內無法取得時拋出 OSError，繼續等待
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
 def get_db():
     """獲取資料庫 session"""
     db = SessionLocal()
@@ -27,8 +102,29 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    """獲取非同步資料庫 session"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
 def init_db():
-    """初始化資料庫表"""
-    from backend.models import Document, ChatHistory
-    Base.metadata.create_all(bind=engine)
+    """初始化資料庫表（多個 worker 同時啟動時依序執行，避免重複建立資料表或欄位）"""
+    from backend.models import Document, ChatHistory, IngestJob, IndexVersion
+    with file_lock(f"{DB_PATH}.init.lock"):
+        Base.metadata.create_all(bind=engine)
+        migrate_db()
+
+def migrate_db():
+    """為舊版資料庫補上新增的欄位與索引（create_all 不會修改既有資料表）"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+                    print(f"資料表 {table.name} 新增欄位：{column.name}")
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
 
@@ -0,0 +1,154 @@
+"""嵌入向量持久化快取模組"""
+from langchain_core.embeddings import Embeddings
+from typing import List, Optional
+import numpy as np
+import hashlib
+import sqlite3
+import threading
+import time
+import os
+
+# 快取資料庫路徑（與 custom_service.db 放在同一目錄）
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "embedding_cache.db")
+)
+
+# 快取最多保留的向量數，超過時淘汰最早寫入的項目
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+
+def text_hash(text: str) -> str:
+    """計算文字的 sha256"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _unit(blob: bytes) -> List[float]:
+    """將儲存的向量單位化後返回（舊版以 /api/embeddings 寫入的向量未單位化）"""
+    vector = np.frombuffer(blob, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm > 0 else vector).tolist()
+
+class EmbeddingCache:
+    """以 SQLite 儲存的嵌入向量快取，鍵為 (模型名稱, 文字 sha256)，向量以 float32 儲存"""
+    
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_created_at ON embeddings (created_at)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+    
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """查詢多段文字的嵌入向量，未命中的位置為 None"""
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            # SQLite 參數數量有上限，分批查詢
+            for start in range(0, len(hashes), 500):
+                batch = hashes[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch]
+                ).fetchall()
+                found.update(rows)
+            results = [_unit(found[h]) if h in found else None for h in hashes]
+            hit_count = sum(1 for result in results if result is not None)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        return results
+    
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """寫入多段文字的嵌入向量"""
+        if not texts:
+            return
+        now = time.time()
+        rows = [
+            (model, text_hash(text), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            cursor = self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, text_hash, vector, created_at) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._count += max(cursor.rowcount, 0)
+            if self._count > self.max_entries:
+                self._evict()
+            self._conn.commit()
+    
+    def _evict(self):
+        """淘汰最早寫入的項目，保留約 90% 的容量"""
+        excess = self._count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY created_at LIMIT ?)",
+            (excess,)
+        )
+        self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    
+    def stats(self) -> dict:
+        """快取命中統計"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": self._count,
+                "max_size": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+class CachedEmbeddings(Embeddings):
+    """包裝 OllamaEmbeddings：文字未變時直接從快取取得嵌入向量，不呼叫 Ollama
+    
+    快取鍵使用加上指令前綴後的文字，因此查詢與文件的嵌入不會互相混用。
+    """
+    
+    def __init__(self, underlying, cache: EmbeddingCache, model: str):
+        self.underlying = underlying
+        self.cache = cache
+        self.model = model
+    
+    @property
+    def query_instruction(self) -> str:
+        return self.underlying.query_instruction
+    
+    @property
+    def embed_instruction(self) -> str:
+        return self.underlying.embed_instruction
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """嵌入文件，只對未命中快取的文字呼叫 Ollama"""
+        keys = [f"{self.embed_instruction}{text}" for text in texts]
+        results = self.cache.get_many(self.model, keys)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            vectors = self.underlying.embed_documents([texts[i] for i in missing])
+            self.cache.put_many(self.model, [keys[i] for i in missing], vectors)
+            for i, vector in zip(missing, vectors):
+                results[i] = vector
+        return results
+    
+    def embed_query(self, text: str) -> List[float]:
+        """嵌入查詢文字"""
+        key = f"{self.query_instruction}{text}"
+        cached = self.cache.get_many(self.model, [key])[0]
+        if cached is not None:
+            return cached
+        vector = self.underlying.embed_query(text)
+        self.cache.put_many(self.model, [key], [vector])
+        return vector
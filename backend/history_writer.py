@@ -0,0 +1,196 @@
+"""聊天歷史的延後批次寫入模組
+
+每則對話各自 db.add() + commit() 時，每個請求都要等待 SQLite 的寫入鎖與一次 fsync，
+並發時寫入互相排隊，延遲直接反映在聊天回應上。
+此模組讓 API 只把對話放進記憶體佇列就返回，背景 task 定期將累積的對話
+以一次交易批次寫入：
+1. 累積到 HISTORY_BATCH_SIZE 筆或距第一筆等待超過 HISTORY_FLUSH_INTERVAL_MS 時寫入
+2. 佇列已滿時新的對話等待空位（背壓），不會無限佔用記憶體
+3. 尚未寫入的對話仍可被同一會話的下一個問題讀取（對話感知檢索不會漏掉上一輪）
+4. 關閉時寫完佇列中剩餘的對話
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, List, Optional, Tuple
+
+from sqlalchemy import insert
+
+from backend.database import AsyncSessionLocal
+from backend.models import ChatHistory
+from backend.metrics import record_stage
+
+# 每批最多寫入的對話數與最長等待時間（毫秒）
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "200"))
+HISTORY_FLUSH_INTERVAL_MS = float(os.getenv("HISTORY_FLUSH_INTERVAL_MS", "100"))
+
+# 佇列中最多等待寫入的對話數
+HISTORY_QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", "10000"))
+
+# 等待佇列寫完的最長時間（秒），資料庫持續寫入失敗時 flush 不會無限等待
+HISTORY_FLUSH_TIMEOUT = float(os.getenv("HISTORY_FLUSH_TIMEOUT", "10"))
+
+# 寫入失敗時的重試間隔（秒）
+_RETRY_INTERVAL = 1.0
+
+class HistoryWriter:
+    """將 ChatHistory 的新增延後並合併為批次交易"""
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self._pending: Deque[dict] = deque()
+        # 正在寫入、尚未提交的批次（仍要讓讀取端看得到）
+        self._writing: List[dict] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._space: Optional[asyncio.Condition] = None
+        self._flushed: Optional[asyncio.Condition] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        # 關閉時仍寫入失敗而放棄的對話數
+        self._dropped = 0
+        self.max_batch_size = 0
+
+    def start(self) -> asyncio.Task:
+        """在背景開始寫入"""
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._flushed = asyncio.Condition()
+        self._closing = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self._task
+
+    async def add(self, user_message: str, bot_response: str, session_id: str):
+        """將一則對話放入佇列（佇列已滿時等待空位）"""
+        if self._task is None:
+            # 背景 task 未啟動（例如在 lifespan 之外使用）時直接寫入
+            await self._write([self._row(user_message, bot_response, session_id)])
+            return
+        if len(self._pending) >= self.max_queue:
+            async with self._space:
+                await self._space.wait_for(lambda: len(self._pending) < self.max_queue)
+        self._pending.append(self._row(user_message, bot_response, session_id))
+        self.queued += 1
+        if len(self._pending) >= self.batch_size or len(self._pending) == 1:
+            self._wakeup.set()
+
+    @staticmethod
+    def _row(user_message: str, bot_response: str, session_id: str) -> dict:
+        # 時間戳記在放入佇列時決定，批次寫入不會改變對話的先後順序；
+        # 與 ChatHistory.timestamp 的預設值（SQLite CURRENT_TIMESTAMP）相同，以不含時區的 UTC 時間儲存
+        return {
+            "timestamp": datetime.now(timezone.utc).replace(tzinfo=None),
+            "user_message": user_message,
+            "bot_response": bot_response,
+            "session_id": session_id,
+        }
+
+    def pending_turns(self, session_id: str) -> List[Tuple[str, str, datetime]]:
+        """同一會話尚未寫入資料庫的 (用戶訊息, 回答, 時間戳記)（由舊到新）"""
+        return [
+            (row["user_message"], row["bot_response"], row["timestamp"])
+            for row in [*self._writing, *self._pending]
+            if row["session_id"] == session_id
+        ]
+
+    async def flush(self, timeout: float = HISTORY_FLUSH_TIMEOUT) -> bool:
+        """等待目前佇列中的對話全部寫入（例如刪除會話歷史之前）
+
+        timeout 秒內未寫完（例如資料庫持續寫入失敗、批次不斷重試）時返回 False。
+        """
+        if self._task is None or (not self._pending and not self._writing):
+            return True
+        target = self.queued
+        self._wakeup.set()
+        async with self._flushed:
+            try:
+                await asyncio.wait_for(
+                    self._flushed.wait_for(lambda: self.written + self._dropped >= target or self._task.done()),
+                    timeout
+                )
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def close(self):
+        """寫完佇列中剩餘的對話後停止背景 task"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # 第一筆到達後最多等待 flush_interval 再寫入，期間累積的對話一起提交
+            if len(self._pending) < self.batch_size and not self._closing:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            count = min(len(self._pending), self.batch_size)
+            self._writing = [self._pending.popleft() for _ in range(count)]
+            async with self._space:
+                self._space.notify_all()
+            try:
+                await self._write(self._writing)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                if self._closing:
+                    print(f"寫入聊天歷史失敗，放棄 {count} 則對話：{e}")
+                    self._dropped += count
+                else:
+                    # 放回佇列前端，稍後重試
+                    print(f"寫入聊天歷史失敗，{_RETRY_INTERVAL:g} 秒後重試 {count} 則對話：{e}")
+                    self._pending.extendleft(reversed(self._writing))
+                    self._writing = []
+                    await asyncio.sleep(_RETRY_INTERVAL)
+                    continue
+            else:
+                self.written += count
+            self._writing = []
+            async with self._flushed:
+                self._flushed.notify_all()
+
+    async def _write(self, rows: List[dict]):
+        """以一次交易寫入一批對話"""
+        start = time.perf_counter()
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(ChatHistory), rows)
+            await db.commit()
+        record_stage("db", "save_history_batch", time.perf_counter() - start)
+        self.batches += 1
+        self.max_batch_size = max(self.max_batch_size, len(rows))
+
+    def stats(self) -> dict:
+        """佇列長度與批次寫入統計"""
+        return {
+            "queue_depth": len(self._pending) + len(self._writing),
+            "queued": self.queued,
+            "written": self.written,
+            "batches": self.batches,
+            "failures": self.failures,
+            "avg_batch_size": round(self.written / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+        }
+
+history_writer = HistoryWriter(HISTORY_BATCH_SIZE, HISTORY_FLUSH_INTERVAL_MS / 1000, HISTORY_QUEUE_SIZE)
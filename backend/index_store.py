@@ -0,0 +1,139 @@
+"""多 worker 共用的版本化索引模組
+
+以 uvicorn --workers N 或多台主機執行時，每個 worker 各自在記憶體中持有向量庫、BM25 索引與向量索引，
+某個 worker 處理上傳後其他 worker 不會知道。啟用 SHARED_INDEX 後改為：
+1. 寫入（上傳、刪除文件）時取得跨行程的檔案鎖，將目前版本的索引目錄複製為新版本後在新目錄中修改
+2. 寫入完成後在 SQLite 的 index_versions 資料表發布新版本；發布前的舊版本目錄不會被修改
+3. 每個 worker 定期檢查最新版本，有新版本時在背景載入新目錄，載入完成後才切換，查詢不中斷
+4. 保留最近 INDEX_KEEP_VERSIONS 個版本，更早的版本在發布超過 INDEX_RETIRE_GRACE 秒後刪除
+多台主機時 INDEX_ROOT 與資料庫需放在共用儲存上。
+"""
+import os
+import shutil
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from backend.database import SessionLocal, file_lock
+from backend.models import IndexVersion
+
+# 是否啟用多 worker 共用的版本化索引
+SHARED_INDEX = os.getenv("SHARED_INDEX", "0") == "1"
+
+# 版本化索引的根目錄（各版本存放在 v000001、v000002 … 子目錄）
+INDEX_ROOT = os.getenv(
+    "INDEX_ROOT",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "indexes")
+)
+
+# 檢查新版本的間隔（秒）
+INDEX_POLL_INTERVAL = float(os.getenv("INDEX_POLL_INTERVAL", "1"))
+
+# 保留的版本數，以及舊版本發布後至少保留的秒數（讓仍在使用舊版本的查詢完成）
+INDEX_KEEP_VERSIONS = max(2, int(os.getenv("INDEX_KEEP_VERSIONS", "3")))
+INDEX_RETIRE_GRACE = float(os.getenv("INDEX_RETIRE_GRACE", "60"))
+
+# 版本目錄中 Chroma 與向量索引的子目錄名稱
+CHROMA_SUBDIR = "chroma"
+VECTOR_INDEX_SUBDIR = "vector_index"
+
+_HOSTNAME = socket.gethostname()
+
+def worker_id() -> str:
+    """目前 worker 的識別（主機名稱:行程 ID）"""
+    return f"{_HOSTNAME}:{os.getpid()}"
+
+def is_worker_alive(worker: Optional[str]) -> bool:
+    """worker 是否仍在執行（其他主機的 worker 無法檢查，視為仍在執行）"""
+    if not worker:
+        return False
+    host, _, pid = worker.rpartition(":")
+    if host != _HOSTNAME:
+        return True
+    if not pid.isdigit() or int(pid) == os.getpid():
+        # 行程 ID 與目前的行程相同表示是重新啟動前留下的記錄
+        return False
+    if os.name == "nt":
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def version_directory(version: int) -> str:
+    """版本對應的索引目錄"""
+    return os.path.join(INDEX_ROOT, f"v{version:06d}")
+
+def chroma_directory(directory: str) -> str:
+    """索引目錄中的 Chroma 目錄"""
+    return os.path.join(directory, CHROMA_SUBDIR)
+
+def vector_index_directory(directory: str) -> str:
+    """索引目錄中的向量索引目錄"""
+    return os.path.join(directory, VECTOR_INDEX_SUBDIR)
+
+def ingest_lock():
+    """跨行程的寫入鎖：同一時間只有一個 worker 建立新版本"""
+    os.makedirs(INDEX_ROOT, exist_ok=True)
+    return file_lock(os.path.join(INDEX_ROOT, ".lock"))
+
+def latest_version() -> Optional[Tuple[int, str]]:
+    """最新發布的版本，返回 (版本號, 索引目錄)；尚未發布任何版本時返回 None"""
+    db = SessionLocal()
+    try:
+        row = db.query(IndexVersion).order_by(IndexVersion.version.desc()).first()
+        return (row.version, row.directory) if row is not None else None
+    finally:
+        db.close()
+
+def prepare_version(base_directory: Optional[str], legacy: Optional[dict] = None) -> Tuple[int, str]:
+    """建立下一個版本的索引目錄（需持有 ingest_lock）：複製 base_directory，沒有時複製 legacy 中的舊版目錄"""
+    latest = latest_version()
+    version = (latest[0] if latest else 0) + 1
+    directory = version_directory(version)
+    if os.path.exists(directory):
+        # 上次建立後未發布（例如寫入中斷）的目錄
+        shutil.rmtree(directory)
+    if base_directory is not None:
+        shutil.copytree(base_directory, directory)
+    else:
+        os.makedirs(directory)
+        for name, source in (legacy or {}).items():
+            if os.path.isdir(source) and os.listdir(source):
+                shutil.copytree(source, os.path.join(directory, name))
+    return version, directory
+
+def discard_version(directory: str):
+    """刪除未發布的索引目錄（沒有任何變更或寫入失敗時）"""
+    shutil.rmtree(directory, ignore_errors=True)
+
+def publish_version(version: int, directory: str, chunk_count: int):
+    """發布新版本（需持有 ingest_lock），並刪除超過保留數量與期限的舊版本"""
+    db = SessionLocal()
+    try:
+        db.add(IndexVersion(version=version, directory=directory, chunk_count=chunk_count, created_by=worker_id()))
+        db.commit()
+    finally:
+        db.close()
+    print(f"已發布索引版本 {version}：{chunk_count} 個文本塊")
+    retire_versions()
+
+def retire_versions():
+    """刪除較舊的版本目錄：保留最近 INDEX_KEEP_VERSIONS 個版本，其餘在被取代超過 INDEX_RETIRE_GRACE 秒後刪除"""
+    db = SessionLocal()
+    try:
+        rows = db.query(IndexVersion).order_by(IndexVersion.version.desc()).all()
+        # 版本被取代的時間即下一個版本的發布時間（created_at 為資料庫的 UTC 時間）
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=INDEX_RETIRE_GRACE)
+        for newer, row in zip(rows[INDEX_KEEP_VERSIONS - 1:], rows[INDEX_KEEP_VERSIONS:]):
+            if newer.created_at is None or newer.created_at > cutoff:
+                continue
+            shutil.rmtree(row.directory, ignore_errors=True)
+            db.delete(row)
+            print(f"已刪除舊的索引版本 {row.version}")
+        db.commit()
+    finally:
+        db.close()
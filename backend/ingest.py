@@ -0,0 +1,232 @@
+"""背景文件處理工作模組
+
+/upload 只把檔案串流寫入磁碟並建立工作後立即返回，
+由單一背景執行緒依序分割、嵌入並更新向量庫，前端透過 /upload/{job_id} 輪詢進度。
+"""
+import gzip
+import hashlib
+import os
+import queue
+import threading
+import time
+import uuid
+
+from backend.database import SessionLocal
+from backend.models import Document, IngestJob
+from backend.rag import process_and_store_chunks, text_splitter
+from backend.index_store import is_worker_alive
+from backend.text_splitter import FileChunks, read_text_blocks
+from backend.metrics import start_trace, span, log_if_slow
+
+# 上傳檔案暫存目錄
+UPLOAD_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "uploads")
+
+# 文件內容（UTF-8、gzip 壓縮）的存放目錄
+DOCUMENT_DIR = os.getenv(
+    "DOCUMENT_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "documents")
+)
+
+# 串流寫入上傳檔案時每次讀取的位元組數
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# 更新工作進度的最短間隔（秒），避免每批嵌入都寫入資料庫
+PROGRESS_UPDATE_INTERVAL = 0.5
+
+# 沒有對應工作記錄的上傳檔案（例如寫入檔案後、建立工作前中斷）保留的秒數
+ORPHAN_UPLOAD_AGE = 3600
+
+# 工作狀態
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+_job_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+def new_job_id() -> str:
+    """產生新的工作 ID"""
+    return uuid.uuid4().hex
+
+def job_file_path(job_id: str) -> str:
+    """工作對應的上傳檔案路徑"""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    return os.path.join(UPLOAD_DIR, f"{job_id}.txt")
+
+def enqueue_job(job_id: str):
+    """將工作加入佇列，必要時啟動背景執行緒"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_worker_loop, name="ingest-worker", daemon=True)
+            _worker.start()
+    _job_queue.put(job_id)
+
+def _worker_loop():
+    """依序處理佇列中的工作"""
+    while True:
+        job_id = _job_queue.get()
+        try:
+            run_job(job_id)
+        except Exception as e:
+            print(f"處理工作 {job_id} 時發生未預期的錯誤：{e}")
+        finally:
+            _job_queue.task_done()
+
+def document_body_name(filename: str) -> str:
+    """文件內容在 DOCUMENT_DIR 中的檔名（同名文件重新上傳時覆寫）"""
+    return hashlib.sha256(filename.encode("utf-8")).hexdigest()[:32] + ".txt.gz"
+
+def store_document_body(path: str, encoding: str, filename: str) -> dict:
+    """將上傳檔案以 UTF-8 重新編碼並 gzip 壓縮後存入 DOCUMENT_DIR，返回檔名、原始檔案的位元組數與 sha256"""
+    os.makedirs(DOCUMENT_DIR, exist_ok=True)
+    name = document_body_name(filename)
+    target = os.path.join(DOCUMENT_DIR, name)
+    temp_path = f"{target}.tmp"
+    with gzip.open(temp_path, "wt", encoding="utf-8") as out:
+        for block, _ in read_text_blocks(path, encoding):
+            out.write(block)
+    # 寫完後才取代舊的內容，處理中斷時不會留下不完整的檔案
+    os.replace(temp_path, target)
+
+    # 大小與上傳工作相同，以原始檔案的位元組數計算（Big5 與 UTF-8 的中文字元位元組數不同）
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(block)
+            size += len(block)
+    return {"body_path": name, "size": size, "content_hash": digest.hexdigest()}
+
+def remove_document_body(body_path: str):
+    """刪除文件內容檔案"""
+    path = os.path.join(DOCUMENT_DIR, body_path)
+    if os.path.exists(path):
+        os.remove(path)
+
+def _update_job(job_id: str, **fields):
+    """更新工作狀態"""
+    db = SessionLocal()
+    try:
+        db.query(IngestJob).filter(IngestJob.id == job_id).update(fields)
+        db.commit()
+    finally:
+        db.close()
+
+def run_job(job_id: str):
+    """處理一個上傳工作：分割、嵌入並更新向量庫，完成後記錄文件"""
+    db = SessionLocal()
+    try:
+        job = db.get(IngestJob, job_id)
+        if job is None:
+            print(f"找不到工作：{job_id}")
+            return
+        filename = job.filename
+    finally:
+        db.close()
+
+    path = job_file_path(job_id)
+    _update_job(job_id, status=JOB_RUNNING)
+    start = time.perf_counter()
+    trace = start_trace()
+
+    try:
+        # 逐段讀取並分割檔案，不將整份文件讀入記憶體
+        chunks = FileChunks(path, text_splitter)
+
+        last_update = [0.0]
+        def progress(processed: int, total: int):
+            now = time.monotonic()
+            if now - last_update[0] >= PROGRESS_UPDATE_INTERVAL:
+                last_update[0] = now
+                _update_job(job_id, chunks_processed=processed, chunks_total=total)
+
+        stats = process_and_store_chunks(chunks, filename, progress)
+        if chunks.replaced:
+            print(f"文件 {filename}（{chunks.encoding}）有 {chunks.replaced} 個無法解碼的字元，已以 U+FFFD 取代")
+
+        # 新增或更新同名文件，內容壓縮存放在磁碟上
+        with span("ingest", "store_body"):
+            body = store_document_body(path, chunks.encoding, filename)
+        db = SessionLocal()
+        try:
+            with span("db", "save_document"):
+                document = db.query(Document).filter(Document.filename == filename).one_or_none()
+                if document is None:
+                    document = Document(filename=filename)
+                    db.add(document)
+                document.content = ""
+                document.body_path = body["body_path"]
+                document.encoding = chunks.encoding
+                document.size = body["size"]
+                document.content_hash = body["content_hash"]
+                document.chunk_count = stats["chunks"]
+
+                # 舊版沒有檔名的文件已隨舊版文本塊一併從向量庫移除
+                db.query(Document).filter(Document.filename.is_(None)).delete()
+                db.commit()
+        finally:
+            db.close()
+
+        _update_job(
+            job_id,
+            status=JOB_SUCCEEDED,
+            chunks_total=stats["chunks"],
+            chunks_processed=stats["chunks"],
+            added=stats["added"],
+            deleted=stats["deleted"],
+            unchanged=stats["unchanged"],
+            chunks_per_sec=stats["chunks_per_sec"]
+        )
+        log_if_slow(f"處理文件 {filename}", trace, time.perf_counter() - start)
+    except Exception as e:
+        print(f"處理文件 {filename} 時發生錯誤：{e}")
+        _update_job(job_id, status=JOB_FAILED, error=str(e))
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+def recover_jobs():
+    """將已結束的 worker 留下的未完成工作標記為失敗，並清除殘留的上傳檔案
+
+    多個 worker 共用資料庫時，其他仍在執行的 worker 的工作與上傳檔案保持不變。
+    """
+    db = SessionLocal()
+    try:
+        unfinished = db.query(IngestJob).filter(IngestJob.status.in_([JOB_QUEUED, JOB_RUNNING])).all()
+        interrupted = [job.id for job in unfinished if not is_worker_alive(job.worker)]
+        if interrupted:
+            db.query(IngestJob).filter(IngestJob.id.in_(interrupted)).update(
+                {"status": JOB_FAILED, "error": "伺服器重新啟動，工作已中斷，請重新上傳"},
+                synchronize_session=False
+            )
+            db.commit()
+            print(f"已將 {len(interrupted)} 個未完成的工作標記為失敗")
+    finally:
+        db.close()
+
+    if os.path.exists(UPLOAD_DIR):
+        now = time.time()
+        for name in os.listdir(UPLOAD_DIR):
+            path = os.path.join(UPLOAD_DIR, name)
+            job_id = os.path.splitext(name)[0]
+            try:
+                if job_id not in interrupted and _is_upload_in_use(job_id, now - os.path.getmtime(path)):
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                # 其他 worker 已處理完並刪除
+                pass
+
+def _is_upload_in_use(job_id: str, age: float) -> bool:
+    """上傳檔案是否仍屬於其他 worker 尚未完成的工作（剛寫入、尚未建立工作記錄的檔案也保留）"""
+    db = SessionLocal()
+    try:
+        job = db.get(IngestJob, job_id)
+    finally:
+        db.close()
+    if job is None:
+        return age < ORPHAN_UPLOAD_AGE
+    return job.status in (JOB_QUEUED, JOB_RUNNING)
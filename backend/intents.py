@@ -0,0 +1,59 @@
+"""固定回覆的意圖模組
+
+問候、道謝、道別等不需要查詢客服資料的訊息，以固定的回覆直接回答，不檢索也不呼叫 LLM。
+只有整則訊息（去除前後的標點與空白、忽略大小寫）符合某個意圖時才使用固定回覆，
+「你好，請問運費怎麼算？」這類夾帶問題的訊息仍走一般的檢索與生成。
+「好」「ok」等附和的意思依對話而定（可能是在回答客服的追問），只在會話沒有先前對話時使用固定回覆。
+"""
+import re
+from typing import List, Optional, Tuple
+
+# 比對前去除的前後字元（標點、空白、常見的表情符號）
+_STRIP_CHARS = " \t\r\n?？!！。.,，~～、…:：;；😊🙂🙏👋"
+
+# (意圖名稱, 比對整則訊息的正規表示式, 回覆)
+INTENTS: List[Tuple[str, "re.Pattern", str]] = [
+    (
+        "greeting",
+        re.compile(r"(你好|您好|妳好|哈囉|嗨|hi|hello|hey|早安|午安|早|安安)(呀|啊|喔|哦|唷)?", re.IGNORECASE),
+        "您好！我是客服助手，請問有什麼可以為您服務的嗎？您可以詢問產品、退換貨、運費、付款方式或會員相關的問題。",
+    ),
+    (
+        "thanks",
+        re.compile(r"(謝謝|多謝|感謝|感恩|謝啦|thanks|thank you|thx)(你|您|妳)?(的幫忙|的協助)?(囉|喔|哦)?", re.IGNORECASE),
+        "不客氣！如果還有其他問題，隨時都可以詢問我。",
+    ),
+    (
+        "goodbye",
+        re.compile(r"(再見|掰掰|拜拜|bye|bye bye|goodbye)(囉|喔|哦)?", re.IGNORECASE),
+        "感謝您的詢問，祝您有美好的一天，再見！",
+    ),
+    (
+        "goodnight",
+        re.compile(r"晚安(囉|喔|哦|啦)?", re.IGNORECASE),
+        "晚安！感謝您的詢問，有任何問題歡迎隨時再來詢問。",
+    ),
+    (
+        "acknowledge",
+        re.compile(r"(好|好的|好喔|好哦|了解|瞭解|知道了|明白了|收到|ok|okay)", re.IGNORECASE),
+        "好的！還有其他需要協助的地方嗎？",
+    ),
+]
+
+# 只在會話沒有先前對話時使用固定回覆的意圖
+OPENING_ONLY_INTENTS = {"acknowledge"}
+
+def match_intent(message: str, in_conversation: bool = False) -> Optional[Tuple[str, str]]:
+    """訊息整則符合固定回覆的意圖時返回 (意圖名稱, 回覆)，否則返回 None
+
+    in_conversation 為 True（會話已有先前對話）時不比對 OPENING_ONLY_INTENTS 中的意圖。
+    """
+    text = message.strip(_STRIP_CHARS)
+    if not text:
+        return None
+    for name, pattern, reply in INTENTS:
+        if in_conversation and name in OPENING_ONLY_INTENTS:
+            continue
+        if pattern.fullmatch(text):
+            return name, reply
+    return None
@@ -0,0 +1,163 @@
+"""BM25 詞彙索引模組
+
+客服問題常包含必須精確比對的字詞（電話號碼、訂單用語、「7天」），純向量檢索容易漏掉。
+此模組在文件處理時為每個文本塊建立倒排索引：中日韓文字以相鄰兩字（bigram）為詞，
+英數字以連續的字元為詞，查詢時以 BM25 計分，再與向量檢索結果融合。
+"""
+import math
+import re
+import threading
+from collections import Counter
+from typing import Collection, Dict, List, Optional, Tuple
+
+# BM25 參數
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 中日韓文字逐字為一個單位，英數字以連續的字元為一個單位，其他字元（標點、空白）作為分隔
+_CJK = r"\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff"
+_UNIT_PATTERN = re.compile(rf"[{_CJK}]|[A-Za-z0-9]+|[^{_CJK}A-Za-z0-9]+")
+_CJK_PATTERN = re.compile(rf"[{_CJK}]")
+_ALNUM_PATTERN = re.compile(r"[A-Za-z0-9]+")
+
+def _is_cjk(unit: str) -> bool:
+    return bool(_CJK_PATTERN.fullmatch(unit))
+
+def tokenize(text: str) -> List[str]:
+    """將文字切成索引詞
+
+    英數字整段作為一個詞（小寫）；相鄰單位中只要有中日韓文字就組成 bigram，
+    因此「退貨條件」得到「退貨」「貨條」「條件」，「7天」得到「7」「7天」；
+    單獨一個中日韓字時保留單字。
+    """
+    tokens = []
+    run = []
+
+    def flush():
+        if len(run) == 1 and _is_cjk(run[0]):
+            tokens.append(run[0])
+        for left, right in zip(run, run[1:]):
+            if _is_cjk(left) or _is_cjk(right):
+                tokens.append(left + right)
+        run.clear()
+
+    for unit in _UNIT_PATTERN.findall(text.lower()):
+        if _ALNUM_PATTERN.fullmatch(unit):
+            tokens.append(unit)
+            run.append(unit)
+        elif _is_cjk(unit):
+            run.append(unit)
+        else:
+            flush()
+    flush()
+    return tokens
+
+class LexicalIndex:
+    """記憶體中的 BM25 倒排索引，支援逐一新增與刪除文本塊"""
+
+    def __init__(self):
+        # 詞 -> {文本塊 ID: 詞頻}
+        self._postings: Dict[str, Dict[str, int]] = {}
+        # 文本塊 ID -> (詞數, 內容, metadata)
+        self._chunks: Dict[str, Tuple[int, str, dict]] = {}
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def add(self, chunk_id: str, text: str, metadata: Optional[dict] = None):
+        """加入或取代一個文本塊"""
+        term_counts = Counter(tokenize(text))
+        with self._lock:
+            self._remove(chunk_id)
+            for term, count in term_counts.items():
+                self._postings.setdefault(term, {})[chunk_id] = count
+            length = sum(term_counts.values())
+            self._chunks[chunk_id] = (length, text, metadata or {})
+            self._total_length += length
+
+    def update_metadata(self, chunk_id: str, metadata: dict):
+        """只更新文本塊的 metadata（內容不變時不需重新分詞）"""
+        with self._lock:
+            if chunk_id in self._chunks:
+                length, text, _ = self._chunks[chunk_id]
+                self._chunks[chunk_id] = (length, text, metadata)
+
+    def remove(self, chunk_id: str):
+        """刪除一個文本塊"""
+        with self._lock:
+            self._remove(chunk_id)
+
+    def _remove(self, chunk_id: str):
+        entry = self._chunks.pop(chunk_id, None)
+        if entry is None:
+            return
+        self._total_length -= entry[0]
+        for term in set(tokenize(entry[1])):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self._postings[term]
+
+    def clear(self):
+        """清空索引"""
+        with self._lock:
+            self._postings.clear()
+            self._chunks.clear()
+            self._total_length = 0
+
+    def copy(self) -> "LexicalIndex":
+        """複製索引（修改副本不影響原索引，不需重新分詞）"""
+        index = LexicalIndex()
+        with self._lock:
+            index._postings = {term: dict(postings) for term, postings in self._postings.items()}
+            index._chunks = dict(self._chunks)
+            index._total_length = self._total_length
+        return index
+
+    def get(self, chunk_id: str) -> Optional[Tuple[str, dict]]:
+        """取得文本塊的 (內容, metadata)"""
+        entry = self._chunks.get(chunk_id)
+        return (entry[1], entry[2]) if entry is not None else None
+
+    def search(self, query: str, k: int, exclude: Collection[str] = frozenset()) -> Tuple[List[Tuple[str, float]], float]:
+        """以 BM25 搜尋，返回 ([(文本塊 ID, 分數)], 信心度)；exclude 中的文本塊不列入結果
+
+        信心度為第一名文本塊涵蓋的查詢詞 IDF 佔全部查詢詞 IDF 的比例：
+        查詢中的每個詞都出現在第一名文本塊時為 1.0。
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        with self._lock:
+            total = len(self._chunks)
+            if not terms or not total:
+                return [], 0.0
+            avg_length = self._total_length / total
+
+            scores: Dict[str, float] = {}
+            matched: Dict[str, float] = {}
+            idf_sum = 0.0
+            for term in terms:
+                postings = self._postings.get(term, {})
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                idf_sum += idf
+                for chunk_id, tf in postings.items():
+                    length = self._chunks[chunk_id][0]
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+                    matched[chunk_id] = matched.get(chunk_id, 0.0) + idf
+
+        ranked = sorted(
+            (item for item in scores.items() if item[0] not in exclude), key=lambda item: item[1], reverse=True
+        )[:k]
+        confidence = matched[ranked[0][0]] / idf_sum if ranked and idf_sum > 0 else 0.0
+        return ranked, confidence
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[str]:
+    """以倒數排名融合（RRF）合併多個排序結果，返回依融合分數排序的 ID"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking, start=1):
+            scores[id_] = scores.get(id_, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)
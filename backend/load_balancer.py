@@ -0,0 +1,232 @@
+"""Ollama 多節點負載平衡模組
+
+單一 Ollama 伺服器是吞吐量的上限，也是單點故障。此模組將請求分散到多個 Ollama 節點：
+1. 每個節點有自己的 HTTP 連線池
+2. 選擇進行中請求最少的健康節點（平手時輪替）
+3. 連線失敗或節點返回 5xx（請求未被處理）時改送下一個節點
+4. 連續失敗的節點暫停使用，由定期的健康檢查（GET /api/tags）確認恢復後重新加入
+"""
+import asyncio
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, TypeVar
+import httpx
+
+# 健康檢查間隔與逾時（秒）：回應超過逾時的節點視為失敗（過慢）
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+OLLAMA_PROBE_TIMEOUT = float(os.getenv("OLLAMA_PROBE_TIMEOUT", "5"))
+
+# 連續失敗（請求或健康檢查）達此次數時暫停使用節點
+OLLAMA_MAX_FAILURES = int(os.getenv("OLLAMA_MAX_FAILURES", "3"))
+
+# 請求延遲的指數移動平均權重
+_LATENCY_ALPHA = 0.2
+
+T = TypeVar("T")
+
+class NodeUnavailableError(ValueError):
+    """節點返回 5xx（過載或故障），請求可改送其他節點"""
+
+# 可以改送其他節點的錯誤
+_RETRYABLE_ERRORS = (httpx.ConnectError, NodeUnavailableError)
+
+class OllamaNode:
+    """一個 Ollama 節點：連線池、進行中的請求數與健康狀態"""
+
+    def __init__(self, url: str, timeout: float, max_connections: int):
+        self.url = url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.healthy = True
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.requests = 0
+        self.failures = 0
+        self.latency: Optional[float] = None
+        self.probe_latency: Optional[float] = None
+        self._http_client: Optional[httpx.Client] = None
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections
+        )
+
+    def http_client(self) -> httpx.Client:
+        """此節點的同步 HTTP 客戶端（執行緒安全，供文件嵌入的工作執行緒共用）"""
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.Client(
+                base_url=self.url,
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+                limits=self._limits()
+            )
+        return self._http_client
+
+    def async_client(self) -> httpx.AsyncClient:
+        """此節點的非同步 HTTP 客戶端"""
+        if self._async_client is None or self._async_client.is_closed:
+            self._async_client = httpx.AsyncClient(
+                base_url=self.url,
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+                limits=self._limits()
+            )
+        return self._async_client
+
+    async def aclose(self):
+        """關閉此節點的連線池"""
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+        if self._http_client is not None:
+            self._http_client.close()
+            self._http_client = None
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "avg_latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "probe_latency_ms": round(self.probe_latency * 1000, 1) if self.probe_latency is not None else None,
+        }
+
+class OllamaBalancer:
+    """在多個節點間以最少進行中請求分配請求（節點可與其他 OllamaBalancer 共用）"""
+
+    def __init__(self, nodes: List[OllamaNode], lock: threading.Lock):
+        self.nodes = nodes
+        self._lock = lock
+        self._next = 0
+
+    def _acquire(self, exclude: List[OllamaNode]) -> OllamaNode:
+        with self._lock:
+            # 沒有健康的節點時仍嘗試其他節點，不直接失敗
+            candidates = (
+                [node for node in self.nodes if node.healthy and node not in exclude]
+                or [node for node in self.nodes if node not in exclude]
+                or self.nodes
+            )
+            start = self._next % len(candidates)
+            self._next += 1
+            node = min(candidates[start:] + candidates[:start], key=lambda node: node.outstanding)
+            node.outstanding += 1
+            node.requests += 1
+            return node
+
+    def _release(self, node: OllamaNode, ok: Optional[bool], elapsed: float):
+        with self._lock:
+            node.outstanding -= 1
+            if ok:
+                node.consecutive_failures = 0
+                if node.latency is None:
+                    node.latency = elapsed
+                else:
+                    node.latency += _LATENCY_ALPHA * (elapsed - node.latency)
+            elif ok is not None:
+                node.failures += 1
+                _record_failure(node)
+
+    @contextmanager
+    def request(self, exclude: List[OllamaNode] = ()):
+        """選出節點並追蹤請求：區塊內拋出例外時記為失敗（取消或中斷連線不計）"""
+        node = self._acquire(list(exclude))
+        start = time.monotonic()
+        try:
+            yield node
+        except Exception:
+            self._release(node, False, time.monotonic() - start)
+            raise
+        except BaseException:
+            self._release(node, None, time.monotonic() - start)
+            raise
+        else:
+            self._release(node, True, time.monotonic() - start)
+
+    def call(self, fn: Callable[[OllamaNode], T]) -> T:
+        """以選出的節點呼叫 fn(node)，連線失敗或節點不可用時改用下一個節點"""
+        tried = []
+        while True:
+            try:
+                with self.request(tried) as node:
+                    return fn(node)
+            except _RETRYABLE_ERRORS:
+                tried.append(node)
+                if len(tried) >= len(self.nodes):
+                    raise
+
+    async def acall(self, fn: Callable[[OllamaNode], Awaitable[T]]) -> T:
+        """非同步版本的 call"""
+        tried = []
+        while True:
+            try:
+                with self.request(tried) as node:
+                    return await fn(node)
+            except _RETRYABLE_ERRORS:
+                tried.append(node)
+                if len(tried) >= len(self.nodes):
+                    raise
+
+    def stats(self) -> List[dict]:
+        return [node.stats() for node in self.nodes]
+
+def _record_failure(node: OllamaNode):
+    """累計連續失敗次數，達上限時暫停使用節點（呼叫端需持有鎖）"""
+    node.consecutive_failures += 1
+    if node.healthy and node.consecutive_failures >= OLLAMA_MAX_FAILURES:
+        node.healthy = False
+        print(f"Ollama 節點 {node.url} 連續失敗 {node.consecutive_failures} 次，暫停使用")
+
+class OllamaCluster:
+    """依 URL 共用節點的節點集合：同一節點同時用於嵌入與生成時，進行中的請求合併計算"""
+
+    def __init__(self, timeout: float, max_connections: int):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.nodes: Dict[str, OllamaNode] = {}
+        self._lock = threading.Lock()
+
+    def balancer(self, urls: List[str]) -> OllamaBalancer:
+        """建立分配到指定節點的 OllamaBalancer"""
+        nodes = []
+        for url in urls:
+            if url not in self.nodes:
+                self.nodes[url] = OllamaNode(url, self.timeout, self.max_connections)
+            nodes.append(self.nodes[url])
+        return OllamaBalancer(nodes, self._lock)
+
+    async def probe(self, node: OllamaNode):
+        """健康檢查一個節點：成功時恢復暫停的節點，失敗或逾時時累計失敗次數"""
+        start = time.monotonic()
+        try:
+            response = await node.async_client().get("/api/tags", timeout=OLLAMA_PROBE_TIMEOUT)
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        elapsed = time.monotonic() - start
+        with self._lock:
+            node.probe_latency = elapsed
+            if not ok:
+                _record_failure(node)
+            elif not node.healthy:
+                node.healthy = True
+                node.consecutive_failures = 0
+                print(f"Ollama 節點 {node.url} 已恢復，重新加入")
+            else:
+                node.consecutive_failures = 0
+
+    async def run_health_checks(self, interval: float = OLLAMA_HEALTH_INTERVAL):
+        """定期檢查所有節點（在背景 task 中執行直到被取消）"""
+        while True:
+            await asyncio.gather(*(self.probe(node) for node in list(self.nodes.values())))
+            await asyncio.sleep(interval)
+
+    async def aclose(self):
+        """關閉所有節點的連線池"""
+        for node in self.nodes.values():
+            await node.aclose()
@@ -5,21 +5,75 @@ import os
 os.environ["ANONYMIZED_TELEMETRY"] = "False"
 os.environ["CHROMA_SERVER_NOFILE"] = "0"
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from sqlalchemy import select, delete, func, literal, or_, and_, cast, LargeBinary, Text
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import BaseModel, Field
+from typing import List, Optional, Tuple
+from contextlib import asynccontextmanager
 from datetime import datetime
 import uuid
+import json
+import base64
+import asyncio
+import time
 
-from backend.database import get_db, init_db
-from backend.models import Document, ChatHistory
-from backend.rag import process_and_store_document, query_rag, initialize_vectorstore
+from backend.database import get_async_db, init_db, AsyncSessionLocal, async_engine
+from backend.history_writer import history_writer
+from backend.models import Document, ChatHistory, IngestJob
+from backend.ingest import (
+    new_job_id, job_file_path, enqueue_job, recover_jobs, remove_document_body, UPLOAD_CHUNK_SIZE, JOB_QUEUED
+)
+from backend.rag import (
+    delete_document_chunks, aquery_rag, astream_rag, answer_cache, watch_shared_index, early_exit_stats,
+    CONVERSATION_TURNS
+)
+from backend.index_store import SHARED_INDEX, worker_id
+from backend.batch import parse_questions, aanswer_batch, default_concurrency, BATCH_MAX_QUESTIONS
+from backend.ollama_client import (
+    close_async_client, start_health_checks, embedding_cache, generation_scheduler, embed_batcher,
+    embed_balancer, generate_balancer
+)
+from backend.scheduler import OllamaBusyError
+from backend.metrics import (
+    MetricsMiddleware, StatsCollector, register_stats_collector, latest_metrics, CONTENT_TYPE_LATEST,
+    start_trace, span, server_timing, log_if_slow
+)
+from backend.warmup import (
+    STARTUP_WARMUP, WARMUP_PING_INTERVAL, mark_database_ready, start_warmup, start_keep_warm, readiness
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """啟動時初始化資料庫並在背景開始健康檢查與預熱，關閉時停止背景 task 並關閉連線池"""
+    # 初始化資料庫；上次執行時未完成的上傳工作無法繼續，標記為失敗
+    await asyncio.to_thread(init_db)
+    await asyncio.to_thread(recover_jobs)
+    mark_database_ready()
+    # 聊天歷史由背景 task 批次寫入
+    history_writer.start()
+
+    # 向量庫與模型在背景載入，不延遲行程開始回應
+    background_tasks = [start_health_checks()]
+    if STARTUP_WARMUP:
+        background_tasks.append(start_warmup())
+    if WARMUP_PING_INTERVAL > 0:
+        background_tasks.append(start_keep_warm())
+    # 多個 worker 共用索引時，定期切換到其他 worker 發布的新版本
+    if SHARED_INDEX:
+        background_tasks.append(asyncio.get_running_loop().create_task(watch_shared_index()))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    # 寫完尚未寫入的聊天歷史後再關閉資料庫連線池
+    await history_writer.close()
+    await async_engine.dispose()
+    await close_async_client()
 
 # 初始化 FastAPI 應用
-app = FastAPI(title="客服聊天機器人 API")
+app = FastAPI(title="客服聊天機器人 API", lifespan=lifespan)
 
 # CORS 配置
 app.add_middleware(
@@ -28,24 +82,30 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 讓瀏覽器的開發者工具可以讀取各階段耗時
+    expose_headers=["Server-Timing", "Retry-After"],
 )
 
-# 初始化資料庫
-init_db()
-
-# 不在此處初始化向量庫，改為懶加載（在需要時才載入）
-# initialize_vectorstore()
+# 記錄每個 HTTP 請求的耗時
+app.add_middleware(MetricsMiddleware)
 
-# 全局變數存儲當前 session_id
-current_session_id = str(uuid.uuid4())
+# 聊天歷史分頁大小（預設與上限）及 NDJSON 匯出時每批讀取的筆數
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "500"))
+HISTORY_EXPORT_BATCH_SIZE = int(os.getenv("HISTORY_EXPORT_BATCH_SIZE", "1000"))
 
 # Pydantic 模型
 class ChatMessage(BaseModel):
     message: str
+    session_id: Optional[str] = Field(None, max_length=64)
 
 class ChatResponse(BaseModel):
     response: str
     timestamp: str
+    session_id: str
+
+class SessionResponse(BaseModel):
+    session_id: str
 
 class HistoryItem(BaseModel):
     id: int
@@ -56,114 +116,433 @@ class HistoryItem(BaseModel):
 
 class HistoryResponse(BaseModel):
     history: List[HistoryItem]
+    next_cursor: Optional[str] = None
+
+class DocumentItem(BaseModel):
+    id: int
+    filename: Optional[str]
+    size: int
+    chunk_count: int
+    upload_time: str
+    updated_time: str
+
+class DocumentListResponse(BaseModel):
+    documents: List[DocumentItem]
+
+class UploadJobResponse(BaseModel):
+    job_id: str
+    filename: str
+    status: str
+    size: int
+    chunks_total: int
+    chunks_processed: int
+    progress: float
+    added: int
+    deleted: int
+    unchanged: int
+    chunks_per_sec: float
+    error: Optional[str]
+    created_at: str
+    updated_at: str
 
 @app.get("/")
 async def root():
-    """根路徑"""
+    """根路徑（行程已啟動即可回應）"""
     return {"message": "客服聊天機器人 API", "status": "running"}
 
-@app.post("/upload")
-async def upload_file(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    """上傳文件"""
+@app.get("/ready")
+async def ready():
+    """就緒檢查：資料庫已初始化、向量庫已載入且模型已預熱時返回 200，否則返回 503"""
+    status = readiness()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+@app.post("/upload", status_code=202)
+async def upload_file(file: UploadFile = File(...), db: AsyncSession = Depends(get_async_db)):
+    """上傳文件（建立背景處理工作後立即返回工作 ID）"""
     # 檢查文件格式
     if not file.filename.endswith('.txt'):
         raise HTTPException(status_code=400, detail="只支援 .txt 格式的文件")
     
     try:
-        # 讀取文件內容
-        content = await file.read()
-        content_str = content.decode('utf-8')
-        
-        # 清空舊文件（SQLite）
-        db.query(Document).delete()
-        db.commit()
+        # 分段將上傳內容寫入磁碟，不一次讀入記憶體
+        job_id = new_job_id()
+        size = 0
+        with open(job_file_path(job_id), "wb") as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await asyncio.to_thread(out.write, chunk)
+                size += len(chunk)
         
-        # 儲存新文件到 SQLite
-        new_doc = Document(content=content_str)
-        db.add(new_doc)
-        db.commit()
-        
-        # 處理並儲存到向量庫
-        try:
-            process_and_store_document(content_str)
-        except Exception as e:
-            print(f"處理文件到向量庫時發生錯誤：{e}")
-            raise HTTPException(status_code=500, detail=f"處理文件到向量庫失敗：{str(e)}")
+        # 建立工作並交給背景執行緒處理
+        db.add(IngestJob(id=job_id, filename=file.filename, size=size, status=JOB_QUEUED, worker=worker_id()))
+        await db.commit()
+        enqueue_job(job_id)
         
         return {
-            "message": "文件上傳成功",
+            "message": "文件已上傳，正在背景處理",
+            "job_id": job_id,
             "filename": file.filename,
-            "size": len(content_str)
+            "size": size,
+            "status": JOB_QUEUED
         }
-    except HTTPException:
-        raise
     except Exception as e:
         print(f"文件上傳時發生未預期的錯誤：{e}")
         raise HTTPException(status_code=500, detail=f"文件上傳失敗：{str(e)}")
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat(message: ChatMessage, db: Session = Depends(get_db)):
-    """發送聊天訊息"""
-    global current_session_id
+@app.get("/upload/{job_id}", response_model=UploadJobResponse)
+async def get_upload_job(job_id: str, db: AsyncSession = Depends(get_async_db)):
+    """查詢文件處理工作的進度"""
+    job = await db.get(IngestJob, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="找不到指定的上傳工作")
     
+    return UploadJobResponse(
+        job_id=job.id,
+        filename=job.filename,
+        status=job.status,
+        size=job.size or 0,
+        chunks_total=job.chunks_total or 0,
+        chunks_processed=job.chunks_processed or 0,
+        progress=round(job.chunks_processed / job.chunks_total, 4) if job.chunks_total else 0.0,
+        added=job.added or 0,
+        deleted=job.deleted or 0,
+        unchanged=job.unchanged or 0,
+        chunks_per_sec=job.chunks_per_sec or 0.0,
+        error=job.error,
+        created_at=job.created_at.isoformat() if job.created_at else "",
+        updated_at=job.updated_at.isoformat() if job.updated_at else ""
+    )
+
+@app.get("/documents", response_model=DocumentListResponse)
+async def list_documents(db: AsyncSession = Depends(get_async_db)):
+    """列出已上傳的文件"""
+    try:
+        result = await db.execute(
+            select(
+                # 舊版記錄沒有 size，以內容的 UTF-8 位元組數代替（轉為 BLOB 後 length 返回位元組數）
+                Document.id, Document.filename,
+                func.coalesce(Document.size, func.length(cast(Document.content, LargeBinary))),
+                Document.chunk_count, Document.upload_time, Document.updated_time
+            ).order_by(Document.id.asc())
+        )
+        documents = [
+            DocumentItem(
+                id=row[0],
+                filename=row[1],
+                size=row[2] or 0,
+                chunk_count=row[3] or 0,
+                upload_time=row[4].isoformat() if row[4] else "",
+                updated_time=row[5].isoformat() if row[5] else ""
+            )
+            for row in result.all()
+        ]
+        return DocumentListResponse(documents=documents)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"獲取文件列表時發生錯誤：{str(e)}")
+
+@app.delete("/documents/{document_id}")
+async def delete_document(document_id: int, db: AsyncSession = Depends(get_async_db)):
+    """刪除文件及其在向量庫中的文本塊"""
+    document = await db.get(Document, document_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail="找不到指定的文件")
+    
+    try:
+        deleted = 0
+        if document.filename:
+            deleted = await asyncio.to_thread(delete_document_chunks, document.filename)
+        body_path = document.body_path
+        await db.delete(document)
+        await db.commit()
+        if body_path:
+            await asyncio.to_thread(remove_document_body, body_path)
+        return {"message": "文件已刪除", "filename": document.filename, "deleted": deleted}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"刪除文件時發生錯誤：{str(e)}")
+
+def new_session_id() -> str:
+    """產生新的會話 ID"""
+    return str(uuid.uuid4())
+
+async def load_recent_turns(db: AsyncSession, session_id: str) -> List[Tuple[str, str]]:
+    """讀取會話最近的對話輪次（由舊到新），供對話感知檢索使用"""
+    if CONVERSATION_TURNS <= 0:
+        return []
+    # 尚在寫入佇列中的對話比資料庫中的都新。需在讀取資料庫之前取得（之後才取得會漏掉讀取期間寫入的批次），
+    # 讀取期間寫入的批次因此可能同時出現在兩邊，以 (用戶訊息, 回答, 時間戳記) 去除重複
+    pending = history_writer.pending_turns(session_id)[-CONVERSATION_TURNS:]
+    if len(pending) < CONVERSATION_TURNS:
+        with span("db", "load_history"):
+            result = await db.execute(
+                select(ChatHistory.user_message, ChatHistory.bot_response, ChatHistory.timestamp)
+                .where(ChatHistory.session_id == session_id)
+                .order_by(ChatHistory.timestamp.desc(), ChatHistory.id.desc())
+                .limit(CONVERSATION_TURNS)
+            )
+        stored = [tuple(row) for row in reversed(result.all())]
+        written = set(stored)
+        pending = (stored + [turn for turn in pending if turn not in written])[-CONVERSATION_TURNS:]
+    return [(user_message, bot_response) for user_message, bot_response, _ in pending]
+
+@app.post("/session", response_model=SessionResponse)
+async def create_session():
+    """建立新的會話，返回會話 ID"""
+    return SessionResponse(session_id=new_session_id())
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat(message: ChatMessage, response: Response, db: AsyncSession = Depends(get_async_db)):
+    """發送聊天訊息（Server-Timing 標頭為此請求各階段的耗時）"""
     if not message.message or not message.message.strip():
         raise HTTPException(status_code=400, detail="訊息不能為空")
     
+    # 未提供會話 ID 時發放新的會話
+    session_id = message.session_id or new_session_id()
+    start = time.perf_counter()
+    trace = start_trace()
+    
     try:
-        # 使用 RAG 查詢回答
-        bot_response = query_rag(message.message.strip())
+        # 使用 RAG 查詢回答，參考同一會話先前的對話
+        history = await load_recent_turns(db, session_id)
+        bot_response = await aquery_rag(message.message.strip(), history, session_id)
         
-        # 儲存對話歷史
-        chat_record = ChatHistory(
-            user_message=message.message.strip(),
-            bot_response=bot_response,
-            session_id=current_session_id
-        )
-        db.add(chat_record)
-        db.commit()
+        # 儲存對話歷史（放入寫入佇列，由背景 task 批次寫入）
+        with span("db", "save_history"):
+            await history_writer.add(message.message.strip(), bot_response, session_id)
         
+        response.headers["Server-Timing"] = server_timing(trace)
+        log_if_slow("/chat", trace, time.perf_counter() - start)
         return ChatResponse(
             response=bot_response,
-            timestamp=datetime.now().isoformat()
+            timestamp=datetime.now().isoformat(),
+            session_id=session_id
         )
+    except OllamaBusyError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"處理訊息時發生錯誤：{str(e)}")
 
-@app.get("/history", response_model=HistoryResponse)
-async def get_history(db: Session = Depends(get_db)):
-    """獲取聊天歷史"""
-    try:
-        history_records = db.query(ChatHistory).order_by(ChatHistory.timestamp.asc()).all()
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    """格式化一則 Server-Sent Event"""
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream(message: ChatMessage, db: AsyncSession = Depends(get_async_db)):
+    """發送聊天訊息（以 SSE 串流回答）"""
+    if not message.message or not message.message.strip():
+        raise HTTPException(status_code=400, detail="訊息不能為空")
+    
+    user_message = message.message.strip()
+    session_id = message.session_id or new_session_id()
+    start = time.perf_counter()
+    trace = start_trace()
+    history = await load_recent_turns(db, session_id)
+    
+    # 取得第一段回答後才開始回應：Ollama 忙碌時仍能以 HTTP 429 回覆
+    stream = astream_rag(user_message, history, session_id)
+    first_token = await anext(stream, None)
+    # 標頭只能包含到第一段回答為止的階段，完整的耗時記錄在 /metrics 與慢請求的日誌
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Server-Timing": server_timing(trace)}
+    
+    async def event_stream():
+        tokens = []
+        if first_token is not None:
+            tokens.append(first_token)
+            yield sse_event({"token": first_token})
+        try:
+            async for token in stream:
+                tokens.append(token)
+                yield sse_event({"token": token})
+        except Exception as e:
+            # 回應已開始，無法再改為錯誤狀態碼：以 error 事件通知前端回答不完整，保存已產生的部分
+            print(f"串流回答時發生錯誤：{e}")
+            yield sse_event({"detail": f"生成回答時發生錯誤：{e}"}, event="error")
         
-        history_items = [
-            HistoryItem(
-                id=record.id,
-                timestamp=record.timestamp.isoformat() if record.timestamp else "",
-                user_message=record.user_message,
-                bot_response=record.bot_response,
-                session_id=record.session_id
-            )
-            for record in history_records
-        ]
+        bot_response = "".join(tokens) or "抱歉，我無法生成回答。"
+        
+        # 串流結束後才儲存完整的對話歷史（放入寫入佇列，由背景 task 批次寫入）
+        with span("db", "save_history"):
+            await history_writer.add(user_message, bot_response, session_id)
         
-        return HistoryResponse(history=history_items)
+        yield sse_event(
+            {"response": bot_response, "timestamp": datetime.now().isoformat(), "session_id": session_id},
+            event="done"
+        )
+        log_if_slow("/chat/stream", trace, time.perf_counter() - start)
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=headers)
+
+@app.post("/chat/batch")
+async def chat_batch(request: Request, concurrency: Optional[int] = Query(None, ge=1)):
+    """批次回答問題（請求內容為 JSONL，每行一題），依完成順序以 NDJSON 串流返回每題的回答與延遲"""
+    try:
+        text = (await request.body()).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="請求內容必須是 UTF-8 編碼的 JSONL")
+    items, errors = parse_questions(text.splitlines())
+    if not items and not errors:
+        raise HTTPException(status_code=400, detail="沒有任何問題")
+    if len(items) + len(errors) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"每批最多 {BATCH_MAX_QUESTIONS} 個問題")
+    
+    # 並發數超過生成排程的上限只會在佇列中等待，不會更快
+    concurrency = min(concurrency or default_concurrency(), generation_scheduler.max_concurrency)
+    
+    async def results():
+        for item in errors:
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+        async for item in aanswer_batch(items, concurrency):
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+def encode_history_cursor(record: ChatHistory) -> str:
+    """將記錄的 (timestamp, id) 編碼為分頁游標"""
+    # 與 SQLite 儲存的文字格式一致，才能直接以字串比較並使用索引
+    timestamp = record.timestamp.strftime("%Y-%m-%d %H:%M:%S")
+    if record.timestamp.microsecond:
+        timestamp += f".{record.timestamp.microsecond:06d}"
+    raw = f"{timestamp}|{record.id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_history_cursor(cursor: str):
+    """解析分頁游標，返回 (timestamp 文字, id)"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        timestamp, record_id = raw.rsplit("|", 1)
+        return timestamp, int(record_id)
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="無效的分頁游標")
+
+def history_item(record: ChatHistory) -> dict:
+    """將聊天記錄轉為回應格式"""
+    return {
+        "id": record.id,
+        "timestamp": record.timestamp.isoformat() if record.timestamp else "",
+        "user_message": record.user_message,
+        "bot_response": record.bot_response,
+        "session_id": record.session_id
+    }
+
+async def export_history_ndjson(session_id: Optional[str]):
+    """以 NDJSON 逐行串流匯出全部聊天歷史"""
+    # 串流期間依賴注入的 session 已關閉，需自行建立
+    async with AsyncSessionLocal() as db:
+        stmt = select(ChatHistory).order_by(ChatHistory.timestamp.asc(), ChatHistory.id.asc())
+        if session_id:
+            stmt = stmt.where(ChatHistory.session_id == session_id)
+        result = await db.stream(stmt.execution_options(yield_per=HISTORY_EXPORT_BATCH_SIZE))
+        async for partition in result.scalars().partitions():
+            yield "".join(json.dumps(history_item(record), ensure_ascii=False) + "\n" for record in partition)
+
+@app.get("/history", response_model=HistoryResponse)
+async def get_history(
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    session_id: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """獲取聊天歷史（由新到舊分頁，或以 NDJSON 串流匯出全部）"""
+    if format == "ndjson":
+        return StreamingResponse(
+            export_history_ndjson(session_id),
+            media_type="application/x-ndjson",
+            headers={"Content-Disposition": "attachment; filename=chat_history.ndjson"}
+        )
+
+    try:
+        stmt = select(ChatHistory)
+        if session_id:
+            stmt = stmt.where(ChatHistory.session_id == session_id)
+        if cursor:
+            cursor_timestamp, cursor_id = decode_history_cursor(cursor)
+            timestamp = literal(cursor_timestamp, Text)
+            stmt = stmt.where(or_(
+                ChatHistory.timestamp < timestamp,
+                and_(ChatHistory.timestamp == timestamp, ChatHistory.id < cursor_id)
+            ))
+        # 多取一筆以判斷是否還有更舊的記錄
+        stmt = stmt.order_by(ChatHistory.timestamp.desc(), ChatHistory.id.desc()).limit(limit + 1)
+        result = await db.execute(stmt)
+        history_records = result.scalars().all()
+
+        next_cursor = None
+        if len(history_records) > limit:
+            history_records = history_records[:limit]
+            next_cursor = encode_history_cursor(history_records[-1])
+
+        # 頁內仍依時間由舊到新排列，方便前端直接顯示
+        history_items = [HistoryItem(**history_item(record)) for record in reversed(history_records)]
+
+        return HistoryResponse(history=history_items, next_cursor=next_cursor)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"獲取歷史記錄時發生錯誤：{str(e)}")
 
 @app.delete("/history")
-async def clear_history(db: Session = Depends(get_db)):
-    """清除聊天歷史"""
+async def clear_history(session_id: str = Query(..., max_length=64), db: AsyncSession = Depends(get_async_db)):
+    """清除指定會話的聊天歷史"""
     try:
-        db.query(ChatHistory).delete()
-        db.commit()
+        # 先寫入佇列中的對話，避免刪除後才被寫入
+        if not await history_writer.flush():
+            raise HTTPException(status_code=503, detail="聊天歷史尚未寫入完成，請稍後再試")
+        result = await db.execute(delete(ChatHistory).where(ChatHistory.session_id == session_id))
+        await db.commit()
         
-        global current_session_id
-        current_session_id = str(uuid.uuid4())
-        
-        return {"message": "聊天歷史已清除"}
+        return {"message": "聊天歷史已清除", "deleted": result.rowcount}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"清除歷史記錄時發生錯誤：{str(e)}")
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """獲取答案快取與嵌入向量快取的命中統計，以及未呼叫 LLM 即回覆（固定回覆、沒有相關內容）的問題數"""
+    return {
+        "answer_cache": answer_cache.stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "early_exit": early_exit_stats()
+    }
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    """獲取 Ollama 請求排程的佇列深度、排隊等待時間、嵌入批次統計、聊天歷史寫入佇列與各節點狀態"""
+    return {
+        "generation": generation_scheduler.stats(),
+        "embedding_batches": embed_batcher.stats(),
+        "history_writes": history_writer.stats(),
+        "nodes": {
+            "embed": embed_balancer.stats(),
+            "generate": generate_balancer.stats()
+        }
+    }
+
+# 在 /metrics 被抓取時讀取快取、生成佇列與 Ollama 節點的統計
+register_stats_collector(StatsCollector(
+    answer_cache, embedding_cache, generation_scheduler, embed_batcher,
+    {"embed": embed_balancer, "generate": generate_balancer}, history_writer
+))
+
+@app.get("/metrics")
+async def metrics():
+    """以 Prometheus 文字格式輸出指標"""
+    return Response(content=latest_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+@app.exception_handler(OllamaBusyError)
+async def ollama_busy_handler(request, exc):
+    """Ollama 忙碌時回覆 HTTP 429，以 Retry-After 告知建議的重試秒數"""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     """全局異常處理"""
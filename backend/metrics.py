@@ -0,0 +1,206 @@
+"""Prometheus 指標與各階段耗時模組
+
+/chat 變慢時需要知道是嵌入、檢索、prompt 組裝、LLM 生成還是 SQLite 寫入造成的。
+以 span(pipeline, stage) 包住每個階段：耗時記錄到 qabot_stage_seconds 直方圖，
+同時累計到目前請求的 trace，API 以 Server-Timing 標頭返回該請求的各階段耗時。
+快取、生成佇列與 Ollama 節點的既有統計在 /metrics 被抓取時才讀取（StatsCollector）。
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Optional
+
+from prometheus_client import Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# 請求總耗時超過此秒數時印出各階段耗時（設為 0 可停用）
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "10"))
+
+# 秒數直方圖的區間：涵蓋毫秒級的索引查詢到 CPU 上數十秒的生成
+_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+STAGE_SECONDS = Histogram(
+    "qabot_stage_seconds", "RAG 流程各階段耗時（秒）",
+    ["pipeline", "stage"], buckets=_SECONDS_BUCKETS
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "qabot_http_request_duration_seconds", "HTTP 請求耗時（秒，串流回應計算到最後一段送出）",
+    ["method", "route", "status"], buckets=_SECONDS_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "qabot_time_to_first_token_seconds", "從收到問題到生成第一個 token 的時間（秒，不含快取命中）",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+)
+# 生成的 token 總數可由 qabot_generated_tokens_sum 取得
+GENERATED_TOKENS = Histogram(
+    "qabot_generated_tokens", "每個回答生成的 token 數",
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048)
+)
+PROMPT_TOKENS = Histogram(
+    "qabot_prompt_tokens", "每次生成的 prompt token 數",
+    buckets=(128, 256, 512, 1024, 2048, 4096, 8192)
+)
+TOKENS_PER_SECOND = Histogram(
+    "qabot_generation_tokens_per_second", "生成速度（token/秒，以 Ollama 回報的 eval_duration 計算）",
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 100, 200)
+)
+ANSWERS_TOTAL = Counter("qabot_answers", "回答的來源", ["source"])
+RETRIEVALS_TOTAL = Counter("qabot_retrievals", "檢索路徑（lexical：BM25 快速路徑，hybrid：向量與 BM25 融合）", ["path"])
+
+# 目前請求的各階段耗時（秒），由 start_trace() 建立
+_current_trace: ContextVar[Optional[Dict[str, float]]] = ContextVar("qabot_trace", default=None)
+
+def start_trace() -> Dict[str, float]:
+    """為目前的請求建立 trace，之後同一 context（含 asyncio.to_thread）中的 span 都會記錄於此"""
+    trace: Dict[str, float] = {}
+    _current_trace.set(trace)
+    return trace
+
+def _add_to_trace(stage: str, seconds: float):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace[stage] = trace.get(stage, 0.0) + seconds
+
+def record_stage(pipeline: str, stage: str, seconds: float):
+    """記錄一個階段的耗時"""
+    STAGE_SECONDS.labels(pipeline, stage).observe(seconds)
+    _add_to_trace(stage, seconds)
+
+def record_ttft(seconds: float):
+    """記錄首個 token 的時間（與各階段重疊，因此不計入 qabot_stage_seconds）"""
+    TIME_TO_FIRST_TOKEN.observe(seconds)
+    _add_to_trace("ttft", seconds)
+
+@contextmanager
+def span(pipeline: str, stage: str):
+    """記錄區塊的耗時（拋出例外時也記錄）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(pipeline, stage, time.perf_counter() - start)
+
+def server_timing(trace: Dict[str, float]) -> str:
+    """將 trace 格式化為 Server-Timing 標頭（毫秒）"""
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in trace.items())
+
+def log_if_slow(label: str, trace: Dict[str, float], total: float):
+    """總耗時超過 SLOW_REQUEST_SECONDS 時印出各階段耗時"""
+    if SLOW_REQUEST_SECONDS and total >= SLOW_REQUEST_SECONDS:
+        stages = "，".join(f"{stage} {seconds:.2f}s" for stage, seconds in trace.items())
+        print(f"{label} 耗時 {total:.2f} 秒：{stages}")
+
+def record_generation(data: dict, fallback_tokens: int = 0):
+    """記錄一次生成的 token 數與速度（data 為 Ollama 最後一段回應，含 eval_count 等欄位）"""
+    tokens = data.get("eval_count", fallback_tokens)
+    GENERATED_TOKENS.observe(tokens)
+    if data.get("prompt_eval_count") is not None:
+        PROMPT_TOKENS.observe(data["prompt_eval_count"])
+    if data.get("prompt_eval_duration"):
+        record_stage("query", "prompt_eval", data["prompt_eval_duration"] / 1e9)
+    if tokens and data.get("eval_duration"):
+        TOKENS_PER_SECOND.observe(tokens / (data["eval_duration"] / 1e9))
+
+class MetricsMiddleware:
+    """記錄每個 HTTP 請求的耗時（以路由樣板為標籤，避免路徑參數造成過多的時間序列）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(
+                scope["method"], getattr(route, "path", "unmatched"), str(status)
+            ).observe(time.perf_counter() - start)
+
+class StatsCollector:
+    """在 /metrics 被抓取時讀取各模組既有的 stats()，不在請求路徑上額外更新指標"""
+
+    def __init__(self, answer_cache, embedding_cache, scheduler, embed_batcher,
+                 balancers: Dict[str, object], history_writer):
+        self.answer_cache = answer_cache
+        self.embedding_cache = embedding_cache
+        self.scheduler = scheduler
+        self.embed_batcher = embed_batcher
+        self.balancers = balancers
+        self.history_writer = history_writer
+
+    def collect(self) -> Iterable:
+        answer = self.answer_cache.stats()
+        embedding = self.embedding_cache.stats()
+        lookups = CounterMetricFamily("qabot_cache_lookups", "快取查詢次數", labels=["cache", "result"])
+        lookups.add_metric(["answer", "exact_hit"], answer["exact_hits"])
+        lookups.add_metric(["answer", "semantic_hit"], answer["semantic_hits"])
+        lookups.add_metric(["answer", "miss"], answer["misses"])
+        lookups.add_metric(["embedding", "hit"], embedding["hits"])
+        lookups.add_metric(["embedding", "miss"], embedding["misses"])
+        yield lookups
+        hit_ratio = GaugeMetricFamily("qabot_cache_hit_ratio", "啟動以來的快取命中率", labels=["cache"])
+        hit_ratio.add_metric(["answer"], answer["hit_ratio"])
+        hit_ratio.add_metric(["embedding"], embedding["hit_ratio"])
+        yield hit_ratio
+        size = GaugeMetricFamily("qabot_cache_entries", "快取項目數", labels=["cache"])
+        size.add_metric(["answer"], answer["size"])
+        size.add_metric(["embedding"], embedding["size"])
+        yield size
+
+        generation = self.scheduler.stats()
+        yield GaugeMetricFamily("qabot_generation_active", "進行中的生成數", value=generation["active"])
+        yield GaugeMetricFamily("qabot_generation_queue_depth", "等待生成名額的請求數", value=generation["queue_depth"])
+        yield GaugeMetricFamily("qabot_generation_max_concurrency", "同時生成的上限", value=generation["max_concurrency"])
+        outcomes = CounterMetricFamily("qabot_generation_admissions", "生成名額的申請結果", labels=["result"])
+        outcomes.add_metric(["admitted"], generation["admitted"])
+        outcomes.add_metric(["rejected"], generation["rejected"])
+        outcomes.add_metric(["timed_out"], generation["timed_out"])
+        yield outcomes
+
+        batches = self.embed_batcher.stats()
+        yield CounterMetricFamily("qabot_embed_batch_requests", "合併前的查詢嵌入請求數", value=batches["requests"])
+        yield CounterMetricFamily("qabot_embed_batches", "送往 Ollama 的查詢嵌入批次數", value=batches["batches"])
+
+        history = self.history_writer.stats()
+        yield GaugeMetricFamily("qabot_history_queue_depth", "等待寫入的聊天歷史數", value=history["queue_depth"])
+        yield CounterMetricFamily("qabot_history_writes", "已寫入的聊天歷史數", value=history["written"])
+        yield CounterMetricFamily("qabot_history_write_batches", "聊天歷史的批次交易數", value=history["batches"])
+        yield CounterMetricFamily("qabot_history_write_failures", "聊天歷史批次寫入失敗次數", value=history["failures"])
+
+        healthy = GaugeMetricFamily("qabot_ollama_node_healthy", "Ollama 節點是否可用", labels=["role", "url"])
+        outstanding = GaugeMetricFamily("qabot_ollama_node_outstanding", "Ollama 節點進行中的請求數", labels=["role", "url"])
+        requests = CounterMetricFamily("qabot_ollama_node_requests", "送往 Ollama 節點的請求數", labels=["role", "url"])
+        failures = CounterMetricFamily("qabot_ollama_node_failures", "Ollama 節點失敗的請求數", labels=["role", "url"])
+        for role, balancer in self.balancers.items():
+            for node in balancer.stats():
+                labels = [role, node["url"]]
+                healthy.add_metric(labels, 1 if node["healthy"] else 0)
+                outstanding.add_metric(labels, node["outstanding"])
+                requests.add_metric(labels, node["requests"])
+                failures.add_metric(labels, node["failures"])
+        yield healthy
+        yield outstanding
+        yield requests
+        yield failures
+
+def register_stats_collector(collector: StatsCollector):
+    """註冊 StatsCollector（同一行程只註冊一次）"""
+    REGISTRY.register(collector)
+
+def latest_metrics() -> bytes:
+    """以 Prometheus 文字格式輸出所有指標"""
+    return generate_latest(REGISTRY)
+
@@ -1,20 +1,33 @@
 """SQLite 資料模型"""
-from sqlalchemy import Column, Integer, Text, DateTime
+from sqlalchemy import Column, Integer, Float, Text, DateTime, Index
 from sqlalchemy.sql import func
 from backend.database import Base
 import uuid
 
 class Document(Base):
-    """文件資料模型"""
+    """文件資料模型（以檔名識別，重新上傳同名檔案時更新同一筆記錄）"""
     __tablename__ = "documents"
     
     id = Column(Integer, primary_key=True, index=True)
-    content = Column(Text, nullable=False)
+    filename = Column(Text, unique=True, index=True)
+    # 文件內容以 gzip 壓縮存放在 DOCUMENT_DIR 的 body_path（舊版記錄的內容仍在 content 欄位中）
+    content = Column(Text, nullable=False, default="")
+    body_path = Column(Text)
+    encoding = Column(Text)
+    size = Column(Integer)
+    content_hash = Column(Text)
+    chunk_count = Column(Integer, default=0)
     upload_time = Column(DateTime, server_default=func.now(), nullable=False)
+    updated_time = Column(DateTime, default=func.now(), onupdate=func.now())
 
 class ChatHistory(Base):
     """聊天歷史資料模型"""
     __tablename__ = "chat_history"
+    __table_args__ = (
+        # 分頁查詢以 (timestamp, id) 為游標，依會話篩選時再加上 session_id
+        Index("ix_chat_history_timestamp_id", "timestamp", "id"),
+        Index("ix_chat_history_session_timestamp_id", "session_id", "timestamp", "id"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     timestamp = Column(DateTime, server_default=func.now(), nullable=False)
@@ -22,3 +35,34 @@ class ChatHistory(Base):
     bot_response = Column(Text, nullable=False)
     session_id = Column(Text, nullable=False, default=lambda: str(uuid.uuid4()))
 
+
+class IngestJob(Base):
+    """文件處理工作資料模型（背景處理上傳的文件，供前端輪詢進度）"""
+    __tablename__ = "ingest_jobs"
+    
+    id = Column(Text, primary_key=True)
+    filename = Column(Text, nullable=False)
+    status = Column(Text, nullable=False, default="queued")
+    size = Column(Integer, default=0)
+    chunks_total = Column(Integer, default=0)
+    chunks_processed = Column(Integer, default=0)
+    added = Column(Integer, default=0)
+    deleted = Column(Integer, default=0)
+    unchanged = Column(Integer, default=0)
+    chunks_per_sec = Column(Float, default=0.0)
+    error = Column(Text)
+    # 處理此工作的 worker（主機名稱:行程 ID），重新啟動時只回收已結束的 worker 留下的工作
+    worker = Column(Text)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class IndexVersion(Base):
+    """已發布的索引版本（SHARED_INDEX 模式下各 worker 依此切換到最新的索引目錄）"""
+    __tablename__ = "index_versions"
+    
+    version = Column(Integer, primary_key=True)
+    directory = Column(Text, nullable=False)
+    chunk_count = Column(Integer, default=0)
+    created_by = Column(Text)
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
@@ -1,38 +1,314 @@
 """Ollama 客戶端封裝"""
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain_community.chat_models import ChatOllama
-from typing import List
+from backend.embedding_cache import EmbeddingCache, CachedEmbeddings
+from backend.scheduler import FairScheduler, EmbeddingBatcher
+from backend.load_balancer import OllamaCluster, NodeUnavailableError
+from backend.metrics import span, record_stage, record_generation
+from typing import AsyncIterator, List, Optional
+import httpx
+import asyncio
+import json
 import os
+import threading
+import time
 
 # 模型配置
 EMBED_MODEL = "nomic-embed-text"
 LLM_MODEL = "qwen2.5:7b-instruct"
+LLM_TEMPERATURE = 0.7
 
-# Ollama 基礎 URL（預設為 localhost:11434）
+def _parse_urls(value: str) -> List[str]:
+    """解析以逗號分隔的 URL 列表"""
+    return [url.strip().rstrip("/") for url in value.split(",") if url.strip()]
+
+# Ollama 基礎 URL（預設為 localhost:11434），可用逗號分隔多個節點
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 
-# 初始化嵌入模型
-embeddings = OllamaEmbeddings(
-    model=EMBED_MODEL,
-    base_url=OLLAMA_BASE_URL
-)
+# 嵌入與生成各自使用的節點（未設定時皆使用 OLLAMA_BASE_URL）
+OLLAMA_EMBED_URLS = _parse_urls(os.getenv("OLLAMA_EMBED_URLS", OLLAMA_BASE_URL))
+OLLAMA_GENERATE_URLS = _parse_urls(os.getenv("OLLAMA_GENERATE_URLS", OLLAMA_BASE_URL))
 
-# 初始化 LLM 模型
-llm = ChatOllama(
-    model=LLM_MODEL,
-    temperature=0.7,
-    base_url=OLLAMA_BASE_URL
-)
+# HTTP 連線池設定
+OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "64"))
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "300"))
+
+# 生成排程：每個生成節點同時生成的上限、等待佇列長度、排隊逾時與單次生成逾時（秒）
+OLLAMA_MAX_GENERATIONS = int(os.getenv("OLLAMA_MAX_GENERATIONS", "2"))
+OLLAMA_QUEUE_SIZE = int(os.getenv("OLLAMA_QUEUE_SIZE", "32"))
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "60"))
+OLLAMA_GENERATE_TIMEOUT = float(os.getenv("OLLAMA_GENERATE_TIMEOUT", "180"))
+
+# 模型在 Ollama 中閒置多久後卸載（Ollama 的格式，例如 "30m"、"1h"，-1 表示永不卸載）
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+# LLM 的上下文長度與單次回答的 token 上限（num_ctx 不同的請求會讓 Ollama 重新載入模型，所有請求需一致）
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "4096"))
+OLLAMA_NUM_PREDICT = int(os.getenv("OLLAMA_NUM_PREDICT", "512"))
+
+# 查詢嵌入的合併時間窗（毫秒）與每批最多的文字數
+OLLAMA_EMBED_BATCH_WINDOW_MS = float(os.getenv("OLLAMA_EMBED_BATCH_WINDOW_MS", "5"))
+OLLAMA_EMBED_BATCH_SIZE = int(os.getenv("OLLAMA_EMBED_BATCH_SIZE", "32"))
+
+def _api_error(message: str, status_code: int) -> ValueError:
+    """API 錯誤：5xx 表示節點不可用（可改送其他節點），其餘為請求本身的錯誤"""
+    return NodeUnavailableError(message) if status_code >= 500 else ValueError(message)
+
+def _check_embed_response(response: httpx.Response) -> httpx.Response:
+    """嵌入 API 失敗時拋出例外（在節點追蹤範圍內拋出，才會記為該節點的失敗）"""
+    if response.status_code != 200:
+        raise _api_error(
+            "Error raised by inference API HTTP code: %s, %s"
+            % (response.status_code, response.text),
+            response.status_code
+        )
+    return response
+
+# 各 Ollama 節點（依 URL 共用連線池與健康狀態）
+ollama_cluster = OllamaCluster(OLLAMA_TIMEOUT, OLLAMA_MAX_CONNECTIONS)
+embed_balancer = ollama_cluster.balancer(OLLAMA_EMBED_URLS)
+generate_balancer = ollama_cluster.balancer(OLLAMA_GENERATE_URLS)
+
+# 嵌入向量持久化快取：文字未變時（重新上傳、重複的問題）不需再呼叫 Ollama
+embedding_cache = EmbeddingCache()
+
+# 嵌入模型與 LLM 在首次使用時才建立（匯入 langchain_community 需要一秒以上，不在啟動時進行）
+_embeddings = None
+_llm = None
+_model_lock = threading.Lock()
 
 def get_embeddings():
-    """獲取嵌入模型實例"""
-    return embeddings
+    """獲取嵌入模型實例（首次呼叫時建立）"""
+    global _embeddings
+    if _embeddings is None:
+        with _model_lock:
+            if _embeddings is None:
+                from backend.ollama_embeddings import PooledOllamaEmbeddings
+                ollama_embeddings = PooledOllamaEmbeddings(
+                    model=EMBED_MODEL,
+                    base_url=OLLAMA_EMBED_URLS[0]
+                )
+                _embeddings = CachedEmbeddings(ollama_embeddings, embedding_cache, EMBED_MODEL)
+    return _embeddings
 
 def get_llm():
-    """獲取 LLM 模型實例"""
-    return llm
+    """獲取 LLM 模型實例（首次呼叫時建立）"""
+    global _llm
+    if _llm is None:
+        with _model_lock:
+            if _llm is None:
+                from langchain_community.chat_models import ChatOllama
+                # 此版本的 ChatOllama 不支援 keep_alive，模型保留時間由非同步請求與定期預熱維持
+                _llm = ChatOllama(
+                    model=LLM_MODEL,
+                    temperature=LLM_TEMPERATURE,
+                    num_ctx=OLLAMA_NUM_CTX,
+                    num_predict=OLLAMA_NUM_PREDICT,
+                    base_url=OLLAMA_GENERATE_URLS[0]
+                )
+    return _llm
+
+async def _aget_embeddings():
+    """非同步獲取嵌入模型實例（首次建立需匯入 langchain_community，放到執行緒中執行）"""
+    return _embeddings or await asyncio.to_thread(get_embeddings)
 
 def embed_texts(texts: List[str]) -> List[List[float]]:
     """嵌入文本列表"""
-    return embeddings.embed_documents(texts)
+    return get_embeddings().embed_documents(texts)
+
+def start_health_checks() -> asyncio.Task:
+    """在背景定期檢查各 Ollama 節點，暫停失敗的節點並重新加入恢復的節點"""
+    return asyncio.get_running_loop().create_task(ollama_cluster.run_health_checks())
+
+async def close_async_client():
+    """關閉各節點的 HTTP 連線池"""
+    await ollama_cluster.aclose()
+
+def _llm_options() -> dict:
+    """LLM 的生成參數（所有生成請求與預熱共用，避免 Ollama 因參數不同而重新載入模型）"""
+    return {"temperature": LLM_TEMPERATURE, "num_ctx": OLLAMA_NUM_CTX, "num_predict": OLLAMA_NUM_PREDICT}
+
+async def awarm_models(prompt_prefix: str = ""):
+    """預熱：建立嵌入模型實例，並讓每個節點將嵌入模型與 LLM 載入記憶體（避免首個請求等待模型載入）
+
+    指定 prompt_prefix 時讓 LLM 評估這段固定的 prompt 開頭，之後的請求可直接重用其 KV 快取。
+    任一角色的節點全部失敗時拋出例外；部分節點失敗時只印出訊息，由健康檢查處理。
+    """
+    await _aget_embeddings()
+    await aload_models(prompt_prefix)
+
+async def aload_models(prompt_prefix: str = ""):
+    """讓每個節點載入（或保持載入）嵌入模型與 LLM，並重設 keep_alive 的計時"""
+    async def load(node, path: str, payload: dict):
+        response = await node.async_client().post(path, json=payload)
+        if response.status_code != 200:
+            raise _api_error(f"Ollama 模型預熱失敗（HTTP {response.status_code}）：{response.text}", response.status_code)
+
+    if prompt_prefix:
+        # 以與生成請求相同的格式送出固定開頭，只生成一個 token
+        generate = ("/api/chat", {
+            **_chat_payload(prompt_prefix, stream=False),
+            "options": {**_llm_options(), "num_predict": 1},
+        })
+    else:
+        # 空白 prompt 只載入模型、不生成內容
+        generate = ("/api/generate", {
+            "model": LLM_MODEL, "prompt": "", "stream": False,
+            "keep_alive": OLLAMA_KEEP_ALIVE, "options": _llm_options(),
+        })
+    roles = [
+        (embed_balancer, "/api/embed", {"model": EMBED_MODEL, "input": ["預熱"], "keep_alive": OLLAMA_KEEP_ALIVE}),
+        (generate_balancer, *generate),
+    ]
+    for balancer, path, payload in roles:
+        results = await asyncio.gather(
+            *(load(node, path, payload) for node in balancer.nodes), return_exceptions=True
+        )
+        errors = [(node, result) for node, result in zip(balancer.nodes, results) if isinstance(result, Exception)]
+        if len(errors) == len(balancer.nodes):
+            raise errors[0][1]
+        for node, error in errors:
+            print(f"Ollama 節點 {node.url} 預熱 {payload['model']} 失敗：{error}")
+
+async def _aembed_batch(texts: List[str]) -> List[List[float]]:
+    """以非同步方式呼叫 Ollama 嵌入 API，一次嵌入多段文字"""
+    async def post(node):
+        response = await node.async_client().post(
+            "/api/embed",
+            json={"model": EMBED_MODEL, "input": texts, "keep_alive": OLLAMA_KEEP_ALIVE}
+        )
+        if response.status_code != 200:
+            raise _api_error(f"Ollama 嵌入 API 錯誤（HTTP {response.status_code}）：{response.text}", response.status_code)
+        return response.json()["embeddings"]
+    return await embed_balancer.acall(post)
+
+# 生成排程與查詢嵌入的批次合併
+generation_scheduler = FairScheduler(
+    OLLAMA_MAX_GENERATIONS * len(generate_balancer.nodes), OLLAMA_QUEUE_SIZE, OLLAMA_QUEUE_TIMEOUT
+)
+embed_batcher = EmbeddingBatcher(_aembed_batch, OLLAMA_EMBED_BATCH_WINDOW_MS / 1000, OLLAMA_EMBED_BATCH_SIZE)
+
+async def aembed_query(text: str) -> List[float]:
+    """非同步嵌入查詢文本（與 OllamaEmbeddings.embed_query 使用相同的指令前綴與快取）
+    
+    同時到達的多個查詢會合併為一次 Ollama 呼叫。
+    """
+    embeddings = await _aget_embeddings()
+    key = f"{embeddings.query_instruction}{text}"
+    # 快取讀取可能等待文件處理寫入嵌入批次時持有的鎖，在執行緒中進行以免阻塞事件迴圈
+    cached = (await asyncio.to_thread(embedding_cache.get_many, EMBED_MODEL, [key]))[0]
+    if cached is not None:
+        return cached
+    
+    vector = await embed_batcher.embed(key)
+    await asyncio.to_thread(embedding_cache.put_many, EMBED_MODEL, [key], [vector])
+    return vector
+
+async def aembed_queries(texts: List[str]) -> List[List[float]]:
+    """非同步嵌入多個查詢文本（批次處理大量問題時使用）
+
+    先查詢嵌入快取，未命中的文字每 OLLAMA_EMBED_BATCH_SIZE 段呼叫一次 Ollama，
+    同時進行的呼叫數以嵌入節點數的兩倍為上限。
+    """
+    embeddings = await _aget_embeddings()
+    keys = [f"{embeddings.query_instruction}{text}" for text in texts]
+    vectors = await asyncio.to_thread(embedding_cache.get_many, EMBED_MODEL, keys)
+    missing = list(dict.fromkeys(key for key, vector in zip(keys, vectors) if vector is None))
+    if not missing:
+        return vectors
+
+    semaphore = asyncio.Semaphore(2 * len(embed_balancer.nodes))
+    async def embed(batch: List[str]) -> List[List[float]]:
+        async with semaphore:
+            return await _aembed_batch(batch)
+
+    batches = [missing[i:i + OLLAMA_EMBED_BATCH_SIZE] for i in range(0, len(missing), OLLAMA_EMBED_BATCH_SIZE)]
+    results = await asyncio.gather(*(embed(batch) for batch in batches))
+    embedded = [vector for result in results for vector in result]
+    await asyncio.to_thread(embedding_cache.put_many, EMBED_MODEL, missing, embedded)
+    found = dict(zip(missing, embedded))
+    return [vector if vector is not None else found[key] for key, vector in zip(keys, vectors)]
+
+def _chat_payload(prompt: str, stream: bool) -> dict:
+    """建立 Ollama /api/chat 請求內容（與 ChatOllama 相同的模型與參數）"""
+    return {
+        "model": LLM_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": stream,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": _llm_options(),
+    }
+
+def _generate_timeout_error() -> TimeoutError:
+    return TimeoutError(f"Ollama 生成逾時（超過 {OLLAMA_GENERATE_TIMEOUT:.0f} 秒）")
+
+async def agenerate(prompt: str, session_id: Optional[str] = None) -> str:
+    """非同步生成完整回答（經生成排程，同一會話的請求在佇列中輪流）"""
+    async def post(node):
+        try:
+            response = await asyncio.wait_for(
+                node.async_client().post("/api/chat", json=_chat_payload(prompt, stream=False)),
+                OLLAMA_GENERATE_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            raise _generate_timeout_error()
+        if response.status_code != 200:
+            raise _api_error(f"Ollama 生成 API 錯誤（HTTP {response.status_code}）：{response.text}", response.status_code)
+        data = response.json()
+        record_generation(data)
+        return data["message"]["content"]
+    
+    queued = time.perf_counter()
+    async with generation_scheduler.slot(session_id):
+        record_stage("query", "queue", time.perf_counter() - queued)
+        with span("query", "generate"):
+            return await generate_balancer.acall(post)
+
+async def _astream_chat(node, prompt: str, deadline: float) -> AsyncIterator[str]:
+    """向指定節點串流生成，超過 deadline（事件迴圈時間）時拋出 TimeoutError"""
+    loop = asyncio.get_running_loop()
+    async with node.async_client().stream(
+        "POST", "/api/chat", json=_chat_payload(prompt, stream=True)
+    ) as response:
+        if response.status_code != 200:
+            detail = await response.aread()
+            raise _api_error(
+                f"Ollama 生成 API 錯誤（HTTP {response.status_code}）：{detail.decode('utf-8', 'replace')}",
+                response.status_code
+            )
+        lines = response.aiter_lines()
+        chunks = 0
+        while True:
+            try:
+                line = await asyncio.wait_for(lines.__anext__(), deadline - loop.time())
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise _generate_timeout_error()
+            if not line:
+                continue
+            data = json.loads(line)
+            content = data.get("message", {}).get("content")
+            if content:
+                chunks += 1
+                yield content
+            if data.get("done"):
+                record_generation(data, chunks)
+                break
 
+async def astream_generate(prompt: str, session_id: Optional[str] = None) -> AsyncIterator[str]:
+    """非同步逐段生成回答（經生成排程，串流結束前一直佔用名額）"""
+    queued = time.perf_counter()
+    async with generation_scheduler.slot(session_id):
+        record_stage("query", "queue", time.perf_counter() - queued)
+        deadline = asyncio.get_running_loop().time() + OLLAMA_GENERATE_TIMEOUT
+        tried = []
+        while True:
+            try:
+                with span("query", "generate"), generate_balancer.request(tried) as node:
+                    async for content in _astream_chat(node, prompt, deadline):
+                        yield content
+                return
+            except (httpx.ConnectError, NodeUnavailableError):
+                # 連線失敗或節點不可用時尚未輸出任何內容，可以改用下一個節點
+                tried.append(node)
+                if len(tried) >= len(generate_balancer.nodes):
+                    raise
@@ -0,0 +1,27 @@
+"""連線池版本的 OllamaEmbeddings
+
+匯入 langchain_community.embeddings 需要一秒以上，因此此模組只在首次需要嵌入模型時
+由 ollama_client.get_embeddings() 匯入，不影響後端的啟動時間。
+"""
+from langchain_community.embeddings import OllamaEmbeddings
+from backend.ollama_client import embed_balancer, _check_embed_response, OLLAMA_KEEP_ALIVE
+from typing import List
+import httpx
+
+class PooledOllamaEmbeddings(OllamaEmbeddings):
+    """重用 HTTP 連線的 OllamaEmbeddings（原實作每個文本塊都以 requests.post 建立新連線）
+
+    以 /api/embed 一次嵌入整批文字（舊的 /api/embeddings 每次只接受一段文字），
+    返回的向量已單位化。
+    """
+
+    def _embed(self, input: List[str]) -> List[List[float]]:
+        payload = {**self._default_params, "model": self.model, "input": input, "keep_alive": OLLAMA_KEEP_ALIVE}
+        try:
+            response = embed_balancer.call(lambda node: _check_embed_response(
+                node.http_client().post("/api/embed", json=payload)
+            ))
+        except httpx.HTTPError as e:
+            raise ValueError(f"Error raised by inference endpoint: {e}")
+
+        return response.json()["embeddings"]
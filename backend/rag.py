@@ -9,12 +9,29 @@ os.environ["CHROMA_TELEMETRY_ENABLED"] = "False"
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning, message=".*telemetry.*")
 
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain.chains import RetrievalQA
-from langchain.prompts import PromptTemplate
-from backend.ollama_client import get_embeddings, get_llm
+from langchain_core.documents import Document
+from backend.ollama_client import get_embeddings, aembed_query, aembed_queries, agenerate, astream_generate
+from backend.lexical_index import LexicalIndex, reciprocal_rank_fusion
+from backend.vector_index import create_vector_index, VECTOR_BACKEND, VECTOR_INDEX_DIR
+from backend import index_store
+from backend.index_store import SHARED_INDEX, INDEX_POLL_INTERVAL, chroma_directory, vector_index_directory
+from backend.context_packing import estimate_tokens, truncate_to_tokens, pack_context
+from backend.intents import match_intent
+from backend.scheduler import OllamaBusyError
+from backend.metrics import span, record_stage, record_ttft, ANSWERS_TOTAL, RETRIEVALS_TOTAL
+from backend.text_splitter import StreamingTextSplitter, FileChunks
 import shutil
+import asyncio
+import threading
+import time
+import hashlib
+import tempfile
+import unicodedata
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
 
 # Chroma 持久化路徑
 CHROMA_PERSIST_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "chroma_db")
@@ -46,19 +63,288 @@ def ensure_chroma_directory():
         print(f"確保目錄時發生錯誤：{e}")
         raise
 
-# 文本分割器
-text_splitter = RecursiveCharacterTextSplitter(
-    chunk_size=500,
-    chunk_overlap=50,
-    length_function=len,
-)
+# 文本塊大小與相鄰文本塊重疊的字元數（可用 python -m benchmarks.retrieval_eval 比較不同的設定）
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "500"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
+
+# 文本分割器（串流分割，依段落、換行與中文句末標點選擇切點）
+text_splitter = StreamingTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+# 每次檢索的文本塊數量
+RETRIEVER_K = int(os.getenv("RETRIEVER_K", "3"))
+
+# 混合檢索：向量與 BM25 各取的候選數、倒數排名融合（RRF）常數，
+# 以及 BM25 快速路徑的信心度門檻（第一名文本塊涵蓋的查詢詞 IDF 比例，達門檻時不呼叫嵌入；大於 1 時停用）
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "10"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+LEXICAL_FAST_PATH_CONFIDENCE = float(os.getenv("LEXICAL_FAST_PATH_CONFIDENCE", "1.0"))
+
+# 重建 BM25 索引或向量索引時每次從 Chroma 讀取的文本塊數量
+_REBUILD_BATCH_SIZE = 5000
+
+# collection metadata 中標記向量已單位化的欄位
+_NORMALIZED_MARKER = "embeddings_normalized"
+
+# 文件嵌入設定：每批文本塊數量與平行嵌入的工作執行緒數
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))
+
+# 每次寫入 Chroma 的文本塊數量上限
+_UPSERT_BATCH_SIZE = 1000
 
 # 全局變數存儲向量庫
 vectorstore = None
 
+# 向量庫版本號：每次向量庫內容變更時遞增，快取的答案依此判斷是否過期
+vectorstore_generation = 0
+
+# 向量庫中的文本塊數量（None 表示尚未載入），用於判斷向量庫是否為空，
+# 避免每次查詢都呼叫 collection.count() 或額外的 similarity_search
+chunk_count = None
+
+# BM25 詞彙索引：載入向量庫時從 Chroma 重建，文件處理時與向量庫同步增減文本塊
+lexical_index = LexicalIndex()
+
+# 查詢用的向量索引（依 VECTOR_BACKEND 設定，載入向量庫時建立；None 表示尚未載入）
+vector_index = None
+
+# 文件寫入鎖：避免多個上傳同時比對並修改向量庫
+_ingest_lock = threading.RLock()
+
+# 直接修改目前的索引時對查詢隱藏的文本塊 ID：新文本塊寫入期間隱藏，寫完後一次改為隱藏同一文件已不存在的文本塊，
+# 刪除完成後再取消，查詢不會同時看到同一文件的新舊內容（每次以新的 frozenset 取代，查詢不需加鎖）
+_hidden_ids = frozenset()
+
+# SHARED_INDEX 模式下目前載入的索引版本與目錄（None 表示尚未載入任何版本）
+index_version = None
+_index_directory = None
+
+# 上一個版本的 Chroma 目錄：切換後可能仍有查詢在使用，下一次切換時才釋放
+_previous_chroma_directory = None
+
+# 載入並切換索引版本的鎖
+_swap_lock = threading.Lock()
+
+# 是否已檢查過舊版（整庫重建時期）寫入的文本塊
+_legacy_checked = False
+
+# Prompt 開頭的固定指示：所有請求的 prompt 都以完全相同的文字開頭，
+# Ollama 可重用這段的 KV 快取，每個請求只需評估之後的上下文、對話與問題
+PROMPT_PREFIX = """你是一個友善的客服助手。請根據提供的上下文資訊（以及先前的對話，如果有的話）回答用戶的問題。
+如果你不知道答案，請誠實地說你不知道，不要編造資訊。
+請用繁體中文回答。
+
+"""
+
+# Prompt 模板（/chat 與 /chat/stream 共用，以 str.format 填入）
+prompt_template = PROMPT_PREFIX + """上下文資訊：
+{context}
+
+問題：{question}
+
+回答："""
+
+# 有先前對話時使用的 Prompt 模板（開頭與 prompt_template 相同）
+conversation_prompt_template = PROMPT_PREFIX + """上下文資訊：
+{context}
+
+先前的對話：
+{history}
+
+問題：{question}
+
+回答："""
+
+# 對話感知檢索：最多參考的先前輪數，以及這些對話可佔用的 token 預算
+CONVERSATION_TURNS = int(os.getenv("CONVERSATION_TURNS", "3"))
+CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "300"))
+
+# 尚未上傳文件時的回覆
+NO_DOCUMENT_MESSAGE = "抱歉，目前還沒有上傳任何客服資料文件。請先上傳 .txt 格式的文件。"
+
+# 相關度門檻：BM25 第一名文本塊涵蓋的查詢詞 IDF 比例（與快速路徑的信心度相同）低於 LEXICAL_RELEVANCE_THRESHOLD 時，
+# 視為客服資料中沒有相關內容，直接回覆 OUT_OF_SCOPE_MESSAGE 而不呼叫 LLM（0 表示停用整個門檻）。
+# 預設值以 benchmarks/retrieval_questions.jsonl 校正：範圍內的問題最低為 0.073，範圍外的問題最高為 0.031。
+# 與文本塊沒有共同詞彙的換句話說（例如「我想退錢」）信心度為 0，設定 RELEVANCE_THRESHOLD 後，
+# 向量檢索第一名的餘弦相似度達到此值的問題仍視為相關；適當的值依嵌入模型而定，預設不使用（0），
+# 以 benchmarks/retrieval_eval.py 校正後再設定
+LEXICAL_RELEVANCE_THRESHOLD = float(os.getenv("LEXICAL_RELEVANCE_THRESHOLD", "0.05"))
+RELEVANCE_THRESHOLD = float(os.getenv("RELEVANCE_THRESHOLD", "0"))
+OUT_OF_SCOPE_MESSAGE = os.getenv(
+    "OUT_OF_SCOPE_MESSAGE",
+    "抱歉，我在客服資料中找不到與您的問題相關的資訊。建議您聯繫客服專線或寄信至客服信箱，由專人為您服務。"
+)
+
+# 未呼叫 LLM 即回覆的問題數（依原因），與答案快取的統計一同由 /cache/stats 返回
+_early_exits: Counter = Counter()
+_early_exits_lock = threading.Lock()
+
+def record_early_exit(reason: str, count: int = 1):
+    """記錄未呼叫 LLM 即回覆的問題（intent、out_of_scope）"""
+    ANSWERS_TOTAL.labels(reason).inc(count)
+    with _early_exits_lock:
+        _early_exits[reason] += count
+
+def early_exit_stats() -> Dict[str, int]:
+    """各原因未呼叫 LLM 即回覆的問題數"""
+    with _early_exits_lock:
+        return {reason: _early_exits[reason] for reason in ("intent", "out_of_scope")}
+
+def answer_intent(question: str, history: Optional[List[Tuple[str, str]]] = None) -> Optional[str]:
+    """問候、道謝等固定回覆的訊息直接返回回覆，不檢索也不呼叫 LLM（history 非空時「好」等附和交給 LLM 依對話回答）"""
+    intent = match_intent(question, in_conversation=bool(history))
+    if intent is None:
+        return None
+    record_early_exit("intent")
+    return intent[1]
+
+# 答案快取設定：最多快取的問題數、存活秒數、語意比對的餘弦相似度門檻
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+# 正規化問題時移除的結尾標點
+_QUESTION_TRAILING_PUNCTUATION = "?？!！。.~～ "
+
+def normalize_question(question: str) -> str:
+    """正規化問題文字（全半形、大小寫、空白與結尾標點），作為快取的精確比對鍵"""
+    text = unicodedata.normalize("NFKC", question).lower()
+    text = "".join(text.split())
+    return text.rstrip(_QUESTION_TRAILING_PUNCTUATION)
+
+def condense_history(history: Optional[List[Tuple[str, str]]], budget: int = None) -> List[Tuple[str, str]]:
+    """保留最近 CONVERSATION_TURNS 輪對話，由新到舊填入 token 預算，超出的回答截斷
+    
+    history 為依時間由舊到新排列的 (用戶訊息, 回答)，返回值同樣由舊到新排列。
+    """
+    if not history or CONVERSATION_TURNS <= 0:
+        return []
+    remaining = CONVERSATION_TOKEN_BUDGET if budget is None else budget
+    turns = []
+    for user_message, bot_response in reversed(history[-CONVERSATION_TURNS:]):
+        if remaining <= 0:
+            break
+        user_message = truncate_to_tokens(user_message, remaining)
+        remaining -= estimate_tokens(user_message)
+        bot_response = truncate_to_tokens(bot_response, remaining)
+        remaining -= estimate_tokens(bot_response)
+        turns.append((user_message, bot_response))
+    turns.reverse()
+    return turns
+
+def build_search_query(question: str, turns: List[Tuple[str, str]]) -> str:
+    """組合檢索用的查詢：目前問題在前，再附上先前的用戶訊息（由新到舊）
+
+    追問（例如「那運費呢？」）本身缺少主題，附上先前的問題才能檢索到相關文本塊；
+    回答通常較長且已包含檢索結果，因此不納入查詢。
+    """
+    previous = [user_message for user_message, _ in reversed(turns) if user_message]
+    return "\n".join([question] + previous)
+
+class AnswerCache:
+    """問題答案快取：先以正規化文字精確比對，再以問題嵌入做最近鄰比對，採 LRU/TTL 淘汰"""
+    
+    def __init__(self, max_size: int, ttl: float, threshold: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        # 正規化問題 -> (答案, 單位化的問題嵌入, 建立時間)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+    
+    def _is_expired(self, created_at: float) -> bool:
+        return time.monotonic() - created_at > self.ttl
+    
+    def get(self, question: str) -> Optional[str]:
+        """以正規化後的問題文字精確比對"""
+        key = normalize_question(question)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._is_expired(entry[2]):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.exact_hits += 1
+            return entry[0]
+    
+    def get_similar(self, embedding: List[float]) -> Optional[str]:
+        """以問題嵌入在快取中尋找最相似的問題，相似度達門檻時返回其答案"""
+        query = _unit_vector(embedding)
+        with self._lock:
+            # 先移除過期項目
+            expired = [key for key, entry in self._entries.items() if self._is_expired(entry[2])]
+            for key in expired:
+                del self._entries[key]
+            
+            # 由 BM25 快速路徑寫入的項目沒有問題嵌入，只供精確比對
+            keys = [key for key, entry in self._entries.items() if entry[1] is not None]
+            if keys:
+                matrix = np.stack([self._entries[key][1] for key in keys])
+                scores = matrix @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.semantic_hits += 1
+                    return self._entries[keys[best]][0]
+            
+            self.misses += 1
+            return None
+    
+    def record_miss(self):
+        """記錄一次未命中（未經語意比對即改走其他路徑時）"""
+        with self._lock:
+            self.misses += 1
+    
+    def put(self, question: str, embedding: Optional[List[float]], answer: str):
+        """加入快取，超過容量時淘汰最久未使用的項目（embedding 為 None 時只供精確比對）"""
+        key = normalize_question(question)
+        vector = _unit_vector(embedding) if embedding is not None else None
+        with self._lock:
+            self._entries[key] = (answer, vector, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        """清空快取（上傳新文件後答案可能已過期）"""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self) -> dict:
+        """快取命中統計"""
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            total = hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / total, 4) if total else 0.0,
+            }
+
+def _unit_vector(embedding: List[float]) -> np.ndarray:
+    """將嵌入向量單位化，使內積即為餘弦相似度"""
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+# 全局答案快取
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_THRESHOLD)
+
 def initialize_vectorstore():
     """初始化或載入向量庫（懶加載，只在需要時載入）"""
-    global vectorstore
+    global vectorstore, vector_index
+    
+    if SHARED_INDEX:
+        refresh_shared_index()
+        return vectorstore
     
     # 懶加載：只有在目錄已存在且有文件時才載入
     # 如果目錄不存在或為空，不創建空向量庫，等真正有數據時再創建
@@ -70,11 +356,16 @@ def initialize_vectorstore():
                 ensure_chroma_directory()
                 embeddings = get_embeddings()
                 try:
+                    from langchain_community.vectorstores import Chroma
                     vectorstore = Chroma(
                         persist_directory=CHROMA_PERSIST_DIR,
                         embedding_function=embeddings,
                         collection_name=COLLECTION_NAME
                     )
+                    # 只在載入時計算一次文本塊數量
+                    _rebuild_lexical_index(vectorstore._collection, lexical_index)
+                    vector_index = _load_vector_index(vectorstore._collection)
+                    _mark_vectorstore_updated(_count_chunks(vectorstore))
                     return vectorstore
                 except Exception as e:
                     print(f"載入現有向量庫時發生錯誤：{e}")
@@ -86,282 +377,901 @@ def initialize_vectorstore():
     
     # 如果目錄不存在或為空，不創建空向量庫
     vectorstore = None
+    vector_index = None
+    lexical_index.clear()
+    _mark_vectorstore_updated(0)
     return vectorstore
 
-def clear_vectorstore():
-    """清空向量庫"""
-    global vectorstore
-    
-    # 關閉現有的向量庫連接
-    vectorstore = None
-    
-    # 如果目錄存在，刪除整個目錄及其所有內容
-    if os.path.exists(CHROMA_PERSIST_DIR):
-        try:
-            # 確保可以刪除所有文件（包括可能只讀的文件）
-            import stat
-            def remove_readonly(func, path, exc):
-                """移除只讀文件"""
-                os.chmod(path, stat.S_IWRITE)
-                func(path)
-            
-            shutil.rmtree(CHROMA_PERSIST_DIR, onerror=remove_readonly)
-            print(f"已清除向量庫目錄：{CHROMA_PERSIST_DIR}")
-        except Exception as e:
-            print(f"清除向量庫時發生錯誤：{e}")
-            # 如果刪除失敗，嘗試強制刪除
-            try:
-                import subprocess
-                subprocess.run(['rm', '-rf', CHROMA_PERSIST_DIR], check=True)
-                print(f"使用系統命令強制清除目錄")
-            except:
-                pass
-    
-    # 確保目錄存在且有正確的權限
-    ensure_chroma_directory()
-    
-    # 不要在這裡創建空的向量庫，讓 from_texts 來創建
+def _rebuild_lexical_index(collection, index: LexicalIndex):
+    """從 Chroma 中已儲存的文本塊重建 BM25 索引"""
+    start = time.perf_counter()
+    index.clear()
+    offset = 0
+    while True:
+        batch = collection.get(include=["documents", "metadatas"], limit=_REBUILD_BATCH_SIZE, offset=offset)
+        for id_, text, metadata in zip(batch["ids"], batch["documents"], batch["metadatas"]):
+            index.add(id_, text or "", metadata)
+        if len(batch["ids"]) < _REBUILD_BATCH_SIZE:
+            break
+        offset += _REBUILD_BATCH_SIZE
+    print(f"已重建 BM25 索引：{len(index)} 個文本塊，耗時 {time.perf_counter() - start:.2f} 秒")
 
-def process_and_store_document(content: str):
-    """處理並儲存文件到向量庫"""
-    global vectorstore
+def _normalize_stored_embeddings(collection) -> bool:
+    """將舊版以 /api/embeddings 寫入的（未單位化）向量就地單位化，每個向量庫只執行一次
     
-    # 清空舊內容
-    clear_vectorstore()
-    
-    # 分割文本
-    texts = text_splitter.split_text(content)
-    
-    # 如果沒有文本，返回
-    if not texts:
-        print("警告：文本分割後為空")
-        return
+    /api/embed 返回單位向量，兩者混用時 L2 距離的排序會失準。
+    已處理的向量庫在 collection metadata 中標記，返回是否有改寫向量。
+    """
+    metadata = dict(collection.metadata or {})
+    if metadata.get(_NORMALIZED_MARKER):
+        return False
     
-    # 確保目錄存在且有正確的權限
-    ensure_chroma_directory()
+    count = collection.count()
+    offset = 0
+    while offset < count:
+        batch = collection.get(include=["embeddings"], limit=_REBUILD_BATCH_SIZE, offset=offset)
+        if not batch["ids"]:
+            break
+        vectors = np.asarray(batch["embeddings"], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        collection.update(ids=batch["ids"], embeddings=(vectors / np.maximum(norms, 1e-12)).tolist())
+        offset += len(batch["ids"])
     
-    # 添加到向量庫
+    # hnsw: 開頭的設定建立後不可修改，只保留其他欄位
+    metadata = {key: value for key, value in metadata.items() if not key.startswith("hnsw:")}
+    metadata[_NORMALIZED_MARKER] = True
+    collection.modify(metadata=metadata)
+    if count:
+        print(f"已將 {count} 個文本塊的嵌入向量單位化")
+    return count > 0
+
+def _load_vector_index(collection, directory: str = VECTOR_INDEX_DIR):
+    """建立查詢用的向量索引，與 Chroma 不一致（例如首次啟用或上次寫入中斷）時從 Chroma 重建"""
+    start = time.perf_counter()
+    normalized = _normalize_stored_embeddings(collection)
+    index = create_vector_index(collection, directory=directory)
+    count = collection.count()
+    if normalized or not index.is_synced(count):
+        index.clear()
+        offset = 0
+        while True:
+            batch = collection.get(include=["embeddings"], limit=_REBUILD_BATCH_SIZE, offset=offset)
+            if batch["ids"]:
+                index.add(batch["ids"], np.asarray(batch["embeddings"], dtype=np.float32))
+            if len(batch["ids"]) < _REBUILD_BATCH_SIZE:
+                break
+            offset += _REBUILD_BATCH_SIZE
+        index.save()
+        print(f"已從 Chroma 重建 {VECTOR_BACKEND} 向量索引：{len(index)} 個文本塊")
+    print(f"已載入 {VECTOR_BACKEND} 向量索引，耗時 {time.perf_counter() - start:.2f} 秒")
+    return index
+
+def _count_chunks(store) -> int:
+    """計算向量庫中的文本塊數量（僅在載入向量庫時呼叫）"""
     try:
-        embeddings = get_embeddings()
-        
-        # 確保目錄完全乾淨且有寫入權限
-        if os.path.exists(CHROMA_PERSIST_DIR):
-            import stat
-            def remove_readonly(func, path, exc):
-                os.chmod(path, stat.S_IWRITE)
-                func(path)
-            try:
-                shutil.rmtree(CHROMA_PERSIST_DIR, onerror=remove_readonly)
-                ensure_chroma_directory()
-            except Exception as e:
-                print(f"清理目錄時發生錯誤：{e}")
-        
-        # 設置 umask 確保創建的文件有正確的權限
-        import stat
-        old_umask = os.umask(0o000)  # 允許所有權限
-        
+        count = store._collection.count()
+        print(f"向量庫中文檔數量：{count}")
+        return count
+    except Exception as e:
+        # 無法訪問 _collection 時，改用 similarity_search 檢查是否有內容
         try:
-            # 創建向量庫
-            vectorstore = Chroma.from_texts(
-                texts=texts,
-                embedding=embeddings,
-                persist_directory=CHROMA_PERSIST_DIR,
-                collection_name=COLLECTION_NAME
-            )
-        finally:
-            # 恢復原來的 umask
-            os.umask(old_umask)
-        
-        # 立即修復所有創建的文件權限（在 ChromaDB 創建後立即執行）
-        import stat
-        import time
-        # 等待一下確保所有文件都已創建
-        time.sleep(0.1)
-        
-        if os.path.exists(CHROMA_PERSIST_DIR):
-            for root, dirs, files in os.walk(CHROMA_PERSIST_DIR):
-                for d in dirs:
-                    dir_path = os.path.join(root, d)
-                    try:
-                        os.chmod(dir_path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
-                    except Exception as e:
-                        print(f"設置目錄 {dir_path} 權限時發生錯誤：{e}")
-                for f in files:
-                    file_path = os.path.join(root, f)
-                    try:
-                        # 設置完整的讀寫權限
-                        os.chmod(file_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH | stat.S_IWOTH)
-                    except Exception as e:
-                        print(f"設置文件 {file_path} 權限時發生錯誤：{e}")
-        
-        # 重新載入向量庫以確保權限生效
+            print(f"使用 similarity_search 檢查向量庫：{e}")
+            results = store.similarity_search("test", k=1)
+            return len(results) if results else 0
+        except Exception as e2:
+            print(f"檢查向量庫時發生錯誤：{e2}")
+            return 0
+
+def _mark_vectorstore_updated(count: int):
+    """記錄向量庫內容已變更：更新文本塊數量並遞增版本號，使快取的答案失效"""
+    global chunk_count, vectorstore_generation
+    chunk_count = count
+    vectorstore_generation += 1
+    answer_cache.clear()
+
+def _open_vectorstore(directory: Optional[str] = None):
+    """開啟（或創建）持久化的向量庫（預設為 CHROMA_PERSIST_DIR）"""
+    from langchain_community.vectorstores import Chroma
+    if directory is None:
+        ensure_chroma_directory()
+        directory = CHROMA_PERSIST_DIR
+    return Chroma(
+        persist_directory=directory,
+        embedding_function=get_embeddings(),
+        collection_name=COLLECTION_NAME
+    )
+
+def _close_vectorstore(directory: str):
+    """釋放 Chroma 為該目錄保留的連線與記憶體（Chroma 依目錄快取開啟的資料庫，不會自行釋放）"""
+    try:
+        from chromadb.api.client import SharedSystemClient
+        system = SharedSystemClient._identifer_to_system.pop(directory, None)
+        if system is not None:
+            system.stop()
+    except Exception as e:
+        print(f"釋放向量庫 {directory} 時發生錯誤：{e}")
+
+def _has_legacy_index() -> bool:
+    """CHROMA_PERSIST_DIR 中是否有啟用 SHARED_INDEX 之前建立的向量庫"""
+    return os.path.isdir(CHROMA_PERSIST_DIR) and bool(os.listdir(CHROMA_PERSIST_DIR))
+
+def _legacy_directories() -> dict:
+    """首次建立版本時複製的舊版目錄（版本目錄中的名稱 -> 舊版目錄）"""
+    return {
+        index_store.CHROMA_SUBDIR: CHROMA_PERSIST_DIR,
+        index_store.VECTOR_INDEX_SUBDIR: VECTOR_INDEX_DIR,
+    }
+
+def _install_index(version: int, directory: str, store, lexical: LexicalIndex, index, count: int):
+    """切換到已載入的索引版本（需持有 _swap_lock）"""
+    global vectorstore, lexical_index, vector_index, index_version, _index_directory, _previous_chroma_directory
+    if _previous_chroma_directory is not None:
+        _close_vectorstore(_previous_chroma_directory)
+    _previous_chroma_directory = chroma_directory(_index_directory) if _index_directory is not None else None
+    vectorstore, lexical_index, vector_index = store, lexical, index
+    index_version, _index_directory = version, directory
+    _mark_vectorstore_updated(count)
+
+def _migrate_legacy_index():
+    """SHARED_INDEX 模式首次啟動時，將既有的 chroma_db 與向量索引發布為第一個版本"""
+    with _ingest_lock, index_store.ingest_lock():
+        latest = index_store.latest_version()
+        if latest is not None:
+            return latest
+        version, directory = index_store.prepare_version(None, _legacy_directories())
         try:
-            vectorstore = Chroma(
-                persist_directory=CHROMA_PERSIST_DIR,
-                embedding_function=embeddings,
-                collection_name=COLLECTION_NAME
-            )
-        except Exception as e:
-            print(f"重新載入向量庫時發生錯誤（可能仍正常）：{e}")
-        
-        # 確保持久化（如果方法存在）
+            store = _open_vectorstore(chroma_directory(directory))
+            # 發布前先完成向量單位化與向量索引重建，各 worker 載入時不需寫入版本目錄
+            _load_vector_index(store._collection, vector_index_directory(directory))
+            count = store._collection.count()
+        except Exception:
+            _close_vectorstore(chroma_directory(directory))
+            index_store.discard_version(directory)
+            raise
+        index_store.publish_version(version, directory, count)
+        return version, directory
+
+def refresh_shared_index(migrate: bool = True) -> bool:
+    """SHARED_INDEX 模式：有新發布的版本時載入並切換，返回是否已切換
+
+    新版本在目前的執行緒中載入（BM25 索引從 Chroma 重建），載入期間查詢照常使用目前的版本。
+    """
+    latest = index_store.latest_version()
+    if latest is None and migrate and _has_legacy_index():
+        latest = _migrate_legacy_index()
+    if latest is None:
+        if chunk_count is None:
+            _mark_vectorstore_updated(0)
+        return False
+    
+    version, directory = latest
+    if index_version is not None and version <= index_version:
+        return False
+    with _swap_lock:
+        if index_version is not None and version <= index_version:
+            return False
+        start = time.perf_counter()
+        store = _open_vectorstore(chroma_directory(directory))
+        collection = store._collection
+        lexical = LexicalIndex()
+        _rebuild_lexical_index(collection, lexical)
+        index = _load_vector_index(collection, vector_index_directory(directory))
+        _install_index(version, directory, store, lexical, index, collection.count())
+    print(f"已切換到索引版本 {version}，耗時 {time.perf_counter() - start:.2f} 秒")
+    return True
+
+async def watch_shared_index():
+    """SHARED_INDEX 模式：定期檢查是否有其他 worker 發布的新版本（尚未載入向量庫時等到首次查詢才載入）"""
+    while True:
+        await asyncio.sleep(INDEX_POLL_INTERVAL)
+        if not is_vectorstore_loaded():
+            continue
         try:
-            if hasattr(vectorstore, 'persist'):
-                vectorstore.persist()
+            await asyncio.to_thread(refresh_shared_index)
         except Exception as e:
-            print(f"調用 persist() 時發生錯誤（可能不支援，但資料已保存）：{e}")
+            print(f"載入新的索引版本時發生錯誤：{e}")
+
+class _IndexWriter:
+    """一次寫入使用的向量庫、BM25 索引與向量索引；有變更時由呼叫端設定 changed
+
+    live 為 True 時直接修改查詢中的索引（預設模式），寫入期間以 hide 控制查詢看得到的文本塊；
+    SHARED_INDEX 模式在新版本的目錄中寫入，發布前查詢看不到，hide 不做任何事。
+    """
+
+    def __init__(self, store, lexical: LexicalIndex, index, live: bool = False):
+        self.store = store
+        self.collection = store._collection
+        self.lexical = lexical
+        self.index = index
+        self.live = live
+        self.changed = False
+
+    def hide(self, ids: Iterable[str] = (), show: Iterable[str] = ()):
+        """對查詢隱藏 ids 並取消隱藏 show（兩者同時生效）"""
+        global _hidden_ids
+        if self.live:
+            _hidden_ids = (_hidden_ids - frozenset(show)) | frozenset(ids)
+
+    def remove(self, ids: List[str]):
+        """從 Chroma、BM25 索引與向量索引刪除文本塊"""
+        if ids:
+            self.collection.delete(ids=ids)
+        for id_ in ids:
+            self.lexical.remove(id_)
+        self.index.remove(ids)
+
+@contextmanager
+def _writable_index(create: bool = True):
+    """取得可寫入的索引（需持有 _ingest_lock）；create=False 時尚未建立向量庫則返回 None
+    
+    預設直接修改目前的索引，以 _IndexWriter.hide 避免查詢看到寫入一半的文件。
+    SHARED_INDEX 模式則取得跨行程的寫入鎖，複製最新版本的目錄後在新目錄中修改，
+    有變更時發布為新版本並切換，否則刪除新目錄；修改期間目前的版本照常提供查詢。
+    """
+    global vectorstore, vector_index
+    if not SHARED_INDEX:
+        if vectorstore is None:
+            initialize_vectorstore()
+        if vectorstore is None and not create:
+            yield None
+            return
+        store = vectorstore if vectorstore is not None else _open_vectorstore()
+        if vector_index is None:
+            vector_index = _load_vector_index(store._collection)
+        writer = _IndexWriter(store, lexical_index, vector_index, live=True)
+        yield writer
+        vectorstore = store
+        if writer.changed or chunk_count is None:
+            _mark_vectorstore_updated(writer.collection.count())
+        return
+    
+    with index_store.ingest_lock():
+        # 以最新發布的版本為基礎（其他 worker 可能剛發布新版本）
+        refresh_shared_index(migrate=False)
+        base_directory = _index_directory
+        if base_directory is None and not create and not _has_legacy_index():
+            yield None
+            return
+        version, directory = index_store.prepare_version(base_directory, _legacy_directories())
+        try:
+            store = _open_vectorstore(chroma_directory(directory))
+            if base_directory is not None:
+                lexical = lexical_index.copy()
+            else:
+                lexical = LexicalIndex()
+                _rebuild_lexical_index(store._collection, lexical)
+            writer = _IndexWriter(store, lexical, _load_vector_index(store._collection, vector_index_directory(directory)))
+            yield writer
+        except BaseException:
+            _close_vectorstore(chroma_directory(directory))
+            index_store.discard_version(directory)
+            raise
+        if not writer.changed:
+            _close_vectorstore(chroma_directory(directory))
+            index_store.discard_version(directory)
+            return
+        count = writer.collection.count()
+        index_store.publish_version(version, directory, count)
+        with _swap_lock:
+            _install_index(version, directory, store, writer.lexical, writer.index, count)
+
+def chunk_hash(text: str) -> str:
+    """計算文本塊內容的 sha256"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def chunk_id(source: str, content_hash: str) -> str:
+    """文本塊在向量庫中的 ID：由文件名稱與文本塊內容決定，內容不變時 ID 不變"""
+    source_key = hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+    return f"{source_key}-{content_hash}"
+
+def _remove_legacy_chunks(writer: _IndexWriter):
+    """移除舊版（整庫重建）寫入、沒有 source 欄位的文本塊（每個行程只檢查一次）"""
+    global _legacy_checked
+    if _legacy_checked:
+        return 0
+    _legacy_checked = True
+    
+    existing = writer.collection.get(include=["metadatas"])
+    legacy_ids = [
+        id_ for id_, metadata in zip(existing["ids"], existing["metadatas"])
+        if not metadata or "source" not in metadata
+    ]
+    if legacy_ids:
+        writer.remove(legacy_ids)
+        print(f"已移除 {len(legacy_ids)} 個舊版文本塊")
+    return len(legacy_ids)
+
+def chunk_metadata(source: str, id_: str, index: int) -> dict:
+    """文本塊的 metadata（內容雜湊取自 ID）"""
+    return {"source": source, "chunk_hash": id_.rsplit("-", 1)[1], "chunk_index": index}
+
+def iter_chunk_ids(chunks: Iterable[str], source: str) -> Iterator[Tuple[str, str, int]]:
+    """依序返回 (ID, 文本, chunk_index)，以內容雜湊產生穩定的 ID"""
+    for index, text in enumerate(chunks):
+        yield chunk_id(source, chunk_hash(text)), text, index
+
+class StagedVectors:
+    """新增文本塊的嵌入向量暫存檔：嵌入階段寫入，套用變更時依 ID 讀回，整份文件的向量不需留在記憶體中"""
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile(prefix="qabot-vectors-")
+        self._rows = {}
+        self._dim = None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, id_: str) -> bool:
+        return id_ in self._rows
+
+    def ids(self) -> List[str]:
+        return list(self._rows)
+
+    def add(self, ids: List[str], vectors: List[List[float]]):
+        array = np.asarray(vectors, dtype=np.float32)
+        self._dim = array.shape[1]
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(array.tobytes())
+        for id_ in ids:
+            self._rows[id_] = len(self._rows)
+
+    def get(self, ids: List[str]) -> np.ndarray:
+        row_bytes = self._dim * 4
+        vectors = np.empty((len(ids), self._dim), dtype=np.float32)
+        for i, id_ in enumerate(ids):
+            self._file.seek(self._rows[id_] * row_bytes)
+            vectors[i] = np.frombuffer(self._file.read(row_bytes), dtype=np.float32)
+        return vectors
+
+    def close(self):
+        self._file.close()
+
+def _estimate_total(chunks: Iterable[str], seen: int) -> int:
+    """處理中的文本塊總數：串流讀取的檔案依已讀取的比例估算"""
+    return chunks.estimate_total(seen) if isinstance(chunks, FileChunks) else len(chunks)
+
+def process_and_store_document(content: str, source: str, progress: Optional[Callable[[int, int], None]] = None) -> dict:
+    """處理並增量更新文件到向量庫（content 為完整的文件內容）"""
+    return process_and_store_chunks(text_splitter.split_text(content), source, progress)
+
+def process_and_store_chunks(chunks: Iterable[str], source: str, progress: Optional[Callable[[int, int], None]] = None) -> dict:
+    """處理並增量更新文件到向量庫
+    
+    以文件名稱（source）識別文件，只嵌入新增或變更的文本塊、依 ID 刪除已不存在的文本塊，
+    其他文件保持不變。chunks 需可重複迭代（例如 FileChunks，每次迭代重新串流讀取檔案），處理分兩次進行：
+    1. 逐塊比對並嵌入新增的文本塊，向量寫入暫存檔（此階段不修改向量庫，現有向量庫照常提供查詢）
+    2. 再次迭代 chunks，將新增的文本塊連同暫存的向量寫入向量庫，最後刪除已不存在的文本塊；
+       新增的文本塊寫入期間對查詢隱藏，寫完後才與已不存在的文本塊一次切換，查詢只會看到文件完整的舊版或新版
+    記憶體中只保留文本塊 ID 與位置，不保留整份文件的文本與向量。
+    progress(processed, total) 會在嵌入期間定期呼叫，用於回報處理進度（串流讀取時 total 為估計值）。
+    """
+    with _ingest_lock, _writable_index() as writer:
+        collection = writer.collection
         
-        print(f"成功儲存 {len(texts)} 個文本塊到向量庫，持久化目錄：{CHROMA_PERSIST_DIR}")
+        # 1. 此文件目前在向量庫中的文本塊
+        with span("ingest", "diff"):
+            existing = collection.get(where={"source": source}, include=["metadatas"])
+        existing_index = {
+            id_: (metadata or {}).get("chunk_index")
+            for id_, metadata in zip(existing["ids"], existing["metadatas"])
+        }
         
-        # 驗證儲存是否成功
+        # 2. 逐塊比對並嵌入新增的文本塊（同一文件內重複的文本塊只保留第一個）
+        positions = {}
+        staged = StagedVectors()
         try:
-            test_count = vectorstore._collection.count()
-            print(f"驗證：向量庫中實際文檔數量：{test_count}")
-        except Exception as e:
-            print(f"驗證向量庫時發生錯誤（但可能仍正常）：{e}")
+            embed_stats = _embed_new_chunks(chunks, source, existing_index, positions, staged, progress)
+            added = len(staged)
+            stale_ids = [id_ for id_ in existing_index if id_ not in positions]
+            # 內容未變但位置改變的文本塊只更新 metadata，不需重新嵌入
+            moved_ids = [
+                id_ for id_, index in existing_index.items()
+                if id_ in positions and index != positions[id_]
+            ]
             
-    except Exception as e:
-        error_msg = str(e)
-        print(f"儲存文件到向量庫時發生錯誤：{error_msg}")
-        
-        # 如果是權限錯誤，嘗試修復
-        if "readonly" in error_msg.lower() or "permission" in error_msg.lower():
-            print(f"檢測到權限錯誤，嘗試修復...")
-            try:
-                # 刪除目錄並重新創建
-                if os.path.exists(CHROMA_PERSIST_DIR):
-                    import stat
-                    def remove_readonly(func, path, exc):
-                        os.chmod(path, stat.S_IWRITE)
-                        func(path)
-                    shutil.rmtree(CHROMA_PERSIST_DIR, onerror=remove_readonly)
-                
-                ensure_chroma_directory()
-                
-                # 重試一次，使用 umask 確保文件創建時就有正確權限
-                print("重試儲存到向量庫...")
-                import stat
-                old_umask = os.umask(0o000)  # 允許所有權限
-                
+            # 3. 套用變更並同步更新 BM25 索引與向量索引
+            write_seconds = 0.0
+            index_seconds = 0.0
+            start = time.perf_counter()
+            removed_legacy = _remove_legacy_chunks(writer)
+            write_seconds += time.perf_counter() - start
+            new_ids = staged.ids()
+            if added:
+                writer.hide(new_ids)
                 try:
-                    vectorstore = Chroma.from_texts(
-                        texts=texts,
-                        embedding=embeddings,
-                        persist_directory=CHROMA_PERSIST_DIR,
-                        collection_name=COLLECTION_NAME
-                    )
-                finally:
-                    os.umask(old_umask)
-                
-                # 再次修復權限
-                import time
-                time.sleep(0.1)
-                if os.path.exists(CHROMA_PERSIST_DIR):
-                    for root, dirs, files in os.walk(CHROMA_PERSIST_DIR):
-                        for d in dirs:
-                            try:
-                                os.chmod(os.path.join(root, d), stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO)
-                            except:
-                                pass
-                        for f in files:
-                            try:
-                                os.chmod(os.path.join(root, f), stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH | stat.S_IWOTH)
-                            except:
-                                pass
-                
-                # 重新載入
-                vectorstore = Chroma(
-                    persist_directory=CHROMA_PERSIST_DIR,
-                    embedding_function=embeddings,
-                    collection_name=COLLECTION_NAME
-                )
-                
-                print(f"重試成功：儲存 {len(texts)} 個文本塊到向量庫")
-                return
-            except Exception as e2:
-                print(f"修復權限錯誤失敗：{e2}")
-                print(f"權限錯誤詳細信息：")
-                print(f"  目錄路徑：{CHROMA_PERSIST_DIR}")
-                print(f"  目錄存在：{os.path.exists(CHROMA_PERSIST_DIR)}")
-                if os.path.exists(CHROMA_PERSIST_DIR):
-                    try:
-                        stat_info = os.stat(CHROMA_PERSIST_DIR)
-                        print(f"  目錄權限：{oct(stat_info.st_mode)}")
-                    except:
-                        pass
-        raise
+                    write_seconds, index_seconds = _write_staged_chunks(chunks, source, writer, staged)
+                except BaseException:
+                    # 寫入中斷時移除已寫入的新文本塊，查詢繼續使用文件原本的內容
+                    writer.remove(new_ids)
+                    writer.hide(show=new_ids)
+                    raise
+            
+            start = time.perf_counter()
+            for i in range(0, len(moved_ids), _UPSERT_BATCH_SIZE):
+                batch = moved_ids[i:i + _UPSERT_BATCH_SIZE]
+                collection.update(ids=batch, metadatas=[chunk_metadata(source, id_, positions[id_]) for id_ in batch])
+            for id_ in moved_ids:
+                writer.lexical.update_metadata(id_, chunk_metadata(source, id_, positions[id_]))
+            # 一次切換為文件的新內容，再刪除已不存在的文本塊
+            writer.hide(stale_ids, show=new_ids)
+            writer.remove(stale_ids)
+            writer.hide(show=stale_ids)
+            write_seconds += time.perf_counter() - start
+            
+            start = time.perf_counter()
+            if added or stale_ids or removed_legacy:
+                writer.index.save()
+            index_seconds += time.perf_counter() - start
+            record_stage("ingest", "write", write_seconds)
+            record_stage("ingest", "index", index_seconds)
+        finally:
+            staged.close()
+        
+        writer.changed = bool(added or stale_ids or moved_ids or removed_legacy)
+    
+    if not positions:
+        print("警告：文本分割後為空")
+    stats = {
+        "chunks": len(positions),
+        "added": added,
+        "deleted": len(stale_ids),
+        "unchanged": len(positions) - added,
+        "chunks_per_sec": embed_stats["chunks_per_sec"],
+    }
+    print(f"文件 {source} 已更新到向量庫：{stats}")
+    return stats
 
-def get_rag_chain():
-    """獲取 RAG 鏈"""
-    global vectorstore
+def _embed_new_chunks(chunks: Iterable[str], source: str, existing_index: dict, positions: dict,
+                      staged: StagedVectors, progress: Optional[Callable[[int, int], None]]) -> dict:
+    """迭代文本塊，記錄每個 ID 的位置，並分批平行嵌入不在 existing_index 中的文本塊
     
-    if vectorstore is None:
-        initialize_vectorstore()
+    各批次在有限的工作執行緒中嵌入（共用同一個 HTTP 連線池），進行中的批次數有上限，
+    因此讀取檔案的速度不會超過嵌入的速度，記憶體中只有這些批次的文本。
+    """
+    embeddings = get_embeddings()
+    pending = []
+    in_flight = {}
+    unchanged = 0
+    split_seconds = 0.0
+    start = time.perf_counter()
+    
+    def report():
+        if progress is not None:
+            progress(unchanged + len(staged), _estimate_total(chunks, len(positions)))
     
-    # 檢查向量庫是否為空
+    def submit(batch):
+        future = pool.submit(embeddings.embed_documents, [text for _, text in batch])
+        in_flight[future] = [id_ for id_, _ in batch]
+    
+    def collect():
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            staged.add(in_flight.pop(future), future.result())
+        elapsed = time.perf_counter() - start
+        print(f"嵌入進度：{len(staged)} 個文本塊（{len(staged) / elapsed:.1f} 塊/秒）")
+        report()
+    
+    pool = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="embed")
     try:
-        # 方法1：嘗試直接訪問 collection 並檢查數量
-        try:
-            collection = vectorstore._collection
-            count = collection.count()
-            print(f"向量庫中文檔數量：{count}")
-            if count == 0:
-                return None
-        except AttributeError:
-            # 如果沒有 _collection 屬性，嘗試其他方法
-            print("無法訪問 _collection，嘗試其他檢查方法")
-            raise
+        report()
+        iterator = iter_chunk_ids(chunks, source)
+        while True:
+            split_start = time.perf_counter()
+            entry = next(iterator, None)
+            split_seconds += time.perf_counter() - split_start
+            if entry is None:
+                break
+            id_, text, index = entry
+            if id_ in positions:
+                continue
+            positions[id_] = index
+            if id_ in existing_index:
+                unchanged += 1
+                continue
+            pending.append((id_, text))
+            if len(pending) >= EMBED_BATCH_SIZE:
+                submit(pending)
+                pending = []
+                # 限制進行中的批次數，等待較早的批次完成後再繼續讀取
+                while len(in_flight) >= EMBED_WORKERS * 2:
+                    collect()
+        if pending:
+            submit(pending)
+        while in_flight:
+            collect()
+    finally:
+        # 發生錯誤時取消尚未開始的批次；已完成的嵌入保存在嵌入快取中，重試時不需重新計算
+        pool.shutdown(wait=True, cancel_futures=True)
+    
+    elapsed = time.perf_counter() - start
+    record_stage("ingest", "split", split_seconds)
+    record_stage("ingest", "embed", elapsed - split_seconds)
+    report()
+    return {
+        "embedded": len(staged),
+        "seconds": round(elapsed, 3),
+        "chunks_per_sec": round(len(staged) / elapsed, 1) if staged and elapsed > 0 else 0.0,
+    }
+
+def _write_staged_chunks(chunks: Iterable[str], source: str, writer: _IndexWriter, staged: StagedVectors) -> Tuple[float, float]:
+    """再次迭代文本塊，將已嵌入的新增文本塊分批寫入 Chroma、BM25 索引與向量索引，返回 (寫入秒數, 索引秒數)"""
+    write_seconds = 0.0
+    index_seconds = 0.0
+    written = set()
+    batch = []
+    
+    def flush():
+        nonlocal write_seconds, index_seconds
+        ids = [id_ for id_, _, _ in batch]
+        vectors = staged.get(ids)
+        metadatas = [chunk_metadata(source, id_, index) for id_, _, index in batch]
+        start = time.perf_counter()
+        writer.collection.upsert(
+            ids=ids,
+            embeddings=vectors.tolist(),
+            documents=[text for _, text, _ in batch],
+            metadatas=metadatas
+        )
+        write_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        for (id_, text, _), metadata in zip(batch, metadatas):
+            writer.lexical.add(id_, text, metadata)
+        writer.index.add(ids, vectors)
+        index_seconds += time.perf_counter() - start
+        batch.clear()
+    
+    for id_, text, index in iter_chunk_ids(chunks, source):
+        if id_ in staged and id_ not in written:
+            written.add(id_)
+            batch.append((id_, text, index))
+            if len(batch) >= _UPSERT_BATCH_SIZE:
+                flush()
+    if batch:
+        flush()
+    return write_seconds, index_seconds
+
+def delete_document_chunks(source: str) -> int:
+    """從向量庫刪除指定文件的所有文本塊"""
+    with _ingest_lock, _writable_index(create=False) as writer:
+        if writer is None:
+            return 0
         
-    except Exception as e:
-        # 方法2：使用 similarity_search 檢查
-        try:
-            print(f"使用 similarity_search 檢查向量庫：{e}")
-            results = vectorstore.similarity_search("test", k=1)
-            print(f"similarity_search 返回結果數量：{len(results) if results else 0}")
-            if not results or len(results) == 0:
-                return None
-        except Exception as e2:
-            # 如果兩種方法都失敗，返回 None
-            print(f"檢查向量庫時發生錯誤：{e2}")
-            return None
+        ids = writer.collection.get(where={"source": source}, include=[])["ids"]
+        if ids:
+            # 先一次隱藏整份文件，刪除期間查詢不會看到文件的一部分
+            writer.hide(ids)
+            writer.remove(ids)
+            writer.hide(show=ids)
+            writer.index.save()
+            writer.changed = True
+        print(f"已從向量庫刪除文件 {source} 的 {len(ids)} 個文本塊")
+        return len(ids)
+
+def current_index_version() -> Optional[int]:
+    """目前載入的索引版本（未啟用 SHARED_INDEX 或尚未載入時為 None）"""
+    return index_version
+
+def is_vectorstore_loaded() -> bool:
+    """向量庫是否已載入（包含確認為空的情況）"""
+    return chunk_count is not None
+
+def get_vectorstore():
+    """獲取可查詢的向量庫（尚未上傳文件或向量庫為空時返回 None）"""
+    if vectorstore is None:
+        initialize_vectorstore()
     
-    # 創建 Prompt 模板
-    prompt_template = """你是一個友善的客服助手。請根據以下提供的上下文資訊回答用戶的問題。
-如果你不知道答案，請誠實地說你不知道，不要編造資訊。
+    # 以記憶體中的文本塊數量判斷向量庫是否為空
+    if vectorstore is None or not chunk_count:
+        return None
+    return vectorstore
 
-上下文資訊：
-{context}
+def lexical_search(query: str, hidden: Optional[frozenset] = None) -> Tuple[List[str], float]:
+    """以 BM25 搜尋候選文本塊，返回 (文本塊 ID, 信心度)
+    
+    hidden 為查詢開始時取得的 _hidden_ids，同一次查詢的各階段以同一份判斷可見的文本塊（預設為目前的 _hidden_ids）。
+    """
+    hidden = _hidden_ids if hidden is None else hidden
+    ranked, confidence = lexical_index.search(query, HYBRID_CANDIDATES, exclude=hidden)
+    return [id_ for id_, _ in ranked], confidence
 
-問題：{question}
+def _with_similarity(results: List[Tuple[str, float]]) -> Tuple[List[str], float]:
+    """將 [(文本塊 ID, L2 距離的平方)] 轉為 (文本塊 ID, 第一名的餘弦相似度)
+    
+    問題與文本塊的嵌入都是單位向量，||q - x||² = 2 - 2cos，因此 cos = 1 - 距離的平方 / 2。
+    """
+    if not results:
+        return [], 0.0
+    return [id_ for id_, _ in results], 1.0 - results[0][1] / 2
 
-請用繁體中文回答："""
+def _visible(results: List[Tuple[str, float]], hidden: frozenset) -> List[Tuple[str, float]]:
+    """移除對查詢隱藏的文本塊，取前 HYBRID_CANDIDATES 個"""
+    if hidden:
+        results = [item for item in results if item[0] not in hidden]
+    return results[:HYBRID_CANDIDATES]
+
+def vector_search(embedding: List[float], hidden: Optional[frozenset] = None) -> Tuple[List[str], float]:
+    """以問題嵌入在向量索引中搜尋候選文本塊，返回 (文本塊 ID, 第一名的餘弦相似度)
     
-    PROMPT = PromptTemplate(
-        template=prompt_template,
-        input_variables=["context", "question"]
-    )
+    文本塊內容由 BM25 索引提供，不需從 Chroma 讀取。hidden 與 lexical_search 相同，隱藏的文本塊不列入結果。
+    """
+    hidden = _hidden_ids if hidden is None else hidden
+    n_results = min(HYBRID_CANDIDATES + len(hidden), chunk_count or 0)
+    if n_results <= 0 or vector_index is None:
+        return [], 0.0
+    return _with_similarity(_visible(vector_index.search_with_distances(embedding, n_results), hidden))
+
+def vector_search_many(embeddings: List[List[float]], hidden: Optional[frozenset] = None) -> List[Tuple[List[str], float]]:
+    """以多個問題嵌入一次搜尋向量索引（NumPy 以矩陣乘法、HNSW 以多執行緒一次處理整批查詢）"""
+    hidden = _hidden_ids if hidden is None else hidden
+    n_results = min(HYBRID_CANDIDATES + len(hidden), chunk_count or 0)
+    if n_results <= 0 or vector_index is None:
+        return [([], 0.0) for _ in embeddings]
+    return [
+        _with_similarity(_visible(results, hidden))
+        for results in vector_index.search_many_with_distances(embeddings, n_results)
+    ]
+
+def is_relevant(confidence: float, similarity: Optional[float] = None) -> bool:
+    """問題是否與客服資料相關：BM25 信心度達到 LEXICAL_RELEVANCE_THRESHOLD，
+    或向量檢索第一名的相似度達到 RELEVANCE_THRESHOLD（similarity 為 None 表示尚未向量檢索）
+    """
+    if LEXICAL_RELEVANCE_THRESHOLD <= 0 or confidence >= LEXICAL_RELEVANCE_THRESHOLD:
+        return True
+    return RELEVANCE_THRESHOLD > 0 and similarity is not None and similarity >= RELEVANCE_THRESHOLD
+
+def needs_vector_relevance() -> bool:
+    """BM25 信心度未達門檻時，是否還要以向量相似度判斷（否則不需嵌入即可直接回覆）"""
+    return LEXICAL_RELEVANCE_THRESHOLD > 0 and RELEVANCE_THRESHOLD > 0
+
+def chunk_documents(ids: List[str]) -> List[Document]:
+    """依文本塊 ID 取得 Document"""
+    documents = []
+    for id_ in ids:
+        entry = lexical_index.get(id_)
+        if entry is not None:
+            documents.append(Document(page_content=entry[0], metadata=entry[1]))
+    return documents
+
+def fuse_results(vector_ids: List[str], lexical_ids: List[str], k: int = RETRIEVER_K) -> List[Document]:
+    """以倒數排名融合向量與 BM25 的結果，取前 k 個文本塊"""
+    return chunk_documents(reciprocal_rank_fusion([vector_ids, lexical_ids], RRF_K)[:k])
+
+def format_history(turns: List[Tuple[str, str]]) -> str:
+    """將對話輪次格式化為 prompt 中的對話紀錄"""
+    return "\n".join(f"用戶：{user_message}\n客服：{bot_response}" for user_message, bot_response in turns)
+
+def build_prompt(question: str, docs: List, turns: Optional[List[Tuple[str, str]]] = None) -> str:
+    """組合 prompt（有先前對話時附上對話紀錄）
+
+    docs 先經 pack_context 合併相鄰文本塊、移除重複段落並限制在 token 預算內。
+    """
+    context = pack_context(docs)
+    if turns:
+        return conversation_prompt_template.format(context=context, history=format_history(turns), question=question)
+    return prompt_template.format(context=context, question=question)
+
+async def _aget_vectorstore():
+    """非同步獲取可查詢的向量庫（首次載入涉及磁碟 I/O，放到執行緒中執行）"""
+    store = vectorstore
+    if store is None or not chunk_count:
+        store = await asyncio.to_thread(get_vectorstore)
+    return store
+
+async def _alookup_or_retrieve(question: str) -> Tuple[Optional[str], Optional[List[float]], Optional[List]]:
+    """查詢答案快取，未命中時檢索相關文本塊
     
-    # 創建 RAG 鏈
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=get_llm(),
-        chain_type="stuff",
-        retriever=vectorstore.as_retriever(search_kwargs={"k": 3}),
-        chain_type_kwargs={"prompt": PROMPT},
-        return_source_documents=False,
-    )
+    返回 (answer, embedding, docs)：answer 不為 None 時可直接回覆（快取命中、尚未上傳文件或客服資料中沒有相關內容），
+    否則以 docs 生成回答，並以 embedding 寫入快取（走 BM25 快速路徑時 embedding 為 None）。
+    """
+    store = await _aget_vectorstore()
+    if store is None:
+        ANSWERS_TOTAL.labels("no_document").inc()
+        return NO_DOCUMENT_MESSAGE, None, None
+    # 檢索的各階段使用同一份隱藏清單，不會一半使用文件的舊內容、一半使用新內容
+    hidden = _hidden_ids
+    
+    # 1. 精確比對：不需要任何 Ollama 呼叫
+    with span("query", "answer_cache"):
+        cached = answer_cache.get(question)
+    if cached is not None:
+        ANSWERS_TOTAL.labels("exact_cache").inc()
+        return cached, None, None
+    
+    # 2. BM25 快速路徑：查詢詞都出現在同一文本塊時，不需呼叫嵌入（信心度必定達到相關度門檻）
+    with span("query", "lexical_search"):
+        lexical_ids, confidence = await asyncio.to_thread(lexical_search, question, hidden)
+    if lexical_ids and confidence >= LEXICAL_FAST_PATH_CONFIDENCE:
+        answer_cache.record_miss()
+        RETRIEVALS_TOTAL.labels("lexical").inc()
+        return None, None, chunk_documents(lexical_ids[:RETRIEVER_K])
+    # 未達相關度門檻且不以向量相似度判斷時，不需嵌入也不呼叫 LLM
+    if not is_relevant(confidence) and not needs_vector_relevance():
+        answer_cache.record_miss()
+        record_early_exit("out_of_scope")
+        return OUT_OF_SCOPE_MESSAGE, None, None
+    
+    # 3. 語意比對：重用檢索所需的問題嵌入
+    with span("query", "embed"):
+        embedding = await aembed_query(question)
+    with span("query", "semantic_cache"):
+        cached = answer_cache.get_similar(embedding)
+    if cached is not None:
+        ANSWERS_TOTAL.labels("semantic_cache").inc()
+        return cached, None, None
+    
+    # 4. 向量檢索：BM25 信心度與第一名文本塊的相似度都未達門檻時，不呼叫 LLM
+    RETRIEVALS_TOTAL.labels("hybrid").inc()
+    with span("query", "vector_search"):
+        vector_ids, similarity = await asyncio.to_thread(vector_search, embedding, hidden)
+    if not is_relevant(confidence, similarity):
+        record_early_exit("out_of_scope")
+        return OUT_OF_SCOPE_MESSAGE, None, None
     
-    return qa_chain
+    # 5. 與 BM25 結果融合
+    with span("query", "fuse"):
+        return None, embedding, fuse_results(vector_ids, lexical_ids)
 
-def query_rag(question: str) -> str:
-    """使用 RAG 查詢"""
-    qa_chain = get_rag_chain()
+def cache_answer(question: str, embedding: Optional[List[float]], answer: str, generation: int):
+    """寫入答案快取（生成期間向量庫已更新時不寫入，避免快取過期答案）"""
+    if answer and generation == vectorstore_generation:
+        answer_cache.put(question, embedding, answer)
+
+async def aretrieve_many(questions: List[str]) -> List[Tuple[Optional[str], Optional[List[float]], Optional[List], str]]:
+    """批次版的 _alookup_or_retrieve：BM25 在同一個執行緒中依序搜尋，需要嵌入的問題一次批次嵌入，
+    向量檢索以一次批次搜尋完成
+
+    返回每個問題的 (answer, embedding, docs, path)，path 為 intent、no_document、exact_cache、semantic_cache、
+    out_of_scope、lexical 或 hybrid。各階段耗時記錄在 batch pipeline 下（整批一筆），不影響單一查詢的延遲分布。
+    """
+    results = [None] * len(questions)
+    
+    # 0. 問候等固定回覆
+    remaining = []
+    for i, question in enumerate(questions):
+        reply = answer_intent(question)
+        if reply is not None:
+            results[i] = (reply, None, None, "intent")
+        else:
+            remaining.append(i)
+    if not remaining:
+        return results
+    
+    store = await _aget_vectorstore()
+    if store is None:
+        ANSWERS_TOTAL.labels("no_document").inc(len(remaining))
+        for i in remaining:
+            results[i] = (NO_DOCUMENT_MESSAGE, None, None, "no_document")
+        return results
+    hidden = _hidden_ids
+    
+    # 1. 精確比對
+    pending = []
+    with span("batch", "answer_cache"):
+        for i in remaining:
+            question = questions[i]
+            cached = answer_cache.get(question)
+            if cached is not None:
+                ANSWERS_TOTAL.labels("exact_cache").inc()
+                results[i] = (cached, None, None, "exact_cache")
+            else:
+                pending.append(i)
+    
+    # 2. BM25 快速路徑；未達相關度門檻且不以向量相似度判斷的問題直接回覆
+    with span("batch", "lexical_search"):
+        lexical = await asyncio.to_thread(lambda: [lexical_search(questions[i], hidden) for i in pending])
+    to_embed = []
+    for i, (lexical_ids, confidence) in zip(pending, lexical):
+        if lexical_ids and confidence >= LEXICAL_FAST_PATH_CONFIDENCE:
+            answer_cache.record_miss()
+            RETRIEVALS_TOTAL.labels("lexical").inc()
+            results[i] = (None, None, chunk_documents(lexical_ids[:RETRIEVER_K]), "lexical")
+        elif not is_relevant(confidence) and not needs_vector_relevance():
+            answer_cache.record_miss()
+            record_early_exit("out_of_scope")
+            results[i] = (OUT_OF_SCOPE_MESSAGE, None, None, "out_of_scope")
+        else:
+            to_embed.append((i, lexical_ids, confidence))
+    if not to_embed:
+        return results
+    
+    # 3. 批次嵌入後做語意比對
+    with span("batch", "embed"):
+        embeddings = await aembed_queries([questions[i] for i, _, _ in to_embed])
+    to_search = []
+    with span("batch", "semantic_cache"):
+        for (i, lexical_ids, confidence), embedding in zip(to_embed, embeddings):
+            cached = answer_cache.get_similar(embedding)
+            if cached is not None:
+                ANSWERS_TOTAL.labels("semantic_cache").inc()
+                results[i] = (cached, None, None, "semantic_cache")
+            else:
+                to_search.append((i, lexical_ids, confidence, embedding))
+    if not to_search:
+        return results
     
-    if qa_chain is None:
-        return "抱歉，目前還沒有上傳任何客服資料文件。請先上傳 .txt 格式的文件。"
+    # 4. 一次搜尋全部的問題嵌入，BM25 信心度與相似度都未達門檻的問題不呼叫 LLM，其餘與 BM25 結果融合
+    RETRIEVALS_TOTAL.labels("hybrid").inc(len(to_search))
+    with span("batch", "vector_search"):
+        vector_results = await asyncio.to_thread(
+            vector_search_many, [embedding for _, _, _, embedding in to_search], hidden
+        )
+    with span("batch", "fuse"):
+        for (i, lexical_ids, confidence, embedding), (ids, similarity) in zip(to_search, vector_results):
+            if not is_relevant(confidence, similarity):
+                record_early_exit("out_of_scope")
+                results[i] = (OUT_OF_SCOPE_MESSAGE, None, None, "out_of_scope")
+            else:
+                results[i] = (None, embedding, fuse_results(ids, lexical_ids), "hybrid")
+    return results
+
+async def aquery_rag(question: str, history: Optional[List[Tuple[str, str]]] = None, session_id: Optional[str] = None) -> str:
+    """使用 RAG 查詢（非同步版本，不阻塞事件迴圈）
     
+    Ollama 忙碌（生成佇列已滿或排隊逾時）時拋出 OllamaBusyError，由 API 回覆 HTTP 429。
+    """
     try:
-        result = qa_chain.invoke({"query": question})
-        return result.get("result", "抱歉，我無法生成回答。")
+        reply = answer_intent(question, history)
+        if reply is not None:
+            return reply
+        
+        generation = vectorstore_generation
+        turns = condense_history(history)
+        # 快取以檢索查詢為鍵：相同問題在不同對話脈絡下不會共用答案
+        search_query = build_search_query(question, turns)
+        answer, embedding, docs = await _alookup_or_retrieve(search_query)
+        if answer is not None:
+            return answer
+        
+        with span("query", "prompt"):
+            prompt = build_prompt(question, docs, turns)
+        answer = await agenerate(prompt, session_id)
+        ANSWERS_TOTAL.labels("generated").inc()
+        if not answer:
+            return "抱歉，我無法生成回答。"
+        cache_answer(search_query, embedding, answer, generation)
+        return answer
+    except OllamaBusyError:
+        raise
     except Exception as e:
+        ANSWERS_TOTAL.labels("error").inc()
         return f"處理問題時發生錯誤：{str(e)}"
 
+async def astream_rag(question: str, history: Optional[List[Tuple[str, str]]] = None, session_id: Optional[str] = None) -> AsyncIterator[str]:
+    """使用 RAG 查詢，檢索完成後逐段串流 LLM 回答（Ollama 忙碌時拋出 OllamaBusyError）
+    
+    輸出第一段回答前發生錯誤時以錯誤訊息作為回答；已輸出部分回答後才發生錯誤時拋出例外，由呼叫端通知用戶回答不完整。
+    """
+    tokens = []
+    try:
+        reply = answer_intent(question, history)
+        if reply is not None:
+            yield reply
+            return
+        
+        start = time.perf_counter()
+        generation = vectorstore_generation
+        turns = condense_history(history)
+        search_query = build_search_query(question, turns)
+        answer, embedding, docs = await _alookup_or_retrieve(search_query)
+        if answer is not None:
+            yield answer
+            return
+        
+        with span("query", "prompt"):
+            prompt = build_prompt(question, docs, turns)
+        
+        # 逐段輸出 Ollama 產生的 token
+        async for token in astream_generate(prompt, session_id):
+            if not tokens:
+                record_ttft(time.perf_counter() - start)
+            tokens.append(token)
+            yield token
+        ANSWERS_TOTAL.labels("generated").inc()
+        cache_answer(search_query, embedding, "".join(tokens), generation)
+    except OllamaBusyError:
+        raise
+    except Exception as e:
+        ANSWERS_TOTAL.labels("error").inc()
+        if tokens:
+            raise
+        yield f"處理問題時發生錯誤：{str(e)}"
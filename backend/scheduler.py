@@ -0,0 +1,200 @@
+"""Ollama 請求排程模組
+
+單機 Ollama 同時生成的請求越多，每個請求都越慢，且 CPU 上會互相搶佔記憶體頻寬。
+此模組在客戶端控制送往 Ollama 的請求：
+1. FairScheduler：限制同時生成的數量，等待中的請求依會話輪流取得名額（一個會話連續
+   發問不會佔滿佇列），佇列已滿或排隊逾時時拋出 OllamaBusyError（API 以 HTTP 429 回覆）
+2. EmbeddingBatcher：將極短時間窗內同時到達的查詢嵌入合併為一次批次呼叫
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, List, Optional
+
+# 記錄排隊等待時間的最近樣本數（用於計算百分位數）
+_WAIT_SAMPLES = 1000
+
+# 估算 Retry-After 時，生成耗時的指數移動平均權重
+_SERVICE_TIME_ALPHA = 0.2
+
+def _percentile(values: List[float], q: float) -> float:
+    """計算百分位數（values 需已排序）"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class OllamaBusyError(Exception):
+    """Ollama 忙碌：等待佇列已滿或排隊逾時，retry_after 為建議的重試秒數"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class FairScheduler:
+    """限制同時進行的請求數量，等待中的請求依 key 輪流（同一 key 內先到先得）取得名額"""
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # key -> 等待中的 future；取得名額的 key 移到最後
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._active = 0
+        self._waiting = 0
+        self._wait_times: Deque[float] = deque(maxlen=_WAIT_SAMPLES)
+        self._service_time: Optional[float] = None
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def retry_after(self) -> int:
+        """依目前排隊數與平均生成耗時估算佇列消化所需的秒數"""
+        service_time = self._service_time or 1.0
+        return max(1, math.ceil(service_time * (self._waiting + 1) / self.max_concurrency))
+
+    @asynccontextmanager
+    async def slot(self, key: Optional[str] = None):
+        """取得一個執行名額，離開時釋放並喚醒下一個等待者"""
+        start = time.monotonic()
+        await self._acquire(key or "")
+        self._wait_times.append(time.monotonic() - start)
+        self.admitted += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            if self._service_time is None:
+                self._service_time = elapsed
+            else:
+                self._service_time += _SERVICE_TIME_ALPHA * (elapsed - self._service_time)
+            self._release()
+
+    async def _acquire(self, key: str):
+        if self._active < self.max_concurrency and not self._waiting:
+            self._active += 1
+            return
+        if self._waiting >= self.max_queue:
+            self.rejected += 1
+            raise OllamaBusyError("伺服器忙碌中，請稍後再試", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(future)
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done():
+                # 逾時或取消的同時已取得名額：交給下一個等待者
+                self._release()
+            else:
+                future.cancel()
+                queue = self._queues.get(key)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    self._waiting -= 1
+                    if not queue:
+                        del self._queues[key]
+            if isinstance(e, asyncio.TimeoutError):
+                self.timed_out += 1
+                raise OllamaBusyError("排隊等待逾時，請稍後再試", self.retry_after())
+            raise
+
+    def _release(self):
+        """釋放名額：直接轉交給輪到的 key 的第一個等待者，沒有等待者時歸還"""
+        while self._queues:
+            key, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            self._waiting -= 1
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def stats(self) -> dict:
+        """佇列深度、執行中數量與排隊等待時間"""
+        waits = sorted(self._wait_times)
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "active": self._active,
+            "queue_depth": self._waiting,
+            "queued_sessions": len(self._queues),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms": {
+                "p50": round(_percentile(waits, 0.50) * 1000, 1),
+                "p95": round(_percentile(waits, 0.95) * 1000, 1),
+                "max": round(waits[-1] * 1000, 1) if waits else 0.0,
+            },
+            "avg_service_s": round(self._service_time, 3) if self._service_time is not None else None,
+        }
+
+class EmbeddingBatcher:
+    """將時間窗內同時到達的嵌入請求合併為一次 embed_batch(texts) 呼叫（相同文字只嵌入一次）"""
+
+    def __init__(self, embed_batch: Callable[[List[str]], Awaitable[List[List[float]]]], window: float, max_batch: int):
+        self.embed_batch = embed_batch
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.requests = 0
+        self.batches = 0
+        self.max_batch_size = 0
+
+    async def embed(self, text: str) -> List[float]:
+        """嵌入一段文字，等待所在的批次完成"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self.requests += 1
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        """送出目前累積的批次"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        self.max_batch_size = max(self.max_batch_size, len(texts))
+        try:
+            vectors = dict(zip(texts, await self.embed_batch(texts)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for text, future in batch:
+            if not future.done():
+                future.set_result(vectors[text])
+
+    def stats(self) -> dict:
+        """合併的請求數與批次大小"""
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+        }
@@ -0,0 +1,156 @@
+"""串流文本分割模組
+
+RecursiveCharacterTextSplitter 需要整份文件的字串，上傳數百 MB 的文件時記憶體會膨脹數倍。
+此模組逐段讀取並解碼上傳檔案，一邊讀取一邊切出文本塊：
+1. 依檔案開頭判斷編碼（UTF-8 或 Big5/cp950），個別無法解碼的位元組以 U+FFFD 取代，不讓整份文件失敗
+2. 依段落、換行、中英文句末標點（。！？!?）、子句標點與空白的優先順序選擇切點
+3. 相鄰文本塊保留約 chunk_overlap 個字元的重疊，重疊部分盡量從句子或詞的開頭開始
+"""
+import codecs
+import io
+import os
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# 依序嘗試的檔案編碼（cp950 為 Windows 上的 Big5）
+UPLOAD_ENCODINGS = [
+    encoding.strip() for encoding in os.getenv("UPLOAD_ENCODINGS", "utf-8,cp950").split(",") if encoding.strip()
+]
+
+# 每次讀取並解碼的字元數
+READ_BLOCK_CHARS = 256 * 1024
+
+# 判斷編碼時檢查的位元組數
+_DETECT_BYTES = 64 * 1024
+
+# 切點的優先順序：段落、換行、句末標點、子句標點、空白（同一組內取最後出現的位置）
+_SEPARATOR_GROUPS = [
+    ("\n\n",),
+    ("\n",),
+    ("。", "！", "？", "!", "?"),
+    ("；", ";", "，", ",", "、"),
+    (" ", "\t"),
+]
+
+# 重疊部分可以開始的位置（這些字元之後）
+_OVERLAP_BOUNDARIES = set("\n。！？!?；;，,、 \t")
+
+def detect_encoding(path: str, candidates: List[str] = UPLOAD_ENCODINGS) -> str:
+    """依檔案開頭判斷編碼：選擇無法解碼的位元組最少的編碼（相同時依 candidates 的順序）"""
+    with open(path, "rb") as f:
+        sample = f.read(_DETECT_BYTES)
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+
+    best, best_errors = candidates[0], None
+    for encoding in candidates:
+        # final=False：樣本結尾被截斷的多位元組字元不算錯誤
+        text = codecs.getincrementaldecoder(encoding)(errors="replace").decode(sample, final=False)
+        errors = text.count("\ufffd")
+        if best_errors is None or errors < best_errors:
+            best, best_errors = encoding, errors
+        if errors == 0:
+            break
+    return best
+
+class StreamingTextSplitter:
+    """以有限的緩衝區逐段切出文本塊（每塊最多 chunk_size 個字元）"""
+
+    def __init__(self, chunk_size: int = 500, chunk_overlap: int = 50):
+        if chunk_overlap >= chunk_size:
+            raise ValueError("chunk_overlap 必須小於 chunk_size")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def _find_cut(self, buffer: str, start: int) -> int:
+        """在 buffer[start:] 的前 chunk_size 個字元中選擇切點（start 到切點之間的文字成為一個文本塊）"""
+        limit = start + self.chunk_size
+        # 先只考慮不會產生過短文本塊的切點，都沒有時才接受較短的文本塊，仍沒有則在 chunk_size 處硬切
+        for minimum in (self.chunk_size // 4, 1):
+            for group in _SEPARATOR_GROUPS:
+                cut = max(
+                    (position + len(separator)
+                     for separator in group
+                     for position in [buffer.rfind(separator, start, limit)]
+                     if position >= start + minimum),
+                    default=0
+                )
+                if cut:
+                    return cut
+        return limit
+
+    def _overlap_start(self, buffer: str, start: int, cut: int) -> int:
+        """下一個文本塊的起點：從切點往前 chunk_overlap 個字元內的第一個句子或詞開頭開始"""
+        begin = max(cut - self.chunk_overlap, start + 1)
+        for position in range(begin, cut):
+            if buffer[position - 1] in _OVERLAP_BOUNDARIES:
+                return position
+        return begin
+
+    def split_stream(self, blocks: Iterable[str]) -> Iterator[str]:
+        """逐段讀取文字並切出文本塊（緩衝區只保留尚未切出的文字）"""
+        buffer = ""
+        # 下一個文本塊在 buffer 中的起點，以及已包含在上一個文本塊中的位置（重疊部分的結尾）
+        start = 0
+        emitted = 0
+        for block in blocks:
+            buffer = buffer[start:] + block
+            emitted -= start
+            start = 0
+            while len(buffer) - start > self.chunk_size:
+                cut = self._find_cut(buffer, start)
+                chunk = buffer[start:cut].strip()
+                if chunk:
+                    yield chunk
+                start = self._overlap_start(buffer, start, cut)
+                emitted = cut
+
+        # 剩下的文字若都已包含在上一個文本塊中則不再輸出
+        if buffer[max(emitted, start):].strip():
+            chunk = buffer[start:].strip()
+            if chunk:
+                yield chunk
+
+    def split_text(self, text: str) -> List[str]:
+        """分割完整的字串"""
+        return list(self.split_stream(
+            text[i:i + READ_BLOCK_CHARS] for i in range(0, len(text), READ_BLOCK_CHARS)
+        ))
+
+def read_text_blocks(path: str, encoding: str) -> Iterator[Tuple[str, int]]:
+    """逐段讀取並解碼檔案，返回 (文字, 目前已讀取的位元組數)；換行統一為 \\n"""
+    with open(path, "rb") as raw:
+        text_file = io.TextIOWrapper(raw, encoding=encoding, errors="replace", newline=None)
+        while True:
+            block = text_file.read(READ_BLOCK_CHARS)
+            if not block:
+                break
+            yield block, raw.tell()
+
+class FileChunks:
+    """檔案的文本塊來源：每次迭代都重新串流讀取檔案，可重複迭代且記憶體用量固定"""
+
+    def __init__(self, path: str, splitter: StreamingTextSplitter, encoding: Optional[str] = None):
+        self.path = path
+        self.splitter = splitter
+        self.encoding = encoding or detect_encoding(path)
+        self.size = os.path.getsize(path)
+        self.bytes_read = 0
+        # 無法解碼而以 U+FFFD 取代的字元數（最近一次迭代）
+        self.replaced = 0
+
+    def _blocks(self) -> Iterator[str]:
+        self.bytes_read = 0
+        self.replaced = 0
+        for block, position in read_text_blocks(self.path, self.encoding):
+            self.bytes_read = position
+            self.replaced += block.count("\ufffd")
+            yield block
+
+    def __iter__(self) -> Iterator[str]:
+        return self.splitter.split_stream(self._blocks())
+
+    def estimate_total(self, seen: int) -> int:
+        """依已讀取的位元組比例估算文本塊總數（迭代中使用）"""
+        if not self.bytes_read or self.bytes_read >= self.size:
+            return seen
+        return max(seen, round(seen * self.size / self.bytes_read))
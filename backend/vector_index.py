@@ -0,0 +1,389 @@
+"""可替換的向量索引模組
+
+Chroma 仍是文本塊與嵌入的持久化來源，查詢時則可改用行程內的索引，省去 Chroma 的 SQLite 與持久化層：
+- chroma：直接查詢 Chroma collection（預設）
+- numpy：記憶體映射的連續 float32 矩陣，以矩陣乘法暴力計算 top-k，適合數萬個文本塊以內的語料
+- hnsw：hnswlib 近似最近鄰索引，適合更大的語料（只有此後端需要匯入 hnswlib）
+三者都以 L2 距離排序，與 Chroma 預設的距離一致。
+"""
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import threading
+import json
+import os
+
+# 向量索引後端：chroma、numpy 或 hnsw
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma").lower()
+
+# 行程內索引的儲存目錄（與 chroma_db 放在同一目錄）
+VECTOR_INDEX_DIR = os.getenv(
+    "VECTOR_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "vector_index")
+)
+
+# HNSW 參數：每個節點的連結數、建立索引與查詢時的候選數
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF = int(os.getenv("HNSW_EF", "128"))
+
+# 已刪除的列超過此比例時，儲存 NumPy 索引時順便壓縮檔案
+_COMPACT_RATIO = 0.25
+
+# NumPy 索引批次搜尋時每次計算距離的查詢數
+_SEARCH_BATCH_SIZE = 256
+
+def _write_json(path: str, data):
+    """先寫入暫存檔再取代，避免中途失敗留下不完整的檔案"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+class VectorIndex(ABC):
+    """向量索引介面：以文本塊 ID 新增、刪除向量，並以 L2 距離搜尋最近的 k 個文本塊
+
+    子類別須實作所有抽象方法，缺少任何一個時在建立索引時即失敗，而不是等到第一次查詢。
+    """
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """索引中的文本塊數量"""
+
+    def is_synced(self, count: int) -> bool:
+        """索引是否與 Chroma 中的文本塊數量一致（不一致時需從 Chroma 重建）"""
+        return len(self) == count
+
+    def search(self, embedding: List[float], k: int) -> List[str]:
+        return [id_ for id_, _ in self.search_with_distances(embedding, k)]
+
+    def search_many(self, embeddings: List[List[float]], k: int) -> List[List[str]]:
+        """一次搜尋多個查詢向量（批次處理大量問題時使用），返回每個查詢的文本塊 ID"""
+        return [[id_ for id_, _ in results] for results in self.search_many_with_distances(embeddings, k)]
+
+    @abstractmethod
+    def search_with_distances(self, embedding: List[float], k: int) -> List[Tuple[str, float]]:
+        """搜尋最近的 k 個文本塊，返回 [(文本塊 ID, L2 距離的平方)]，依距離由近到遠排列"""
+
+    def search_many_with_distances(self, embeddings: List[List[float]], k: int) -> List[List[Tuple[str, float]]]:
+        """一次搜尋多個查詢向量，返回每個查詢的 [(文本塊 ID, L2 距離的平方)]"""
+        return [self.search_with_distances(embedding, k) for embedding in embeddings]
+
+    @abstractmethod
+    def add(self, ids: List[str], vectors: np.ndarray):
+        """新增（或取代）文本塊的向量"""
+
+    @abstractmethod
+    def remove(self, ids: List[str]):
+        """刪除文本塊的向量（不存在的 ID 直接略過）"""
+
+    @abstractmethod
+    def clear(self):
+        """刪除所有向量"""
+
+    def save(self):
+        """將變更寫入磁碟"""
+
+class ChromaVectorIndex(VectorIndex):
+    """直接查詢 Chroma collection（文本塊已由呼叫端寫入 Chroma，新增與刪除皆不需額外處理）"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __len__(self) -> int:
+        return self.collection.count()
+
+    def is_synced(self, count: int) -> bool:
+        return True
+
+    def search_with_distances(self, embedding: List[float], k: int) -> List[Tuple[str, float]]:
+        return self.search_many_with_distances([embedding], k)[0]
+
+    def search_many_with_distances(self, embeddings: List[List[float]], k: int) -> List[List[Tuple[str, float]]]:
+        if not embeddings:
+            return []
+        # collection 使用預設的 l2 空間，返回的距離即為 L2 距離的平方
+        result = self.collection.query(
+            query_embeddings=[list(map(float, embedding)) for embedding in embeddings], n_results=k,
+            include=["distances"]
+        )
+        return [list(zip(ids, distances)) for ids, distances in zip(result["ids"], result["distances"])]
+
+    def add(self, ids: List[str], vectors: np.ndarray):
+        pass
+
+    def remove(self, ids: List[str]):
+        pass
+
+    def clear(self):
+        pass
+
+class NumpyVectorIndex(VectorIndex):
+    """記憶體映射的 float32 矩陣，暴力計算所有距離後取 top-k（結果精確）
+
+    新增的向量直接附加到檔案尾端，刪除只標記該列，已刪除的列過多時才重寫檔案。
+    """
+
+    def __init__(self, directory: str = VECTOR_INDEX_DIR):
+        self.directory = directory
+        self._vectors_path = os.path.join(directory, "vectors.f32")
+        self._norms_path = os.path.join(directory, "norms.f32")
+        self._ids_path = os.path.join(directory, "ids.json")
+        self._lock = threading.Lock()
+        self.dim = None
+        # 每一列對應的文本塊 ID（已刪除的列為 None）
+        self._ids: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}
+        self._matrix = None
+        # 各列的平方範數，已刪除的列為 inf，使其距離永遠最遠
+        self._sq_norms = np.zeros(0, dtype=np.float32)
+        self._load()
+
+    def _load(self):
+        """從磁碟載入（只映射向量檔案，不讀入記憶體）"""
+        if not os.path.exists(self._ids_path):
+            return
+        with open(self._ids_path, encoding="utf-8") as f:
+            data = json.load(f)
+        ids, dim = data["ids"], data["dim"]
+        row_bytes = dim * 4 if dim else 0
+        # 附加向量後尚未寫入 ids.json 就中斷時，檔案大小會不一致，視為需要重建
+        if (not os.path.exists(self._vectors_path)
+                or os.path.getsize(self._vectors_path) != len(ids) * row_bytes
+                or os.path.getsize(self._norms_path) != len(ids) * 4):
+            print("NumPy 向量索引檔案不完整，將從 Chroma 重建")
+            return
+        self.dim = dim
+        self._ids = ids
+        self._rows = {id_: row for row, id_ in enumerate(ids) if id_ is not None}
+        self._sq_norms = np.fromfile(self._norms_path, dtype=np.float32)
+        self._sq_norms[[row for row, id_ in enumerate(ids) if id_ is None]] = np.inf
+        self._remap()
+
+    def _remap(self):
+        if self._ids:
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(len(self._ids), self.dim))
+        else:
+            self._matrix = None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def search_with_distances(self, embedding: List[float], k: int) -> List[Tuple[str, float]]:
+        with self._lock:
+            matrix, sq_norms, ids, live = self._matrix, self._sq_norms, self._ids, len(self._rows)
+        k = min(k, live)
+        if matrix is None or k <= 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        # ||q - x||² = ||x||² - 2 q·x + ||q||²，排序時不需要 ||q||²，只在返回的 k 個距離加上
+        distances = sq_norms - 2 * (matrix @ query)
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        query_sq_norm = float(query @ query)
+        return [(ids[row], float(distances[row]) + query_sq_norm) for row in top]
+
+    def search_many_with_distances(self, embeddings: List[List[float]], k: int) -> List[List[Tuple[str, float]]]:
+        with self._lock:
+            matrix, sq_norms, ids, live = self._matrix, self._sq_norms, self._ids, len(self._rows)
+        k = min(k, live)
+        if matrix is None or k <= 0:
+            return [[] for _ in embeddings]
+        results = []
+        # 分批計算距離矩陣，限制 查詢數 × 文本塊數 的暫存大小
+        for start in range(0, len(embeddings), _SEARCH_BATCH_SIZE):
+            queries = np.asarray(embeddings[start:start + _SEARCH_BATCH_SIZE], dtype=np.float32)
+            distances = sq_norms[None, :] - 2 * (queries @ matrix.T)
+            top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            order = np.argsort(np.take_along_axis(distances, top, axis=1), axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+            top_distances = np.take_along_axis(distances, top, axis=1) + np.einsum("ij,ij->i", queries, queries)[:, None]
+            for rows, row_distances in zip(top, top_distances):
+                results.append([(ids[row], float(distance)) for row, distance in zip(rows, row_distances)])
+        return results
+
+    def add(self, ids: List[str], vectors: np.ndarray):
+        if not ids:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                os.makedirs(self.directory, exist_ok=True)
+                open(self._vectors_path, "wb").close()
+                open(self._norms_path, "wb").close()
+            self._remove([id_ for id_ in ids if id_ in self._rows])
+            sq_norms = np.einsum("ij,ij->i", vectors, vectors).astype(np.float32)
+            with open(self._vectors_path, "ab") as f:
+                vectors.tofile(f)
+            with open(self._norms_path, "ab") as f:
+                sq_norms.tofile(f)
+            start = len(self._ids)
+            self._ids = self._ids + list(ids)
+            self._rows.update({id_: start + i for i, id_ in enumerate(ids)})
+            self._sq_norms = np.concatenate([self._sq_norms, sq_norms])
+            self._remap()
+
+    def remove(self, ids: List[str]):
+        with self._lock:
+            self._remove(ids)
+
+    def _remove(self, ids: List[str]):
+        rows = [self._rows.pop(id_) for id_ in ids if id_ in self._rows]
+        if rows:
+            # 複製後再修改，搜尋中的執行緒仍使用舊的陣列
+            self._ids = list(self._ids)
+            self._sq_norms = self._sq_norms.copy()
+            for row in rows:
+                self._ids[row] = None
+                self._sq_norms[row] = np.inf
+
+    def clear(self):
+        with self._lock:
+            self.dim = None
+            self._ids = []
+            self._rows = {}
+            self._sq_norms = np.zeros(0, dtype=np.float32)
+            self._matrix = None
+            for path in (self._vectors_path, self._norms_path, self._ids_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def save(self):
+        with self._lock:
+            if self.dim is None:
+                return
+            deleted = len(self._ids) - len(self._rows)
+            if deleted and deleted > len(self._ids) * _COMPACT_RATIO:
+                self._compact()
+            _write_json(self._ids_path, {"dim": self.dim, "ids": self._ids})
+
+    def _compact(self):
+        """重寫檔案，移除已刪除的列"""
+        live = [row for row, id_ in enumerate(self._ids) if id_ is not None]
+        vectors = np.asarray(self._matrix[live]) if live else np.zeros((0, self.dim), dtype=np.float32)
+        sq_norms = self._sq_norms[live]
+        for path, data in ((self._vectors_path, vectors), (self._norms_path, sq_norms)):
+            data.tofile(f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+        self._ids = [self._ids[row] for row in live]
+        self._rows = {id_: row for row, id_ in enumerate(self._ids)}
+        self._sq_norms = sq_norms
+        self._remap()
+
+class HnswVectorIndex(VectorIndex):
+    """hnswlib 近似最近鄰索引，查詢時間隨語料大小呈對數成長"""
+
+    def __init__(self, directory: str = VECTOR_INDEX_DIR, M: int = HNSW_M,
+                 ef_construction: int = HNSW_EF_CONSTRUCTION, ef: int = HNSW_EF):
+        self.directory = directory
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self._index_path = os.path.join(directory, "hnsw.bin")
+        self._labels_path = os.path.join(directory, "hnsw_labels.json")
+        self._lock = threading.Lock()
+        self._index = None
+        self._labels: Dict[str, int] = {}
+        self._ids: Dict[int, str] = {}
+        self._next_label = 0
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(self._index_path) and os.path.exists(self._labels_path)):
+            return
+        with open(self._labels_path, encoding="utf-8") as f:
+            data = json.load(f)
+        import hnswlib
+        index = hnswlib.Index(space="l2", dim=data["dim"])
+        index.load_index(self._index_path, allow_replace_deleted=True)
+        self._index = index
+        self._labels = data["labels"]
+        self._ids = {label: id_ for id_, label in self._labels.items()}
+        self._next_label = data["next_label"]
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def search_with_distances(self, embedding: List[float], k: int) -> List[Tuple[str, float]]:
+        return self.search_many_with_distances([embedding], k)[0]
+
+    def search_many_with_distances(self, embeddings: List[List[float]], k: int) -> List[List[Tuple[str, float]]]:
+        with self._lock:
+            k = min(k, len(self))
+            if self._index is None or k <= 0 or not embeddings:
+                return [[] for _ in embeddings]
+            self._index.set_ef(max(self.ef, k))
+            # hnswlib 以多個執行緒平行搜尋整批查詢；l2 空間返回的距離即為 L2 距離的平方
+            labels, distances = self._index.knn_query(np.asarray(embeddings, dtype=np.float32), k=k)
+            return [
+                [(self._ids[int(label)], float(distance)) for label, distance in zip(row, row_distances)]
+                for row, row_distances in zip(labels, distances)
+            ]
+
+    def add(self, ids: List[str], vectors: np.ndarray):
+        if not ids:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self._index is None:
+                import hnswlib
+                self._index = hnswlib.Index(space="l2", dim=vectors.shape[1])
+                self._index.init_index(
+                    max_elements=max(len(ids), 1024), M=self.M,
+                    ef_construction=self.ef_construction, allow_replace_deleted=True
+                )
+            self._remove([id_ for id_ in ids if id_ in self._labels])
+            needed = self._index.get_current_count() + len(ids)
+            if needed > self._index.get_max_elements():
+                self._index.resize_index(max(needed, self._index.get_max_elements() * 2))
+            labels = np.arange(self._next_label, self._next_label + len(ids))
+            self._next_label += len(ids)
+            self._index.add_items(vectors, labels, replace_deleted=True)
+            for id_, label in zip(ids, labels.tolist()):
+                self._labels[id_] = label
+                self._ids[label] = id_
+
+    def remove(self, ids: List[str]):
+        with self._lock:
+            self._remove(ids)
+
+    def _remove(self, ids: List[str]):
+        for id_ in ids:
+            label = self._labels.pop(id_, None)
+            if label is not None:
+                del self._ids[label]
+                self._index.mark_deleted(label)
+
+    def clear(self):
+        with self._lock:
+            self._index = None
+            self._labels = {}
+            self._ids = {}
+            self._next_label = 0
+            for path in (self._index_path, self._labels_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def save(self):
+        with self._lock:
+            if self._index is None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._index.save_index(f"{self._index_path}.tmp")
+            os.replace(f"{self._index_path}.tmp", self._index_path)
+            _write_json(self._labels_path, {
+                "dim": self._index.dim,
+                "next_label": self._next_label,
+                "labels": self._labels
+            })
+
+def create_vector_index(collection, backend: str = VECTOR_BACKEND, directory: str = VECTOR_INDEX_DIR) -> VectorIndex:
+    """依設定建立向量索引"""
+    if backend == "numpy":
+        return NumpyVectorIndex(directory)
+    if backend == "hnsw":
+        return HnswVectorIndex(directory)
+    if backend != "chroma":
+        print(f"未知的向量索引後端 {backend}，改用 chroma")
+    return ChromaVectorIndex(collection)
@@ -0,0 +1,100 @@
+"""啟動預熱與就緒狀態模組
+
+後端啟動時不再於匯入階段載入向量庫與模型，行程很快就能回應（GET / 表示行程已啟動）。
+啟動後在背景載入向量庫與索引、建立嵌入模型並讓 Ollama 載入模型，
+完成後 GET /ready 才返回 200，負載平衡器或自動擴展可依此決定何時導入流量。
+之後定期以固定的 prompt 開頭呼叫 Ollama，讓閒置期間模型不被卸載、KV 快取保有這段開頭。
+"""
+import asyncio
+import os
+import time
+
+import httpx
+
+from backend.rag import get_vectorstore, is_vectorstore_loaded, current_index_version, PROMPT_PREFIX
+from backend.index_store import worker_id
+from backend.ollama_client import awarm_models, aload_models, generation_scheduler
+
+# 啟動後是否在背景預熱（0 表示停用：向量庫與模型在首次查詢時才載入，/ready 只檢查資料庫）
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "1") != "0"
+
+# 模型預熱失敗（例如 Ollama 尚未啟動）時的重試間隔（秒）
+WARMUP_RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", "5"))
+
+# 定期預熱的間隔（秒，應小於 OLLAMA_KEEP_ALIVE；0 表示停用）；期間已有生成請求時略過該次
+WARMUP_PING_INTERVAL = float(os.getenv("WARMUP_PING_INTERVAL", "240"))
+
+# 資料庫初始化與模型預熱是否完成（向量庫是否載入由 rag 模組判斷）
+_database_ready = False
+_models_ready = False
+
+# 各項預熱的耗時（秒）
+_durations = {}
+
+def mark_database_ready():
+    """資料庫已初始化"""
+    global _database_ready
+    _database_ready = True
+
+async def _warm_index():
+    start = time.perf_counter()
+    await asyncio.to_thread(get_vectorstore)
+    _durations["index"] = round(time.perf_counter() - start, 3)
+    print(f"向量庫預熱完成，耗時 {_durations['index']:.2f} 秒")
+
+async def _warm_models():
+    global _models_ready
+    start = time.perf_counter()
+    while True:
+        try:
+            await awarm_models(PROMPT_PREFIX)
+            break
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Ollama 模型預熱失敗：{e}，{WARMUP_RETRY_INTERVAL:g} 秒後重試")
+            await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+    _models_ready = True
+    _durations["models"] = round(time.perf_counter() - start, 3)
+    print(f"Ollama 模型預熱完成，耗時 {_durations['models']:.2f} 秒")
+
+async def run_warmup():
+    """同時載入向量庫與預熱模型（在背景 task 中執行）"""
+    await asyncio.gather(_warm_index(), _warm_models())
+
+async def run_keep_warm():
+    """定期讓 Ollama 保持模型載入並重新評估固定的 prompt 開頭（最近有生成請求時不需要）"""
+    admitted = generation_scheduler.admitted
+    while True:
+        await asyncio.sleep(WARMUP_PING_INTERVAL)
+        if generation_scheduler.admitted != admitted:
+            admitted = generation_scheduler.admitted
+            continue
+        try:
+            await aload_models(PROMPT_PREFIX)
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Ollama 定期預熱失敗：{e}")
+
+def start_warmup() -> asyncio.Task:
+    """在背景開始預熱"""
+    return asyncio.get_running_loop().create_task(run_warmup())
+
+def start_keep_warm() -> asyncio.Task:
+    """在背景開始定期預熱"""
+    return asyncio.get_running_loop().create_task(run_keep_warm())
+
+def readiness() -> dict:
+    """就緒狀態：停用預熱時只要求資料庫已初始化"""
+    checks = {
+        "database": _database_ready,
+        "index": is_vectorstore_loaded(),
+        "models": _models_ready,
+    }
+    required = ["database", "index", "models"] if STARTUP_WARMUP else ["database"]
+    return {
+        "ready": all(checks[name] for name in required),
+        "warmup": STARTUP_WARMUP,
+        "checks": checks,
+        "warmup_s": dict(_durations),
+        # 多個 worker 時可確認各 worker 已切換到相同的索引版本
+        "worker": worker_id(),
+        "index_version": current_index_version(),
+    }
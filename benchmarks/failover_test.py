@@ -0,0 +1,104 @@
+"""多個 Ollama 節點的負載平衡與故障轉移測試
+
+啟動數個模擬 Ollama 伺服器（其中一個生成較慢）與後端，分三個階段發送 /chat 請求：
+1. 全部節點正常：觀察各節點分到的生成請求數（較慢的節點進行中的請求較多，分到的較少）
+2. 一個節點故障（所有請求返回 503）：請求改送其他節點，節點在連續失敗後被暫停使用
+3. 節點恢復：健康檢查確認後重新加入
+
+使用方式：
+    python -m benchmarks.failover_test --nodes 3 --requests 48 --concurrency 8
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from benchmarks.harness import PROJECT_DIR, run_app, upload_file
+from benchmarks.load_test import QUESTIONS
+
+# 後端在生成失敗時返回的回答開頭
+ERROR_PREFIX = "處理問題時發生錯誤"
+
+async def run_phase(base_url: str, concurrency: int, total: int) -> dict:
+    """以指定並發數發送 total 個 /chat 請求，統計失敗的回答"""
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=600.0) as client:
+        async def one(i: int):
+            nonlocal errors
+            async with semaphore:
+                response = await client.post("/chat", json={"message": QUESTIONS[i % len(QUESTIONS)]})
+                if response.status_code != 200 or response.json()["response"].startswith(ERROR_PREFIX):
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+    return {"requests": total, "errors": errors, "elapsed_s": round(elapsed, 3)}
+
+def chat_counts(servers) -> list:
+    return [server.request_counts.get("/api/chat", 0) for server in servers]
+
+def node_health(base_url: str) -> list:
+    nodes = httpx.get(f"{base_url}/scheduler/stats").json()["nodes"]["generate"]
+    return [node["healthy"] for node in nodes]
+
+def main():
+    parser = argparse.ArgumentParser(description="多個 Ollama 節點的負載平衡與故障轉移測試")
+    parser.add_argument("--nodes", type=int, default=3, help="模擬 Ollama 節點數")
+    parser.add_argument("--requests", type=int, default=48, help="每個階段的請求數")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--token-latency", type=float, default=0.02, help="一般節點每個 token 的延遲（秒）")
+    parser.add_argument("--slow-factor", type=float, default=4.0, help="最後一個節點的生成延遲倍數")
+    parser.add_argument("--health-interval", type=float, default=1.0, help="後端健康檢查間隔（秒）")
+    parser.add_argument("--corpus", default=os.path.join(PROJECT_DIR, "test_data.txt"))
+    parser.add_argument("--output", help="將結果寫入 JSON 檔案")
+    args = parser.parse_args()
+
+    servers = [
+        FakeOllamaServer(token_latency=args.token_latency * (args.slow_factor if i == args.nodes - 1 else 1)).start()
+        for i in range(args.nodes)
+    ]
+    failing = servers[0]
+    env = {
+        "ANSWER_CACHE_SIZE": "0",
+        "OLLAMA_HEALTH_INTERVAL": str(args.health_interval),
+    }
+    results = []
+    try:
+        with run_app(",".join(server.url for server in servers), env=env) as base_url:
+            upload_file(base_url, args.corpus)
+
+            def phase(name: str):
+                before = chat_counts(servers)
+                result = asyncio.run(run_phase(base_url, args.concurrency, args.requests))
+                result["phase"] = name
+                result["chat_requests"] = [after - prior for after, prior in zip(chat_counts(servers), before)]
+                result["healthy"] = node_health(base_url)
+                results.append(result)
+                print(
+                    f"{name}：錯誤 {result['errors']}/{result['requests']}，耗時 {result['elapsed_s']:.2f} s，"
+                    f"各節點生成請求 {result['chat_requests']}，健康狀態 {result['healthy']}"
+                )
+
+            phase("全部正常")
+            failing.set_available(False)
+            phase("節點 0 故障")
+            failing.set_available(True)
+            time.sleep(args.health_interval * 2 + 0.5)
+            phase("節點 0 恢復")
+    finally:
+        for server in servers:
+            server.stop()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"nodes": args.nodes, "results": results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""模擬 Ollama 的本地 HTTP 伺服器（用於壓力測試與效能基準）
+
+回應內容固定且可重現：嵌入向量由字元二元組雜湊產生，生成的回答為固定的 token 序列，
+每個 token 之間依設定的延遲輸出，用來模擬 CPU 上的 qwen2.5 生成速度。
+
+也模擬 Ollama 的模型載入與 KV 快取：模型閒置超過 keep_alive 或 num_ctx 改變時重新載入
+（load_latency），prompt 與最近幾個 prompt 相同的開頭不需重新評估，只有其餘字元
+依 prompt_char_latency 計算評估時間並回報於 prompt_eval_count。
+
+使用方式：
+    python -m benchmarks.fake_ollama --port 11434 --token-latency 0.05
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List
+
+# 預設回答的 token 序列
+DEFAULT_TOKENS = ["根據", "客服", "資料", "，", "您的", "問題", "答案", "如下", "。"]
+
+# 未指定 keep_alive 時 Ollama 保留模型的秒數
+DEFAULT_KEEP_ALIVE = 300.0
+
+def parse_keep_alive(value) -> float:
+    """將 Ollama 的 keep_alive（秒數或 "30m"、"1h" 等字串，負數表示永久）轉為秒數"""
+    if value is None:
+        return DEFAULT_KEEP_ALIVE
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        match = re.fullmatch(r"\s*(-?\d+(?:\.\d+)?)\s*(ms|s|m|h)?\s*", str(value))
+        if not match:
+            return DEFAULT_KEEP_ALIVE
+        seconds = float(match.group(1)) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600, None: 1}[match.group(2)]
+    return math.inf if seconds < 0 else seconds
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    """以字元二元組雜湊產生可重現的單位向量（相近的文字會得到相近的向量）"""
+    vector = [0.0] * dim
+    grams = [text[i:i + 2] for i in range(max(len(text) - 1, 1))]
+    for gram in grams:
+        digest = hashlib.md5(gram.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dim
+        vector[index] += 1.0 if digest[4] % 2 == 0 else -1.0
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    """處理 /api/embeddings、/api/embed、/api/chat、/api/generate 與 /api/tags"""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # 關閉 Nagle 演算法，避免 keep-alive 連線上的標頭與內容分段造成延遲
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data: dict, status: int = 200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: dict):
+        line = (json.dumps(data, ensure_ascii=False) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def _unavailable(self) -> bool:
+        """模擬故障的節點：所有請求返回 503"""
+        if self.server.config["available"]:
+            return False
+        self._send_json({"error": "server unavailable"}, status=503)
+        return True
+
+    def do_GET(self):
+        if self._unavailable():
+            return
+        if self.path.rstrip("/") == "/api/tags":
+            self._send_json({"models": [{"name": "fake"}]})
+        else:
+            self._send_json({"status": "ok"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.rstrip("/")
+        config = self.server.config
+        if self._unavailable():
+            return
+        self.server.record_request(path)
+
+        if path == "/api/embeddings":
+            time.sleep(config["embed_latency"])
+            self._send_json({"embedding": fake_embedding(body.get("prompt", ""), config["dim"])})
+        elif path == "/api/embed":
+            inputs = body.get("input", [])
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            time.sleep(config["embed_latency"])
+            self._send_json({"embeddings": [fake_embedding(text, config["dim"]) for text in inputs]})
+        elif path in ("/api/chat", "/api/generate"):
+            self._generate(path, body, config)
+        else:
+            self._send_json({"error": f"unknown endpoint {path}"}, status=404)
+
+    def _generate(self, path: str, body: dict, config: dict):
+        """依設定的延遲逐一輸出 token"""
+        tokens = config["tokens"]
+        prompt = body.get("prompt") or "".join(m.get("content", "") for m in body.get("messages", []))
+        options = body.get("options") or {}
+        time.sleep(self.server.load_model(body.get("model"), body.get("keep_alive"), options.get("num_ctx")))
+        if path == "/api/generate" and not prompt:
+            # 空白 prompt 只載入模型（預熱），不生成內容
+            self._send_json({"model": body.get("model"), "response": "", "done": True, "done_reason": "load"})
+            return
+        if options.get("num_predict", -1) > 0:
+            tokens = tokens[:options["num_predict"]]
+        prompt_eval_count = len(prompt) - self.server.cached_prefix(prompt)
+        prompt_eval_seconds = config["prompt_eval_latency"] + prompt_eval_count * config["prompt_char_latency"]
+        prompt_eval_duration = int(prompt_eval_seconds * 1e9)
+        time.sleep(prompt_eval_seconds)
+
+        def chunk(content: str, done: bool) -> dict:
+            data = {"model": body.get("model"), "done": done}
+            if path == "/api/chat":
+                data["message"] = {"role": "assistant", "content": content}
+            else:
+                data["response"] = content
+            if done:
+                data.update({
+                    "prompt_eval_count": prompt_eval_count,
+                    "prompt_eval_duration": prompt_eval_duration,
+                    "eval_count": len(tokens),
+                    "eval_duration": int(config["token_latency"] * len(tokens) * 1e9),
+                })
+            return data
+
+        if body.get("stream", True) is False:
+            time.sleep(config["token_latency"] * len(tokens))
+            self._send_json(chunk("".join(tokens), True))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in tokens:
+            time.sleep(config["token_latency"])
+            self._write_chunk(chunk(token, False))
+        self._write_chunk(chunk("", True))
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    """可在背景執行緒中啟動的模擬 Ollama 伺服器"""
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, dim: int = 768,
+                 token_latency: float = 0.02, prompt_eval_latency: float = 0.0,
+                 embed_latency: float = 0.0, tokens: List[str] = None,
+                 prompt_char_latency: float = 0.0, load_latency: float = 0.0, kv_slots: int = 4):
+        super().__init__((host, port), FakeOllamaHandler)
+        self.config = {
+            "dim": dim,
+            "token_latency": token_latency,
+            "prompt_eval_latency": prompt_eval_latency,
+            "embed_latency": embed_latency,
+            "prompt_char_latency": prompt_char_latency,
+            "load_latency": load_latency,
+            "tokens": tokens or DEFAULT_TOKENS,
+            "available": True,
+        }
+        self.request_counts = {}
+        self.loads = 0
+        # 已載入的模型：model -> (卸載時間, num_ctx)；每個生成槽位最近一次的 prompt
+        self._models = {}
+        self._kv_prompts = [""] * kv_slots
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record_request(self, path: str):
+        with self._lock:
+            self.request_counts[path] = self.request_counts.get(path, 0) + 1
+
+    def load_model(self, model: str, keep_alive, num_ctx) -> float:
+        """更新模型的保留時間，返回需要等待的載入秒數（未載入、已逾時卸載或 num_ctx 改變時）"""
+        with self._lock:
+            now = time.monotonic()
+            expires, loaded_ctx = self._models.get(model, (0.0, None))
+            reload = expires <= now or loaded_ctx != num_ctx
+            self._models[model] = (now + parse_keep_alive(keep_alive), num_ctx)
+            if not reload:
+                return 0.0
+            self.loads += 1
+            self._kv_prompts = [""] * len(self._kv_prompts)
+        return self.config["load_latency"]
+
+    def cached_prefix(self, prompt: str) -> int:
+        """返回 prompt 可重用 KV 快取的字元數，並將 prompt 放入共同開頭最長（或最舊）的槽位"""
+        with self._lock:
+            lengths = [len(os.path.commonprefix([cached, prompt])) for cached in self._kv_prompts]
+            slot = max(range(len(lengths)), key=lambda i: lengths[i])
+            if not lengths[slot]:
+                slot = 0
+            self._kv_prompts.pop(slot)
+            self._kv_prompts.append(prompt)
+            return lengths[slot]
+
+    def set_available(self, available: bool):
+        """切換是否模擬故障（不可用時所有請求返回 503，已建立的連線也一樣）"""
+        self.config["available"] = available
+
+    def start(self) -> "FakeOllamaServer":
+        """在背景執行緒中啟動伺服器"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="模擬 Ollama 伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--dim", type=int, default=768, help="嵌入向量維度")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="每個 token 的生成延遲（秒）")
+    parser.add_argument("--prompt-eval-latency", type=float, default=0.0, help="prompt 評估延遲（秒）")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="每次嵌入請求的延遲（秒）")
+    parser.add_argument("--prompt-char-latency", type=float, default=0.0, help="每個未快取的 prompt 字元的評估延遲（秒）")
+    parser.add_argument("--load-latency", type=float, default=0.0, help="載入模型的延遲（秒）")
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(
+        args.host, args.port, dim=args.dim,
+        token_latency=args.token_latency,
+        prompt_eval_latency=args.prompt_eval_latency,
+        embed_latency=args.embed_latency,
+        prompt_char_latency=args.prompt_char_latency,
+        load_latency=args.load_latency
+    )
+    print(f"模擬 Ollama 伺服器運行於 {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
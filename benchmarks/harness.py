@@ -0,0 +1,107 @@
+"""效能測試共用工具：在暫存目錄中啟動後端應用
+
+後端的 SQLite 與 ChromaDB 路徑都相對於 backend 套件，因此把 backend 複製到暫存目錄後再啟動，
+避免測試資料寫入專案目錄，也能用來比較不同版本（例如另一個 git worktree）的後端。
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import httpx
+
+# 專案根目錄
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port() -> int:
+    """取得一個可用的本地埠號"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until_ready(url: str, timeout: float = 60.0):
+    """等待 HTTP 服務可以回應"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f"服務未在 {timeout} 秒內啟動：{url}")
+
+@contextmanager
+def run_app(ollama_url: str, app_dir: str = PROJECT_DIR, workers: int = 1,
+            env: Optional[dict] = None, log_path: Optional[str] = None,
+            work_dir: Optional[str] = None) -> Iterator[str]:
+    """在暫存目錄中以 uvicorn 啟動後端，返回 API 基礎 URL
+
+    指定 work_dir 時在該目錄啟動且結束後保留資料，可用同一目錄重新啟動以測量載入既有資料的情況。
+    """
+    keep_work_dir = work_dir is not None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="qabot-bench-")
+    if not os.path.isdir(os.path.join(work_dir, "backend")):
+        shutil.copytree(
+            os.path.join(app_dir, "backend"),
+            os.path.join(work_dir, "backend"),
+            ignore=shutil.ignore_patterns("__pycache__")
+        )
+    port = free_port()
+    process_env = {**os.environ, "OLLAMA_BASE_URL": ollama_url, **(env or {})}
+    log_file = open(log_path or os.path.join(work_dir, "server.log"), "w")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.main:app",
+         "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers),
+         "--log-level", "warning"],
+        cwd=work_dir, env=process_env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_ready(f"{base_url}/")
+        yield base_url
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log_file.close()
+        if not keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def upload_file(base_url: str, path: str, timeout: float = 600.0) -> dict:
+    """上傳文件到後端，並等待背景處理工作完成（舊版後端直接返回處理結果）"""
+    deadline = time.time() + timeout
+    with open(path, "rb") as f:
+        response = httpx.post(
+            f"{base_url}/upload",
+            files={"file": (os.path.basename(path), f, "text/plain")},
+            timeout=timeout
+        )
+    response.raise_for_status()
+    result = response.json()
+    if "job_id" not in result:
+        return result
+
+    while time.time() < deadline:
+        job = httpx.get(f"{base_url}/upload/{result['job_id']}", timeout=30.0).json()
+        if job["status"] == "succeeded":
+            return job
+        if job["status"] == "failed":
+            raise RuntimeError(f"上傳工作失敗：{job['error']}")
+        time.sleep(0.1)
+    raise RuntimeError(f"上傳工作未在 {timeout} 秒內完成")
+
+def percentile(values, fraction: float) -> float:
+    """計算百分位數（最近排名法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
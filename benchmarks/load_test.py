@@ -0,0 +1,98 @@
+"""/chat 並發壓力測試
+
+啟動模擬 Ollama 伺服器與後端，上傳 test_data.txt 後以不同並發數發送 /chat 請求，
+輸出吞吐量與延遲。以 --app-dir 指向另一個版本的專案目錄（例如 git worktree），
+即可比較修改前後的並發吞吐量。
+
+使用方式：
+    python -m benchmarks.load_test --concurrency 1,8,32 --requests 64
+    git worktree add /tmp/qabot-before <commit>
+    python -m benchmarks.load_test --app-dir /tmp/qabot-before
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import List
+
+import httpx
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from benchmarks.harness import PROJECT_DIR, percentile, run_app, upload_file
+
+QUESTIONS = ["運費如何計算？", "如何查詢訂單狀態？", "退貨條件是什麼？", "客服專線幾號？"]
+
+async def run_level(base_url: str, concurrency: int, total: int) -> dict:
+    """以指定並發數發送 total 個 /chat 請求"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+    rejected = 0
+
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=600.0,
+        limits=httpx.Limits(max_connections=concurrency)
+    ) as client:
+        async def one(i: int):
+            nonlocal errors, rejected
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post("/chat", json={"message": QUESTIONS[i % len(QUESTIONS)]})
+                latencies.append(time.perf_counter() - start)
+                # 429 為生成佇列已滿時的正常拒絕，與錯誤分開計算
+                if response.status_code == 429:
+                    rejected += 1
+                elif response.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "rejected": rejected,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="/chat 並發壓力測試")
+    parser.add_argument("--app-dir", default=PROJECT_DIR, help="要測試的專案目錄（需包含 backend/）")
+    parser.add_argument("--concurrency", default="1,8,32", help="以逗號分隔的並發數")
+    parser.add_argument("--requests", type=int, default=64, help="每個並發數發送的請求數")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="模擬 Ollama 每個 token 的延遲（秒）")
+    parser.add_argument("--corpus", default=os.path.join(PROJECT_DIR, "test_data.txt"))
+    parser.add_argument("--answer-cache", action="store_true", help="保留答案快取（預設停用，以測量完整的 RAG 流程）")
+    parser.add_argument("--output", help="將結果寫入 JSON 檔案")
+    args = parser.parse_args()
+
+    ollama = FakeOllamaServer(token_latency=args.token_latency).start()
+    results = []
+    try:
+        env = {} if args.answer_cache else {"ANSWER_CACHE_SIZE": "0"}
+        with run_app(ollama.url, app_dir=args.app_dir, env=env) as base_url:
+            upload_file(base_url, args.corpus)
+            httpx.post(f"{base_url}/chat", json={"message": QUESTIONS[0]}, timeout=600.0)
+            for level in [int(c) for c in args.concurrency.split(",")]:
+                result = asyncio.run(run_level(base_url, level, args.requests))
+                results.append(result)
+                print(
+                    f"並發 {result['concurrency']:>3}：{result['throughput_rps']:>7.2f} req/s，"
+                    f"p50 {result['p50_ms']:>8.1f} ms，p99 {result['p99_ms']:>8.1f} ms，"
+                    f"錯誤 {result['errors']}，429 {result['rejected']}"
+                )
+    finally:
+        ollama.stop()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"app_dir": args.app_dir, "results": results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+"""檢索品質與延遲評估：以標註的問題集比較分割與檢索參數
+
+讀取語料（預設 test_data.txt）與標註的問題集（JSONL，每行
+{"question": "退貨條件是什麼？", "expected": "商品需在收到後7天內申請退貨"}，expected 可為多個段落的列表），
+依每組參數（chunk_size、chunk_overlap、向量索引後端、混合檢索候選數）分割語料並建立 BM25 與向量索引，
+以 vector、lexical、hybrid 三種檢索方式回答每個問題，報告：
+1. recall@k：前 k 個文本塊中包含預期段落的問題比例；MRR：第一個包含預期段落的文本塊排名的倒數平均
+2. 索引大小（向量索引檔案與文本塊內容的位元組數）、建立時間（分割、嵌入、建立索引）與查詢延遲
+文本塊去除空白後包含任一預期段落即視為相關；coverage 為有任何文本塊包含預期段落的問題比例
+（段落被切點分開時無法命中，recall 的上限即為 coverage）。
+expected 為 null 的問題是客服資料範圍外的問題，不計入 recall 與 MRR，用來校正相關度門檻
+（BM25 信心度 LEXICAL_RELEVANCE_THRESHOLD 與向量相似度 RELEVANCE_THRESHOLD，判斷方式與後端相同，與檢索方式無關）：
+rejected 為範圍內的問題被誤判為沒有相關內容的比例，oos_rejected 為範圍外的問題正確地不呼叫 LLM 的比例。
+
+嵌入預設使用 hash（以字元二元組雜湊產生的可重現向量，與模擬 Ollama 相同，不需任何服務）；
+--embedder ollama 使用實際的嵌入模型並寫入 embedding_cache.db，第二次起直接從快取讀取，可離線重複執行。
+
+使用方式：
+    python -m benchmarks.retrieval_eval
+    python -m benchmarks.retrieval_eval --chunk-sizes 200,300,500,800 --overlaps 0,50,100 --k 1,3,5
+    python -m benchmarks.retrieval_eval --embedder ollama --backends numpy,hnsw --output retrieval.json
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from backend import rag
+from backend.lexical_index import LexicalIndex, reciprocal_rank_fusion
+from backend.text_splitter import StreamingTextSplitter
+from backend.vector_index import NumpyVectorIndex, HnswVectorIndex
+from benchmarks.fake_ollama import fake_embedding
+from benchmarks.harness import PROJECT_DIR, percentile
+
+RETRIEVERS = ["vector", "lexical", "hybrid"]
+BACKENDS = {"numpy": NumpyVectorIndex, "hnsw": HnswVectorIndex}
+
+# 預設的標註問題集
+DEFAULT_QUESTIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "retrieval_questions.jsonl")
+
+def _int_list(value: str) -> List[int]:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+def _compact(text: str) -> str:
+    """去除空白，比對段落時不受換行與縮排影響"""
+    return re.sub(r"\s+", "", text)
+
+def load_questions(path: str) -> List[Tuple[str, List[str]]]:
+    """讀取標註的問題集，返回 [(問題, [預期段落])]；範圍外的問題（expected 為 null）預期段落為空列表"""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            expected = data.get("expected") or []
+            expected = [expected] if isinstance(expected, str) else list(expected)
+            if not data.get("question"):
+                raise ValueError(f"{path} 第 {line_number} 行缺少 question")
+            questions.append((data["question"], [_compact(passage) for passage in expected]))
+    return questions
+
+def hash_embedder(dim: int) -> Tuple[Callable, Callable]:
+    """返回 (嵌入文件, 嵌入查詢)：以字元二元組雜湊產生可重現的單位向量"""
+    def embed(texts: List[str]) -> List[List[float]]:
+        return [fake_embedding(text, dim) for text in texts]
+    return embed, embed
+
+def ollama_embedder() -> Tuple[Callable, Callable]:
+    """返回 (嵌入文件, 嵌入查詢)：與後端相同的嵌入模型與嵌入向量快取"""
+    from backend.ollama_client import get_embeddings
+    embeddings = get_embeddings()
+    return embeddings.embed_documents, lambda texts: [embeddings.embed_query(text) for text in texts]
+
+def directory_size(directory: str) -> int:
+    """目錄中所有檔案的位元組數"""
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory) for name in names
+    )
+
+def build_index(corpus: str, chunk_size: int, chunk_overlap: int, backend: str,
+                embed_documents: Callable, work_dir: str) -> dict:
+    """分割語料並建立 BM25 與向量索引，返回索引與各階段的時間"""
+    start = time.perf_counter()
+    chunks = list(dict.fromkeys(StreamingTextSplitter(chunk_size, chunk_overlap).split_text(corpus)))
+    split_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectors = np.asarray(embed_documents(chunks), dtype=np.float32)
+    embed_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ids = [f"chunk-{i}" for i in range(len(chunks))]
+    lexical = LexicalIndex()
+    for id_, chunk in zip(ids, chunks):
+        lexical.add(id_, chunk)
+    directory = os.path.join(work_dir, f"{backend}-{chunk_size}-{chunk_overlap}")
+    vector_index = BACKENDS[backend](directory)
+    vector_index.add(ids, vectors)
+    vector_index.save()
+    index_seconds = time.perf_counter() - start
+
+    return {
+        "chunks": {id_: _compact(chunk) for id_, chunk in zip(ids, chunks)},
+        "lexical": lexical,
+        "vector_index": vector_index,
+        "split_s": split_seconds,
+        "embed_s": embed_seconds,
+        "index_s": index_seconds,
+        "vector_index_bytes": directory_size(directory),
+        "text_bytes": sum(len(chunk.encode("utf-8")) for chunk in chunks),
+    }
+
+def _vector_search(built: dict, embedding: List[float], k: int) -> Tuple[List[str], float]:
+    """向量檢索，返回 (文本塊 ID, 第一名的餘弦相似度)（與後端相同，由 L2 距離的平方換算）"""
+    results = built["vector_index"].search_with_distances(embedding, k)
+    return [id_ for id_, _ in results], (1.0 - results[0][1] / 2 if results else 0.0)
+
+def retrieve(retriever: str, built: dict, question: str, embedding: List[float], depth: int,
+             candidates: int, rrf_k: int, fast_path_confidence: float) -> List[str]:
+    """以指定的檢索方式取得前 depth 個文本塊 ID（hybrid 與後端 aquery_rag 的檢索相同）"""
+    n_results = min(max(candidates, depth), len(built["chunks"]))
+    if retriever == "vector":
+        return _vector_search(built, embedding, n_results)[0][:depth]
+    ranked, confidence = built["lexical"].search(question, n_results)
+    lexical_ids = [id_ for id_, _ in ranked]
+    if retriever == "lexical" or (lexical_ids and confidence >= fast_path_confidence):
+        return lexical_ids[:depth]
+    vector_ids, _ = _vector_search(built, embedding, min(candidates, len(built["chunks"])))
+    return reciprocal_rank_fusion([vector_ids, lexical_ids[:candidates]], rrf_k)[:depth]
+
+def is_rejected(built: dict, question: str, embedding: List[float],
+                lexical_threshold: float, relevance_threshold: float) -> bool:
+    """問題是否被相關度門檻判為沒有相關內容（與後端的 rag.is_relevant 相同）"""
+    confidence = built["lexical"].search(question, 1)[1]
+    if lexical_threshold <= 0 or confidence >= lexical_threshold:
+        return False
+    return not (relevance_threshold > 0 and _vector_search(built, embedding, 1)[1] >= relevance_threshold)
+
+def evaluate(retriever: str, built: dict, questions: List[Tuple[str, List[str]]], embeddings: List[List[float]],
+             ks: List[int], candidates: int, rrf_k: int, fast_path_confidence: float,
+             lexical_threshold: float, relevance_threshold: float) -> dict:
+    """計算 recall@k、MRR、相關度門檻的拒答比例與查詢延遲（不含查詢嵌入的時間）"""
+    depth = max(ks)
+    hits = {k: 0 for k in ks}
+    reciprocal_ranks = 0.0
+    latencies = []
+    in_scope = sum(1 for _, expected in questions if expected)
+    rejected = {True: 0, False: 0}
+    for (question, expected), embedding in zip(questions, embeddings):
+        start = time.perf_counter()
+        ids = retrieve(retriever, built, question, embedding, depth, candidates, rrf_k, fast_path_confidence)
+        latencies.append(time.perf_counter() - start)
+        if is_rejected(built, question, embedding, lexical_threshold, relevance_threshold):
+            rejected[bool(expected)] += 1
+        if not expected:
+            continue
+        rank = next(
+            (position for position, id_ in enumerate(ids, start=1)
+             if any(passage in built["chunks"][id_] for passage in expected)),
+            None
+        )
+        if rank is not None:
+            reciprocal_ranks += 1.0 / rank
+            for k in ks:
+                if rank <= k:
+                    hits[k] += 1
+    result = {f"recall@{k}": round(hits[k] / max(in_scope, 1), 4) for k in ks}
+    result[f"mrr@{depth}"] = round(reciprocal_ranks / max(in_scope, 1), 4)
+    result["rejected"] = round(rejected[True] / max(in_scope, 1), 4)
+    result["oos_rejected"] = round(rejected[False] / (len(questions) - in_scope), 4) if len(questions) > in_scope else None
+    result["query_p50_ms"] = round(percentile(latencies, 0.50) * 1000, 3)
+    result["query_p95_ms"] = round(percentile(latencies, 0.95) * 1000, 3)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="以標註的問題集評估分割與檢索參數")
+    parser.add_argument("--corpus", default=os.path.join(PROJECT_DIR, "test_data.txt"), help="語料檔案")
+    parser.add_argument("--questions", default=DEFAULT_QUESTIONS, help="標註的問題集（JSONL）")
+    parser.add_argument("--chunk-sizes", default=f"200,300,{rag.CHUNK_SIZE},800", help="以逗號分隔的 chunk_size")
+    parser.add_argument("--overlaps", default=f"0,{rag.CHUNK_OVERLAP},100", help="以逗號分隔的 chunk_overlap")
+    parser.add_argument("--k", default=f"1,{rag.RETRIEVER_K},5", help="以逗號分隔的 recall@k 的 k")
+    parser.add_argument("--retrievers", default=",".join(RETRIEVERS), help="以逗號分隔的檢索方式")
+    parser.add_argument("--backends", default="numpy", help="以逗號分隔的向量索引後端（numpy、hnsw）")
+    parser.add_argument("--candidates", default=str(rag.HYBRID_CANDIDATES), help="以逗號分隔的混合檢索候選數")
+    parser.add_argument("--rrf-k", type=int, default=rag.RRF_K, help="倒數排名融合常數")
+    parser.add_argument("--fast-path-confidence", type=float, default=rag.LEXICAL_FAST_PATH_CONFIDENCE,
+                        help="hybrid 的 BM25 快速路徑信心度門檻（大於 1 時停用）")
+    parser.add_argument("--lexical-relevance-threshold", type=float, default=rag.LEXICAL_RELEVANCE_THRESHOLD,
+                        help="相關度門檻（BM25 第一名的信心度，0 表示停用整個門檻）")
+    parser.add_argument("--relevance-threshold", type=float, default=rag.RELEVANCE_THRESHOLD,
+                        help="向量檢索第一名的餘弦相似度達到此值的問題仍視為相關（0 表示不使用）")
+    parser.add_argument("--embedder", choices=["hash", "ollama"], default="hash", help="嵌入方式")
+    parser.add_argument("--dim", type=int, default=768, help="hash 嵌入的向量維度")
+    parser.add_argument("--output", help="將結果寫入 JSON 檔案")
+    args = parser.parse_args()
+
+    ks = sorted(set(_int_list(args.k)))
+    retrievers = args.retrievers.split(",")
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = f.read()
+    questions = load_questions(args.questions)
+    embed_documents, embed_queries = hash_embedder(args.dim) if args.embedder == "hash" else ollama_embedder()
+
+    start = time.perf_counter()
+    query_embeddings = embed_queries([question for question, _ in questions])
+    embed_query_ms = (time.perf_counter() - start) * 1000 / len(questions)
+    print(f"語料 {len(corpus)} 字，{len(questions)} 個問題，嵌入方式 {args.embedder}（每個查詢嵌入 {embed_query_ms:.2f} ms）")
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="qabot-retrieval-eval-")
+    try:
+        for chunk_size, chunk_overlap, backend in itertools.product(
+            _int_list(args.chunk_sizes), _int_list(args.overlaps), args.backends.split(",")
+        ):
+            if chunk_overlap >= chunk_size:
+                continue
+            built = build_index(corpus, chunk_size, chunk_overlap, backend, embed_documents, work_dir)
+            covered = sum(
+                any(passage in chunk for chunk in built["chunks"].values() for passage in expected)
+                for _, expected in questions
+            )
+            in_scope = sum(1 for _, expected in questions if expected)
+            config = {
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap,
+                "backend": backend,
+                "chunks": len(built["chunks"]),
+                "coverage": round(covered / max(in_scope, 1), 4),
+                "vector_index_bytes": built["vector_index_bytes"],
+                "text_bytes": built["text_bytes"],
+                "ingest_s": round(built["split_s"] + built["embed_s"] + built["index_s"], 4),
+                "embed_s": round(built["embed_s"], 4),
+            }
+            for retriever in retrievers:
+                for candidates in (_int_list(args.candidates) if retriever == "hybrid" else [None]):
+                    result = dict(config, retriever=retriever, candidates=candidates)
+                    result.update(evaluate(
+                        retriever, built, questions, query_embeddings, ks,
+                        candidates or rag.HYBRID_CANDIDATES, args.rrf_k, args.fast_path_confidence,
+                        args.lexical_relevance_threshold, args.relevance_threshold
+                    ))
+                    results.append(result)
+                    recalls = "，".join(f"R@{k} {result[f'recall@{k}']:.3f}" for k in ks)
+                    rejection = f"拒答 {result['rejected']:.3f}"
+                    if result["oos_rejected"] is not None:
+                        rejection += f"/範圍外 {result['oos_rejected']:.3f}"
+                    print(
+                        f"size {chunk_size:>4} overlap {chunk_overlap:>3} {backend:>5} "
+                        f"{retriever:>7}{f'(c={candidates})' if candidates else '':<7}："
+                        f"{result['chunks']:>4} 塊，coverage {result['coverage']:.3f}，{recalls}，"
+                        f"MRR {result[f'mrr@{max(ks)}']:.3f}，{rejection}，索引 {result['vector_index_bytes'] / 1024:>8.1f} KB，"
+                        f"建立 {result['ingest_s']:>7.3f} s，p50 {result['query_p50_ms']:>7.3f} ms"
+                    )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if results:
+        k = rag.RETRIEVER_K if rag.RETRIEVER_K in ks else max(ks)
+        best = max(results, key=lambda item: (item[f"recall@{k}"], item[f"mrr@{max(ks)}"], -item["chunks"]))
+        print(
+            f"recall@{k} 最高：chunk_size={best['chunk_size']} chunk_overlap={best['chunk_overlap']} "
+            f"{best['retriever']}（recall@{k} {best[f'recall@{k}']:.3f}，MRR {best[f'mrr@{max(ks)}']:.3f}）"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "corpus": args.corpus,
+                "questions": len(questions),
+                "embedder": args.embedder,
+                "lexical_relevance_threshold": args.lexical_relevance_threshold,
+                "relevance_threshold": args.relevance_threshold,
+                "embed_query_ms": round(embed_query_ms, 3),
+                "results": results,
+            }, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
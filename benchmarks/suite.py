@@ -0,0 +1,400 @@
+"""可重現的端到端效能測試套件
+
+以模擬 Ollama 伺服器（可設定嵌入維度與每個 token 的延遲）取代真實模型，測量：
+1. 啟動時間：匯入 backend.main 的時間，以及空資料庫與載入既有文件後重新啟動，
+   到 API 可以回應（GET /）與就緒（GET /ready 返回 200）的時間
+2. /upload 時間：將 test_data.txt 複製擴充為 1 MB、10 MB、100 MB 的文件並等待處理完成
+3. /chat 延遲（p50/p99）與吞吐量：每種文件大小在多個並發數下測量，並由 /metrics 取得
+   每次生成平均的 prompt 評估時間與需評估的 token 數（模擬 Ollama 會重用相同開頭的 KV 快取）
+4. /history 延遲：在大量聊天記錄下的第一頁、深層游標分頁與依會話篩選
+
+結果寫入 JSON 檔案；以 --compare 指定先前的結果檔案即可列出變慢的項目（超過容許比例時結束碼為 1）。
+
+使用方式：
+    python -m benchmarks.suite --sizes 1,10 --concurrency 1,8,32 --history-rows 100000,1000000
+    python -m benchmarks.suite --sizes 1 --compare benchmark_results/baseline.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import httpx
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from benchmarks.harness import PROJECT_DIR, percentile, run_app, upload_file
+from benchmarks.load_test import QUESTIONS, run_level
+
+# 預設的結果目錄
+RESULTS_DIR = os.path.join(PROJECT_DIR, "benchmark_results")
+
+# 數值越大越好的指標（其餘以秒或毫秒計的指標越小越好）
+_HIGHER_IS_BETTER = ("throughput_rps", "chunks_per_sec")
+
+def build_corpus(source: str, size_mb: float, path: str) -> int:
+    """將 source 重複寫入 path 直到達到 size_mb，返回實際位元組數
+
+    每一份複本的每一行都加上編號，讓文本塊的內容各不相同（相同內容的文本塊會被去重）。
+    """
+    with open(source, encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    target = int(size_mb * 1024 * 1024)
+    written = 0
+    copy = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            copy += 1
+            block = "\n".join(f"{line}（#{copy}）" if line.strip() else line for line in lines) + "\n\n"
+            f.write(block)
+            written += len(block.encode("utf-8"))
+    return written
+
+def measure_import(app_dir: str, repeats: int) -> dict:
+    """在新的 Python 行程中匯入 backend.main 的時間（取中位數），以及累計耗時最多的模組"""
+    work_dir = tempfile.mkdtemp(prefix="qabot-import-")
+    try:
+        shutil.copytree(
+            os.path.join(app_dir, "backend"),
+            os.path.join(work_dir, "backend"),
+            ignore=shutil.ignore_patterns("__pycache__")
+        )
+        code = "import time; start = time.perf_counter(); import backend.main; print(time.perf_counter() - start)"
+        # 第一次執行會編譯 .pyc，不列入計算
+        subprocess.run([sys.executable, "-c", code], cwd=work_dir, capture_output=True, check=True)
+        samples = [
+            float(subprocess.run(
+                [sys.executable, "-c", code], cwd=work_dir, capture_output=True, text=True, check=True
+            ).stdout.strip().splitlines()[-1])
+            for _ in range(repeats)
+        ]
+        # -X importtime 輸出「自身耗時 | 累計耗時 | 模組」（微秒）
+        profile = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import backend.main"],
+            cwd=work_dir, capture_output=True, text=True, check=True
+        ).stderr
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    modules = []
+    for line in profile.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            name = parts[2].strip()
+            # 只列出 backend.main 直接匯入的模組（每深一層縮排兩個空白）
+            indent = len(parts[2]) - len(parts[2].lstrip())
+            if indent <= 3 and name != "backend.main":
+                modules.append((name, int(parts[1]) / 1e6))
+    modules.sort(key=lambda item: item[1], reverse=True)
+    return {
+        "import_s": round(percentile(samples, 0.50), 3),
+        "top_modules": [{"module": name, "cumulative_s": round(seconds, 3)} for name, seconds in modules[:10]],
+    }
+
+def wait_for_ready(base_url: str, timeout: float = 600.0):
+    """等待 GET /ready 返回 200，返回是否支援就緒檢查（舊版後端沒有 /ready）"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        status = httpx.get(f"{base_url}/ready", timeout=5.0).status_code
+        if status == 200:
+            return True
+        if status == 404:
+            return False
+        time.sleep(0.05)
+    raise RuntimeError(f"後端未在 {timeout} 秒內就緒")
+
+def prompt_eval_totals(base_url: str):
+    """從 /metrics 讀取累計的 prompt 評估秒數、生成次數與評估的 token 數（舊版後端沒有 /metrics 時返回 None）"""
+    response = httpx.get(f"{base_url}/metrics", timeout=30.0)
+    if response.status_code != 200:
+        return None
+    totals = {"seconds": 0.0, "count": 0.0, "tokens": 0.0}
+    names = {
+        'qabot_stage_seconds_sum{pipeline="query",stage="prompt_eval"}': "seconds",
+        "qabot_prompt_tokens_count": "count",
+        "qabot_prompt_tokens_sum": "tokens",
+    }
+    for line in response.text.splitlines():
+        name, _, value = line.rpartition(" ")
+        if name in names:
+            totals[names[name]] = float(value)
+    return totals
+
+def chat_levels(base_url: str, levels: List[int], total: int) -> List[dict]:
+    """在每個並發數下發送 total 個 /chat 請求"""
+    results = []
+    for level in levels:
+        before = prompt_eval_totals(base_url)
+        result = asyncio.run(run_level(base_url, level, total))
+        after = prompt_eval_totals(base_url)
+        if before is not None and after is not None and after["count"] > before["count"]:
+            count = after["count"] - before["count"]
+            result["prompt_eval_ms"] = round((after["seconds"] - before["seconds"]) / count * 1000, 1)
+            result["prompt_tokens"] = round((after["tokens"] - before["tokens"]) / count, 1)
+        results.append(result)
+        prompt_eval = f"，prompt 評估 {result['prompt_eval_ms']:.1f} ms" if "prompt_eval_ms" in result else ""
+        print(
+            f"  並發 {result['concurrency']:>3}：{result['throughput_rps']:>7.2f} req/s，"
+            f"p50 {result['p50_ms']:>8.1f} ms，p99 {result['p99_ms']:>8.1f} ms，"
+            f"錯誤 {result['errors']}，429 {result['rejected']}{prompt_eval}"
+        )
+    return results
+
+def run_corpus(ollama_url: str, args, size_mb: float, corpus_path: str, env: dict) -> dict:
+    """測量一種文件大小：空資料庫啟動、上傳、重新啟動與 /chat 延遲"""
+    work_dir = tempfile.mkdtemp(prefix="qabot-suite-")
+    try:
+        start = time.perf_counter()
+        with run_app(ollama_url, app_dir=args.app_dir, env=env, work_dir=work_dir) as base_url:
+            startup_empty = time.perf_counter() - start
+            start = time.perf_counter()
+            job = upload_file(base_url, corpus_path, timeout=args.upload_timeout)
+            upload_s = time.perf_counter() - start
+
+        # 以同一目錄重新啟動：包含載入既有的 SQLite、ChromaDB 與索引
+        start = time.perf_counter()
+        with run_app(ollama_url, app_dir=args.app_dir, env=env, work_dir=work_dir) as base_url:
+            startup_loaded = time.perf_counter() - start
+            ready_loaded = time.perf_counter() - start if wait_for_ready(base_url) else None
+            start = time.perf_counter()
+            httpx.post(f"{base_url}/chat", json={"message": QUESTIONS[0]}, timeout=600.0).raise_for_status()
+            first_chat = time.perf_counter() - start
+            chat = chat_levels(base_url, args.levels, args.requests)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "size_mb": size_mb,
+        "bytes": os.path.getsize(corpus_path),
+        "chunks": job.get("chunks_total"),
+        "upload_s": round(upload_s, 3),
+        "chunks_per_sec": round(job["chunks_total"] / upload_s, 1) if job.get("chunks_total") else None,
+        "startup_empty_s": round(startup_empty, 3),
+        "startup_loaded_s": round(startup_loaded, 3),
+        "ready_loaded_s": round(ready_loaded, 3) if ready_loaded is not None else None,
+        "first_chat_ms": round(first_chat * 1000, 1),
+        "chat": chat,
+    }
+
+def seed_history(db_path: str, rows: int, sessions: int, batch: int = 10000):
+    """直接寫入 rows 筆聊天記錄（每秒一筆，依序分配到各會話）"""
+    base = datetime(2024, 1, 1)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("DELETE FROM chat_history")
+        for offset in range(0, rows, batch):
+            conn.executemany(
+                "INSERT INTO chat_history (id, timestamp, user_message, bot_response, session_id) VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        i + 1,
+                        (base + timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S"),
+                        QUESTIONS[i % len(QUESTIONS)],
+                        "根據客服資料，" * 10,
+                        f"bench-session-{i % sessions}",
+                    )
+                    for i in range(offset, min(rows, offset + batch))
+                )
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+def history_cursor(row: int) -> str:
+    """seed_history 寫入的第 row 筆（從 0 起算）記錄的分頁游標"""
+    timestamp = (datetime(2024, 1, 1) + timedelta(seconds=row)).strftime("%Y-%m-%d %H:%M:%S")
+    return base64.urlsafe_b64encode(f"{timestamp}|{row + 1}".encode("utf-8")).decode("ascii")
+
+def time_requests(client: httpx.Client, params: dict, repeats: int) -> dict:
+    """重複發送同一個 /history 請求，返回延遲的百分位數"""
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        client.get("/history", params=params).raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return {
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+def run_history(ollama_url: str, args, env: dict) -> List[dict]:
+    """在不同的聊天記錄筆數下測量 /history 延遲"""
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="qabot-suite-")
+    try:
+        with run_app(ollama_url, app_dir=args.app_dir, env=env, work_dir=work_dir) as base_url:
+            db_path = os.path.join(work_dir, "custom_service.db")
+            with httpx.Client(base_url=base_url, timeout=60.0) as client:
+                for rows in args.history_rows:
+                    start = time.perf_counter()
+                    seed_history(db_path, rows, args.history_sessions)
+                    seed_s = time.perf_counter() - start
+                    result = {
+                        "rows": rows,
+                        "seed_s": round(seed_s, 3),
+                        "first_page": time_requests(client, {}, args.history_repeats),
+                        "deep_page": time_requests(client, {"cursor": history_cursor(rows // 2)}, args.history_repeats),
+                        "session_page": time_requests(client, {"session_id": "bench-session-0"}, args.history_repeats),
+                    }
+                    results.append(result)
+                    print(
+                        f"  {rows:>9,} 筆：第一頁 p50 {result['first_page']['p50_ms']:.2f} ms，"
+                        f"深層分頁 p50 {result['deep_page']['p50_ms']:.2f} ms，"
+                        f"單一會話 p50 {result['session_page']['p50_ms']:.2f} ms"
+                    )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def git_commit(app_dir: str) -> str:
+    """測試目標的 git commit（無法取得時返回空字串）"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=app_dir,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def flatten(results: dict) -> Dict[str, float]:
+    """將結果展開為「名稱 -> 數值」，用於與先前的結果比較"""
+    metrics = {}
+    if results.get("import"):
+        metrics["import_s"] = results["import"]["import_s"]
+    for corpus in results.get("corpora", []):
+        prefix = f"corpus[{corpus['size_mb']}MB]"
+        for key in ("upload_s", "chunks_per_sec", "startup_empty_s", "startup_loaded_s", "ready_loaded_s", "first_chat_ms"):
+            if corpus.get(key) is not None:
+                metrics[f"{prefix}.{key}"] = corpus[key]
+        for level in corpus["chat"]:
+            for key in ("throughput_rps", "p50_ms", "p99_ms", "prompt_eval_ms"):
+                if level.get(key) is not None:
+                    metrics[f"{prefix}.chat[c={level['concurrency']}].{key}"] = level[key]
+    for history in results.get("history", []):
+        for page in ("first_page", "deep_page", "session_page"):
+            for key in ("p50_ms", "p99_ms"):
+                metrics[f"history[{history['rows']}].{page}.{key}"] = history[page][key]
+    return metrics
+
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """列出比 baseline 差超過 tolerance 比例的指標"""
+    before = flatten(baseline)
+    regressions = []
+    for name, value in flatten(current).items():
+        prior = before.get(name)
+        if not prior or value is None:
+            continue
+        ratio = value / prior
+        worse = ratio < 1 - tolerance if name.endswith(_HIGHER_IS_BETTER) else ratio > 1 + tolerance
+        marker = "  ← 變差" if worse else ""
+        print(f"  {name}: {prior} → {value}（×{ratio:.2f}）{marker}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="可重現的端到端效能測試套件")
+    parser.add_argument("--app-dir", default=PROJECT_DIR, help="要測試的專案目錄（需包含 backend/）")
+    parser.add_argument("--sizes", default="1,10", help="以逗號分隔的文件大小（MB），例如 1,10,100")
+    parser.add_argument("--concurrency", default="1,8,32", help="以逗號分隔的 /chat 並發數")
+    parser.add_argument("--requests", type=int, default=64, help="每個並發數發送的 /chat 請求數")
+    parser.add_argument("--import-repeats", type=int, default=5, help="測量匯入時間的重複次數")
+    parser.add_argument("--history-rows", default="100000,1000000", help="以逗號分隔的聊天記錄筆數（0 表示略過）")
+    parser.add_argument("--history-sessions", type=int, default=1000, help="聊天記錄分配到的會話數")
+    parser.add_argument("--history-repeats", type=int, default=50, help="每種 /history 請求的重複次數")
+    parser.add_argument("--dim", type=int, default=768, help="模擬嵌入向量的維度")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="模擬 Ollama 每個 token 的延遲（秒）")
+    parser.add_argument("--prompt-char-latency", type=float, default=0.0005,
+                        help="模擬 Ollama 評估每個未快取的 prompt 字元的延遲（秒）")
+    parser.add_argument("--load-latency", type=float, default=1.0, help="模擬 Ollama 載入模型的延遲（秒）")
+    parser.add_argument("--upload-timeout", type=float, default=3600.0, help="等待上傳處理完成的秒數")
+    parser.add_argument("--source", default=os.path.join(PROJECT_DIR, "test_data.txt"), help="用來擴充文件的原始文字檔")
+    parser.add_argument("--output", help="結果 JSON 檔案（預設寫入 benchmark_results/ 並以時間命名）")
+    parser.add_argument("--compare", help="與先前的結果 JSON 比較")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="比較時容許變差的比例")
+    args = parser.parse_args()
+    args.levels = [int(c) for c in args.concurrency.split(",")]
+    args.history_rows = [int(n) for n in args.history_rows.split(",") if int(n) > 0]
+    sizes = [float(s) for s in args.sizes.split(",") if s]
+
+    # 停用答案快取，每個 /chat 請求都經過完整的 RAG 流程
+    env = {"ANSWER_CACHE_SIZE": "0"}
+    results = {
+        "meta": {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(args.app_dir),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "dim": args.dim,
+            "token_latency": args.token_latency,
+            "prompt_char_latency": args.prompt_char_latency,
+            "load_latency": args.load_latency,
+            "concurrency": args.levels,
+            "requests": args.requests,
+        },
+        "import": None,
+        "corpora": [],
+        "history": [],
+    }
+
+    results["import"] = measure_import(args.app_dir, args.import_repeats)
+    print(
+        f"匯入 backend.main：{results['import']['import_s']:.3f} s（"
+        + "，".join(f"{m['module']} {m['cumulative_s']:.2f}s" for m in results["import"]["top_modules"][:5])
+        + "）"
+    )
+
+    ollama = FakeOllamaServer(
+        dim=args.dim, token_latency=args.token_latency,
+        prompt_char_latency=args.prompt_char_latency, load_latency=args.load_latency
+    ).start()
+    corpus_dir = tempfile.mkdtemp(prefix="qabot-corpus-")
+    try:
+        for size_mb in sizes:
+            corpus_path = os.path.join(corpus_dir, f"corpus_{size_mb:g}MB.txt")
+            build_corpus(args.source, size_mb, corpus_path)
+            print(f"文件 {size_mb:g} MB：")
+            result = run_corpus(ollama.url, args, size_mb, corpus_path, env)
+            results["corpora"].append(result)
+            startup = f"啟動 {result['startup_empty_s']:.2f} s / 載入後 {result['startup_loaded_s']:.2f} s"
+            if result["ready_loaded_s"] is not None:
+                startup += f"（就緒 {result['ready_loaded_s']:.2f} s）"
+            print(
+                f"  上傳 {result['upload_s']:.2f} s（{result['chunks']} 個文本塊），{startup}，"
+                f"首次 /chat {result['first_chat_ms']:.1f} ms"
+            )
+        if args.history_rows:
+            print("聊天歷史：")
+            results["history"] = run_history(ollama.url, args, env)
+    finally:
+        ollama.stop()
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    output = args.output or os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"結果已寫入 {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"與 {args.compare}（commit {baseline.get('meta', {}).get('commit') or '未知'}）比較：")
+        regressions = compare(baseline, results, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} 項指標變差超過 {args.tolerance:.0%}")
+            sys.exit(1)
+        print("沒有指標變差超過容許比例")
+
+if __name__ == "__main__":
+    main()
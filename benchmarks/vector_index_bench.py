@@ -0,0 +1,164 @@
+"""向量索引後端比較：Chroma / NumPy 暴力搜尋 / HNSW
+
+以合成的嵌入向量（群聚分布、單位化，接近真實文本嵌入）建立三種索引，
+各在獨立的子行程中測量載入時間與查詢延遲，並以精確的暴力搜尋結果計算 recall@k。
+
+使用方式：
+    python -m benchmarks.vector_index_bench --chunks 20000 --queries 500
+    python -m benchmarks.vector_index_bench --chunks 100000 --backends numpy,hnsw --output results.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# 禁用 ChromaDB telemetry（在導入 ChromaDB 之前設置）
+os.environ["ANONYMIZED_TELEMETRY"] = "False"
+
+import numpy as np
+
+from benchmarks.harness import PROJECT_DIR, percentile
+
+COLLECTION_NAME = "customer_service_docs"
+BACKENDS = ["chroma", "numpy", "hnsw"]
+
+def synthetic_vectors(count: int, dim: int, seed: int = 0) -> np.ndarray:
+    """產生群聚分布的單位向量"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(count // 50, 1), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), count)] + 0.3 * rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """以 L2 距離暴力計算每個查詢的前 k 個向量"""
+    sq_norms = np.einsum("ij,ij->i", vectors, vectors)
+    results = []
+    for query in queries:
+        distances = sq_norms - 2 * (vectors @ query)
+        top = np.argpartition(distances, k - 1)[:k]
+        results.append(top[np.argsort(distances[top])])
+    return np.array(results)
+
+def build(work_dir: str, vectors: np.ndarray, backends) -> dict:
+    """寫入 Chroma 並建立行程內索引，返回各後端的建立時間（秒）"""
+    from backend.vector_index import NumpyVectorIndex, HnswVectorIndex
+    ids = [f"chunk-{i}" for i in range(len(vectors))]
+    build_seconds = {}
+
+    if "chroma" in backends:
+        import chromadb
+        start = time.perf_counter()
+        client = chromadb.PersistentClient(path=os.path.join(work_dir, "chroma_db"))
+        collection = client.get_or_create_collection(COLLECTION_NAME)
+        for i in range(0, len(ids), 5000):
+            collection.add(ids=ids[i:i + 5000], embeddings=vectors[i:i + 5000].tolist())
+        build_seconds["chroma"] = time.perf_counter() - start
+
+    for name, cls in (("numpy", NumpyVectorIndex), ("hnsw", HnswVectorIndex)):
+        if name in backends:
+            start = time.perf_counter()
+            index = cls(os.path.join(work_dir, name))
+            index.add(ids, vectors)
+            index.save()
+            build_seconds[name] = time.perf_counter() - start
+    return build_seconds
+
+def measure(backend: str, work_dir: str, k: int) -> dict:
+    """（於子行程中執行）載入索引並測量查詢延遲與 recall@k"""
+    from backend.vector_index import ChromaVectorIndex, NumpyVectorIndex, HnswVectorIndex
+    queries = np.load(os.path.join(work_dir, "queries.npy"))
+    truth = np.load(os.path.join(work_dir, "truth.npy"))
+
+    start = time.perf_counter()
+    if backend == "chroma":
+        import chromadb
+        client = chromadb.PersistentClient(path=os.path.join(work_dir, "chroma_db"))
+        index = ChromaVectorIndex(client.get_collection(COLLECTION_NAME))
+    elif backend == "numpy":
+        index = NumpyVectorIndex(os.path.join(work_dir, "numpy"))
+    else:
+        index = HnswVectorIndex(os.path.join(work_dir, "hnsw"))
+    load_seconds = time.perf_counter() - start
+
+    # 第一次查詢包含延遲載入（Chroma 的 HNSW 區段、記憶體映射的分頁）
+    start = time.perf_counter()
+    index.search(queries[0], k)
+    first_query_seconds = time.perf_counter() - start
+
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = index.search(query, k)
+        latencies.append(time.perf_counter() - start)
+        hits += len({f"chunk-{i}" for i in expected} & set(found))
+
+    return {
+        "backend": backend,
+        "load_ms": round(load_seconds * 1000, 1),
+        "first_query_ms": round(first_query_seconds * 1000, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        f"recall@{k}": round(hits / (len(queries) * k), 4),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="向量索引後端比較")
+    parser.add_argument("--chunks", type=int, default=20000, help="文本塊（向量）數量")
+    parser.add_argument("--dim", type=int, default=768, help="向量維度")
+    parser.add_argument("--queries", type=int, default=500, help="查詢次數")
+    parser.add_argument("--k", type=int, default=10, help="每次查詢的結果數")
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="以逗號分隔的後端")
+    parser.add_argument("--output", help="將結果寫入 JSON 檔案")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, args.work_dir, args.k)))
+        return
+
+    backends = args.backends.split(",")
+    work_dir = tempfile.mkdtemp(prefix="qabot-vector-bench-")
+    try:
+        vectors = synthetic_vectors(args.chunks, args.dim)
+        # 查詢為既有向量加上雜訊，模擬與某些文本塊相近的問題
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.integers(0, len(vectors), args.queries)]
+        queries = queries + 0.1 * rng.standard_normal(queries.shape).astype(np.float32)
+        np.save(os.path.join(work_dir, "queries.npy"), queries.astype(np.float32))
+        np.save(os.path.join(work_dir, "truth.npy"), exact_top_k(vectors, queries, args.k))
+
+        print(f"建立索引：{args.chunks} 個 {args.dim} 維向量")
+        build_seconds = build(work_dir, vectors, backends)
+        del vectors
+
+        results = []
+        for backend in backends:
+            # 每個後端在新的行程中載入，測得的是冷啟動時間
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.vector_index_bench", "--measure", backend,
+                 "--work-dir", work_dir, "--k", str(args.k)],
+                cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result["build_s"] = round(build_seconds[backend], 2)
+            results.append(result)
+            print(
+                f"{backend:>6}：建立 {result['build_s']:>7.2f} s，載入 {result['load_ms']:>8.1f} ms，"
+                f"首次查詢 {result['first_query_ms']:>8.1f} ms，p50 {result['p50_ms']:>7.3f} ms，"
+                f"p99 {result['p99_ms']:>7.3f} ms，recall@{args.k} {result[f'recall@{args.k}']:.4f}"
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"chunks": args.chunks, "dim": args.dim, "results": results}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,46 @@
  */
 const API_BASE_URL = 'http://localhost:8000';
 
+// ============================================
+// 會話管理
+// ============================================
+/**
+ * 會話 ID 在 localStorage 中的鍵名
+ * 每個瀏覽器各自持有一個會話，聊天歷史與對話脈絡都依會話分開
+ */
+const SESSION_STORAGE_KEY = 'qabotSessionId';
+
+/**
+ * 目前的會話 ID（尚未取得時為 null，發送訊息後由伺服器發放）
+ */
+let sessionId = localStorage.getItem(SESSION_STORAGE_KEY);
+
+/**
+ * 儲存會話 ID
+ * 
+ * @param {string} id - 伺服器發放的會話 ID
+ */
+function setSessionId(id) {
+    sessionId = id;
+    localStorage.setItem(SESSION_STORAGE_KEY, id);
+}
+
+/**
+ * 向伺服器申請新的會話
+ */
+function startNewSession() {
+    $.ajax({
+        url: `${API_BASE_URL}/session`,
+        method: 'POST',
+        success: function(data) {
+            setSessionId(data.session_id);
+        },
+        error: function(xhr, status, error) {
+            console.error('建立會話失敗：', error);
+        }
+    });
+}
+
 // ============================================
 // DOM 元素初始化（使用 jQuery 選擇器）
 // ============================================
@@ -129,7 +169,9 @@ function handleFileUpload(file) {
         contentType: false,  // 告訴 jQuery 不要設定 Content-Type（讓瀏覽器自動設定）
         success: function(data) {
             // 請求成功時執行的回呼函數
-            showUploadStatus(`文件上傳成功：${data.filename}`, 'success');
+            // 伺服器只建立背景處理工作，接著輪詢處理進度（處理期間仍可繼續聊天）
+            showUploadStatus(`處理中：${data.filename}`, 'loading');
+            pollUploadJob(data.job_id);
         },
         error: function(xhr, status, error) {
             // 請求失敗時執行的回呼函數
@@ -144,6 +186,47 @@ function handleFileUpload(file) {
     });
 }
 
+/**
+ * 上傳工作進度的輪詢間隔（毫秒）
+ */
+const UPLOAD_POLL_INTERVAL = 1000;
+
+/**
+ * 輪詢文件處理工作的進度，直到成功或失敗
+ *
+ * @param {string} jobId - 上傳後取得的工作 ID
+ */
+function pollUploadJob(jobId) {
+    $.ajax({
+        url: `${API_BASE_URL}/upload/${jobId}`,
+        method: 'GET',
+        success: function(job) {
+            if (job.status === 'succeeded') {
+                // 只有新增或變更的文本塊需要重新建立索引
+                showUploadStatus(
+                    `文件上傳成功：${job.filename}（新增 ${job.added}、刪除 ${job.deleted}、未變更 ${job.unchanged} 個文本塊）`,
+                    'success'
+                );
+            } else if (job.status === 'failed') {
+                showUploadStatus(`上傳失敗：${job.error}`, 'error');
+            } else {
+                const percent = Math.round(job.progress * 100);
+                showUploadStatus(
+                    `處理中：${job.filename}（${job.chunks_processed}/${job.chunks_total} 個文本塊，${percent}%）`,
+                    'loading'
+                );
+                setTimeout(function() {
+                    pollUploadJob(jobId);
+                }, UPLOAD_POLL_INTERVAL);
+            }
+        },
+        error: function(xhr, status, error) {
+            const detail = xhr.responseJSON?.detail || error;
+            showUploadStatus(`查詢處理進度失敗：${detail}`, 'error');
+        }
+    });
+}
+
 /**
  * 顯示上傳狀態訊息
  * 
@@ -201,7 +284,8 @@ $messageInput.on('keypress', function(e) {
 
 /**
  * 發送聊天訊息到伺服器
- * 使用 jQuery 的 $.ajax() 或 $.post() 來發送請求
+ * 使用 /chat/stream 端點，以 Server-Sent Events 逐段接收回答
+ * jQuery 的 $.ajax() 無法逐段讀取回應，因此這裡使用原生的 fetch() 與 ReadableStream
  */
 function sendMessage() {
     // jQuery 的 .val() 方法可以取得或設定表單元素的值
@@ -214,34 +298,119 @@ function sendMessage() {
     $messageInput.val('');  // 清空輸入框
     $sendBtn.prop('disabled', true);  // 禁用發送按鈕
 
-    // 顯示載入中的訊息
+    // 顯示載入中的訊息，收到第一個 token 後改為顯示回答
     const loadingId = addMessage('bot', '思考中...', true);
+    let botMessageId = null;
+    let answer = '';
 
-    // 使用 jQuery 的 $.ajax() 發送 POST 請求
-    $.ajax({
-        url: `${API_BASE_URL}/chat`,
+    fetch(`${API_BASE_URL}/chat/stream`, {
         method: 'POST',
-        contentType: 'application/json',  // 設定 Content-Type
-        data: JSON.stringify({ message }),  // 將物件轉換為 JSON 字串
-        success: function(data) {
-            // 移除載入訊息，顯示 AI 的真實回應
-            removeMessage(loadingId);
-            addMessage('bot', data.response);
-        },
-        error: function(xhr) {
-            // 顯示錯誤訊息
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ message, session_id: sessionId })
+    }).then(async function(response) {
+        if (!response.ok) {
+            const data = await response.json().catch(() => ({}));
+            // 伺服器忙碌（HTTP 429）時提示建議的重試時間
+            if (response.status === 429) {
+                const retryAfter = response.headers.get('Retry-After');
+                throw new Error(`${data.detail || '伺服器忙碌中'}（約 ${retryAfter || '幾'} 秒後再試）`);
+            }
+            throw new Error(data.detail || '發生錯誤');
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder('utf-8');
+        let buffer = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // SSE 事件之間以空行分隔
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            events.forEach(function(rawEvent) {
+                const event = parseSseEvent(rawEvent);
+                if (!event) return;
+
+                if (event.type === 'error') {
+                    // 已顯示的部分回答保留，另外提示回答不完整
+                    console.error('串流回答時發生錯誤：', event.data.detail);
+                    if (botMessageId === null) {
+                        removeMessage(loadingId);
+                        botMessageId = addMessage('bot', answer || '抱歉，我無法生成回答。');
+                    }
+                    addMessage('bot', `錯誤：${event.data.detail}`, false, true);
+                } else if (event.type === 'done') {
+                    // 尚未持有會話時，沿用伺服器為這則訊息發放的會話
+                    if (event.data.session_id && event.data.session_id !== sessionId) {
+                        setSessionId(event.data.session_id);
+                    }
+                } else if (event.type === 'message') {
+                    answer += event.data.token;
+                    if (botMessageId === null) {
+                        removeMessage(loadingId);
+                        botMessageId = addMessage('bot', answer);
+                    } else {
+                        updateMessage(botMessageId, answer);
+                    }
+                }
+            });
+        }
+
+        // 沒有收到任何 token 時也要移除載入訊息
+        if (botMessageId === null) {
             removeMessage(loadingId);
-            const detail = xhr.responseJSON?.detail || '發生錯誤';
-            addMessage('bot', `錯誤：${detail}`, false, true);
-        },
-        complete: function() {
-            // 恢復發送按鈕狀態，並將游標聚焦回輸入框
-            $sendBtn.prop('disabled', false);
-            $messageInput.focus();  // jQuery 的 .focus() 方法聚焦元素
+            addMessage('bot', answer || '抱歉，我無法生成回答。');
         }
+    }).catch(function(error) {
+        // 顯示錯誤訊息
+        removeMessage(loadingId);
+        addMessage('bot', `錯誤：${error.message}`, false, true);
+    }).finally(function() {
+        // 恢復發送按鈕狀態，並將游標聚焦回輸入框
+        $sendBtn.prop('disabled', false);
+        $messageInput.focus();  // jQuery 的 .focus() 方法聚焦元素
     });
 }
 
+/**
+ * 解析一則 SSE 事件
+ *
+ * @param {string} rawEvent - 以空行分隔出的原始事件文字
+ * @returns {{type: string, data: Object}|null} 事件類型與解析後的資料
+ */
+function parseSseEvent(rawEvent) {
+    let type = 'message';
+    let data = '';
+    rawEvent.split('\n').forEach(function(line) {
+        if (line.startsWith('event:')) {
+            type = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+            data += line.slice(5).trim();
+        }
+    });
+    if (!data) return null;
+    return { type: type, data: JSON.parse(data) };
+}
+
+/**
+ * 更新指定訊息的文字內容
+ *
+ * @param {number} messageId - 要更新的訊息 ID
+ * @param {string} content - 新的訊息內容
+ */
+function updateMessage(messageId, content) {
+    $(`#msg-${messageId}`).find('p').text(content);
+    scrollToBottom();
+}
+
+/**
+ * 訊息 ID 計數器
+ */
+let messageCounter = 0;
+
 /**
  * 在聊天區域新增一則訊息
  * 
@@ -252,11 +421,38 @@ function sendMessage() {
  * @returns {number} 訊息的唯一 ID，可用於後續刪除
  */
 function addMessage(role, content, isLoading = false, isError = false) {
-    // 使用時間戳記作為唯一 ID
-    const messageId = Date.now();
+    const $messageDiv = createMessageElement(role, content, isLoading, isError);
+    
+    // 移除「還沒有對話記錄」的提示訊息
+    // jQuery 的 .find() 方法可以找尋子元素
+    const $emptyMsg = $chatMessages.find('p.text-center');
+    if ($emptyMsg.length > 0) {
+        $emptyMsg.remove();  // jQuery 的 .remove() 方法移除元素
+    }
+    
+    // jQuery 的 .append() 方法將元素加入容器
+    $chatMessages.append($messageDiv);
+    // 自動捲動到最底部
+    scrollToBottom();
+    
+    return $messageDiv.data('messageId');
+}
+
+/**
+ * 建立訊息元素（不加入頁面）
+ * 
+ * @param {string} role - 訊息角色：'user' 或 'bot'
+ * @param {string} content - 訊息內容
+ * @param {boolean} isLoading - 是否為載入中的訊息
+ * @param {boolean} isError - 是否為錯誤訊息
+ * @returns {jQuery} 訊息元素
+ */
+function createMessageElement(role, content, isLoading = false, isError = false) {
+    // 使用遞增計數器作為唯一 ID（同一毫秒內新增多則訊息時時間戳記會重複）
+    const messageId = ++messageCounter;
     
     // jQuery 可以使用 $('<div>') 建立新元素
-    const $messageDiv = $('<div>').attr('id', `msg-${messageId}`);
+    const $messageDiv = $('<div>').attr('id', `msg-${messageId}`).data('messageId', messageId);
     
     // 根據角色決定訊息對齊方式：使用者靠右，機器人靠左
     const flexClass = role === 'user' ? 'justify-end' : 'justify-start';
@@ -277,19 +473,7 @@ function addMessage(role, content, isLoading = false, isError = false) {
     $bubble.append($paragraph);
     $messageDiv.append($bubble);
     
-    // 移除「還沒有對話記錄」的提示訊息
-    // jQuery 的 .find() 方法可以找尋子元素
-    const $emptyMsg = $chatMessages.find('p.text-center');
-    if ($emptyMsg.length > 0) {
-        $emptyMsg.remove();  // jQuery 的 .remove() 方法移除元素
-    }
-    
-    // jQuery 的 .append() 方法將元素加入容器
-    $chatMessages.append($messageDiv);
-    // 自動捲動到最底部
-    scrollToBottom();
-    
-    return messageId;
+    return $messageDiv;
 }
 
 /**
@@ -334,16 +518,20 @@ function scrollToBottom() {
  */
 $clearHistoryBtn.on('click', function() {
     // 使用 confirm 對話框確認使用者真的要清除
-    if (!confirm('確定要清除所有聊天歷史嗎？')) return;
+    if (!confirm('確定要清除目前對話的聊天歷史嗎？')) return;
+    if (!sessionId) return;
 
-    // 使用 jQuery 的 $.ajax() 發送 DELETE 請求
+    // 使用 jQuery 的 $.ajax() 發送 DELETE 請求，只清除目前會話的歷史
     $.ajax({
-        url: `${API_BASE_URL}/history`,
+        url: `${API_BASE_URL}/history?session_id=${encodeURIComponent(sessionId)}`,
         method: 'DELETE',
         success: function() {
             // 清空聊天區域，顯示預設訊息
             // jQuery 的 .html() 方法設定元素的 HTML 內容
             $chatMessages.html('<p class="text-center text-gray-500">還沒有對話記錄</p>');
+            historyCursor = null;
+            // 清除後開始新的會話，先前的對話不再影響回答
+            startNewSession();
         },
         error: function(xhr) {
             const detail = xhr.responseJSON?.detail || '發生錯誤';
@@ -352,33 +540,106 @@ $clearHistoryBtn.on('click', function() {
     });
 });
 
+/**
+ * 每頁載入的歷史記錄筆數
+ */
+const HISTORY_PAGE_SIZE = 20;
+
+/**
+ * 下一頁（較舊記錄）的分頁游標，null 代表已沒有更舊的記錄
+ */
+let historyCursor = null;
+
+/**
+ * 是否正在載入歷史記錄，避免捲動時重複發送請求
+ */
+let isLoadingHistory = false;
+
+/**
+ * 將一頁歷史記錄轉為訊息元素
+ * 
+ * @param {Array} items - 依時間由舊到新排列的歷史記錄
+ * @returns {Array} 訊息元素陣列
+ */
+function createHistoryElements(items) {
+    const elements = [];
+    // 使用 jQuery 的 $.each() 遍歷陣列
+    $.each(items, function(index, item) {
+        elements.push(createMessageElement('user', item.user_message));
+        elements.push(createMessageElement('bot', item.bot_response));
+    });
+    return elements;
+}
+
 /**
  * 載入聊天歷史記錄
- * 使用 jQuery 的 $.ajax() 或 $.getJSON() 取得資料
+ * 只載入最新的一頁，較舊的記錄在捲動到頂端時再載入
  */
 function loadHistory() {
+    isLoadingHistory = true;
     // 使用 jQuery 的 $.ajax() 發送 GET 請求
     $.ajax({
         url: `${API_BASE_URL}/history`,
         method: 'GET',
+        data: { limit: HISTORY_PAGE_SIZE, session_id: sessionId },
         success: function(data) {
+            historyCursor = data.next_cursor;
             // 如果有歷史記錄，逐一顯示
             if (data.history && data.history.length > 0) {
                 $chatMessages.empty();  // jQuery 的 .empty() 清空子元素
-                // 使用 jQuery 的 $.each() 遍歷陣列
-                $.each(data.history, function(index, item) {
-                    addMessage('user', item.user_message);
-                    addMessage('bot', item.bot_response);
-                });
+                $chatMessages.append(createHistoryElements(data.history));
+                scrollToBottom();
             }
         },
         error: function(xhr, status, error) {
             // 載入失敗時只在控制台記錄錯誤
             console.error('載入歷史記錄失敗：', error);
+        },
+        complete: function() {
+            isLoadingHistory = false;
         }
     });
 }
 
+/**
+ * 載入較舊的一頁歷史記錄並插入到最上方
+ * 插入後維持原本的捲動位置，避免畫面跳動
+ */
+function loadOlderHistory() {
+    if (!historyCursor || isLoadingHistory) return;
+    isLoadingHistory = true;
+
+    $.ajax({
+        url: `${API_BASE_URL}/history`,
+        method: 'GET',
+        data: { limit: HISTORY_PAGE_SIZE, cursor: historyCursor, session_id: sessionId },
+        success: function(data) {
+            historyCursor = data.next_cursor;
+            if (data.history && data.history.length > 0) {
+                const previousHeight = $chatMessages[0].scrollHeight;
+                // jQuery 的 .prepend() 方法將元素插入到容器最前面
+                $chatMessages.prepend(createHistoryElements(data.history));
+                $chatMessages.scrollTop($chatMessages[0].scrollHeight - previousHeight + $chatMessages.scrollTop());
+            }
+        },
+        error: function(xhr, status, error) {
+            console.error('載入更早的歷史記錄失敗：', error);
+        },
+        complete: function() {
+            isLoadingHistory = false;
+        }
+    });
+}
+
+/**
+ * 捲動到聊天區域頂端時載入更早的歷史記錄
+ */
+$chatMessages.on('scroll', function() {
+    if ($chatMessages.scrollTop() < 50) {
+        loadOlderHistory();
+    }
+});
+
 // ============================================
 // 頁面初始化
 // ============================================
@@ -388,6 +649,10 @@ function loadHistory() {
  * 也可以簡寫為 $(function() { ... })
  */
 $(document).ready(function() {
-    // 當頁面載入完成時，自動載入歷史記錄
-    loadHistory();
+    // 已有會話時載入該會話的歷史記錄，否則申請新的會話
+    if (sessionId) {
+        loadHistory();
+    } else {
+        startNewSession();
+    }
 });